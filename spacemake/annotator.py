@@ -9,6 +9,7 @@ import logging
 import ncls
 import itertools
 import pickle
+import json
 from time import time
 from collections import defaultdict, OrderedDict, deque
 
@@ -193,6 +194,235 @@ class CompiledClassifier:
 
         return self.joiner(cidx)
 
+    def tag_values(self):
+        """
+        Join the pre-classified annotations into the final gF, gN, gS, gT
+        tag values once, so that tagging a read hitting a single compiled
+        segment is a plain list lookup.
+        """
+        return [
+            tuple([",".join(values) for values in classification])
+            for classification in self.classifications
+        ]
+
+
+class CachedLookup:
+    """
+    Read-only sequence that evaluates func(i) on first access and caches
+    the result. Used to decode entries of the memory-mapped AnnotationIndex
+    only when they are actually needed.
+    """
+
+    def __init__(self, func, n):
+        self.func = func
+        self.n = n
+        self.cache = {}
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        i = int(i)
+        res = self.cache.get(i, None)
+        if res is None:
+            res = self.func(i)
+            self.cache[i] = res
+
+        return res
+
+
+class AnnotationIndex:
+    """
+    Versioned binary format of a compiled annotation, designed to be loaded
+    via mmap. Layout of the file:
+
+        MAGIC (8 bytes), version (uint32), header size (uint32),
+        JSON header with the strand keys and, for every array, its
+        dtype, shape and offset into the file, followed by the flat
+        arrays, each aligned to ALIGN bytes.
+
+    Arrays:
+        strand_bounds   segments of strand_keys[i] are [bounds[i], bounds[i+1])
+        seg_start, seg_end, seg_idx, seg_cid
+                        non-overlapping segments, sorted by start per strand,
+                        their row in the compiled DataFrame and class id
+        cid_table       class id for each row of the compiled DataFrame
+        cls_offsets     annotations of class i are
+                        cls_codes[cls_offsets[i]:cls_offsets[i+1]]
+        cls_codes       (gf, gn, gs, gt) string codes of each annotation
+        tag_codes       string codes of the joined gF, gN, gS, gT tag values
+        str_offsets, str_data
+                        string table (utf-8)
+
+    The file is read-only once written, so all processes loading it on a
+    node share the same pages.
+    """
+
+    MAGIC = b"SPMKANN\0"
+    VERSION = 1
+    ALIGN = 64
+
+    logger = logging.getLogger("AnnotationIndex")
+
+    @staticmethod
+    def get_filename(path):
+        return os.path.join(path, "annotation.idx")
+
+    @staticmethod
+    def exists(path):
+        return os.access(AnnotationIndex.get_filename(path), os.R_OK)
+
+    @classmethod
+    def write(cls, fname, ga):
+        """
+        Store the compiled GenomeAnnotation ga in binary form. The file is
+        written under a temporary name and moved into place, so concurrent
+        readers never see a partial index.
+        """
+        strings = {}
+
+        def code(x):
+            c = strings.get(x, None)
+            if c is None:
+                c = len(strings)
+                strings[x] = c
+            return c
+
+        classifications = ga.classifier.classifications
+        cls_offsets = np.zeros(len(classifications) + 1, dtype=np.int64)
+        cls_codes = []
+        tag_codes = []
+        for i, classification in enumerate(classifications):
+            anns = list(zip(*classification))
+            cls_offsets[i + 1] = cls_offsets[i] + len(anns)
+            cls_codes.extend([[code(x) for x in ann] for ann in anns])
+            tag_codes.append([code(",".join(values)) for values in classification])
+
+        data = [x.encode("utf-8") for x in strings.keys()]
+        str_offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in data], out=str_offsets[1:])
+
+        strand_keys = sorted(ga.seg_ranges.keys())
+        strand_bounds = [0] + [ga.seg_ranges[key][1] for key in strand_keys]
+        arrays = dict(
+            strand_bounds=np.array(strand_bounds, dtype=np.int64),
+            seg_start=ga.seg_starts.astype(np.int64),
+            seg_end=ga.seg_ends.astype(np.int64),
+            seg_idx=ga.seg_idx.astype(np.int64),
+            seg_cid=ga.seg_cid.astype(np.int32),
+            cid_table=np.asarray(ga.classifier.cid_table, dtype=np.int32),
+            cls_offsets=cls_offsets,
+            cls_codes=np.array(cls_codes, dtype=np.int32).reshape(-1, 4),
+            tag_codes=np.array(tag_codes, dtype=np.int32).reshape(-1, 4),
+            str_offsets=str_offsets,
+            str_data=np.frombuffer(b"".join(data), dtype=np.uint8),
+        )
+
+        # header size depends on the offsets and vice versa. Offsets are
+        # relative to the end of the (padded) header and shifted afterwards
+        layout = {}
+        ofs = 0
+        for name, arr in arrays.items():
+            layout[name] = [arr.dtype.str, list(arr.shape), ofs]
+            ofs += -(-arr.nbytes // cls.ALIGN) * cls.ALIGN
+
+        def make_header(shift):
+            shifted = {k: [d, sh, o + shift] for k, (d, sh, o) in layout.items()}
+            header = dict(strands=strand_keys, arrays=shifted)
+            return json.dumps(header).encode("utf-8")
+
+        start = cls.ALIGN
+        while True:
+            header = make_header(start)
+            head_size = len(cls.MAGIC) + 8 + len(header)
+            if head_size <= start:
+                break
+            start = -(-head_size // cls.ALIGN) * cls.ALIGN
+
+        t0 = time()
+        tmp = f"{fname}.tmp.{os.getpid()}"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(cls.MAGIC)
+                f.write(np.array([cls.VERSION, len(header)], dtype="<u4").tobytes())
+                f.write(header)
+                for name, arr in arrays.items():
+                    f.seek(layout[name][2] + start)
+                    f.write(np.ascontiguousarray(arr).tobytes())
+
+                f.truncate(start + ofs)
+
+            os.replace(tmp, fname)
+        except OSError:
+            # e.g. disk full: do not leave a partial file behind
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        dt = time() - t0
+        cls.logger.info(
+            f"stored binary annotation index with {len(ga.seg_starts)} segments "
+            f"and {len(classifications)} classifications in {fname} in {dt:.3f} seconds"
+        )
+
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            magic = f.read(len(self.MAGIC))
+            if magic != self.MAGIC:
+                raise ValueError(f"'{fname}' is not a spacemake annotation index")
+
+            version, head_len = np.frombuffer(f.read(8), dtype="<u4")
+            if version != self.VERSION:
+                raise ValueError(
+                    f"'{fname}' has annotation index version {version}, "
+                    f"expected {self.VERSION}. Please re-compile the annotation"
+                )
+            header = json.loads(f.read(int(head_len)).decode("utf-8"))
+
+        self.fname = fname
+        self.strand_keys = [tuple(key) for key in header["strands"]]
+        self.buf = np.memmap(fname, dtype=np.uint8, mode="r")
+        for name, (dtype, shape, ofs) in header["arrays"].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arr = self.buf[ofs : ofs + nbytes].view(dtype).reshape(shape)
+            setattr(self, name, arr)
+
+        n_cls = len(self.cls_offsets) - 1
+        self.strings = CachedLookup(self.get_string, len(self.str_offsets) - 1)
+        self.classifications = CachedLookup(self.get_classification, n_cls)
+        self.tag_values = CachedLookup(self.get_tag_values, n_cls)
+
+    def get_string(self, i):
+        data = self.str_data[self.str_offsets[i] : self.str_offsets[i + 1]]
+        return bytes(data).decode("utf-8")
+
+    def get_classification(self, cid):
+        codes = self.cls_codes[self.cls_offsets[cid] : self.cls_offsets[cid + 1]]
+        return tuple(
+            [[self.strings[c] for c in column] for column in codes.T.tolist()]
+        )
+
+    def get_tag_values(self, cid):
+        return tuple([self.strings[c] for c in self.tag_codes[cid].tolist()])
+
+
+class IndexedClassifier(CompiledClassifier):
+    """
+    CompiledClassifier backed by a memory-mapped AnnotationIndex. Decodes
+    classifications on first use instead of unpickling all of them.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.cid_table = index.cid_table
+        self.classifications = index.classifications
+
+    def tag_values(self):
+        return self.index.tag_values
+
+
+as_strand = {"+": "-", "-": "+"}
+
 
 ## Helper functions for working with NCLS
 def query(nc, x0, x1):
@@ -263,7 +493,7 @@ class GenomeAnnotation:
 
     logger = logging.getLogger("GenomeAnnotation")
 
-    def __init__(self, df, processor, is_compiled=False):
+    def __init__(self, df, processor, is_compiled=False, classifier=None):
         """
         [summary]
 
@@ -273,9 +503,22 @@ class GenomeAnnotation:
             the indices point into the dataframe to all
             overlapping features
         :type processor: function that takes frozenset(indices) as sole argument
+        :param classifier: CompiledClassifier of a compiled annotation. Enables
+            the batched lookup via sorted segment arrays (see query_blocks_batch)
+        :type classifier: CompiledClassifier
         """
         # self.df = df
         self.processor = processor
+        self.is_compiled = is_compiled
+        self.classifier = classifier
+        self.multi_cache = {}
+        if df is None:
+            # segments are set up by from_binary_index()
+            self.strand_keys = []
+            self.strand_map = {}
+            self.seg_ranges = {}
+            self.empty = frozenset([])
+            return
 
         # find all unique combinations of chrom + strand
         strands = df[["chrom", "strand"]].drop_duplicates().values
@@ -283,6 +526,15 @@ class GenomeAnnotation:
         self.strand_map = {}
         self.empty = frozenset([])
 
+        # compiled segments do not overlap. Sorted by start, their ends are
+        # sorted as well and all strands are concatenated into flat arrays.
+        # seg_ranges[strand_key] holds the (first, last + 1) segment of a strand
+        self.seg_ranges = {}
+        seg_starts = []
+        seg_ends = []
+        seg_idx = []
+        n_seg = 0
+
         t0 = time()
         for strand_key in sorted(self.strand_keys):
             chrom, strand = strand_key
@@ -291,11 +543,53 @@ class GenomeAnnotation:
             nested_list = ncls.NCLS(d["start"], d["end"], d.index)
             self.strand_map[strand_key] = nested_list
 
+            if is_compiled:
+                order = np.argsort(d["start"].values, kind="stable")
+                seg_starts.append(d["start"].values[order])
+                seg_ends.append(d["end"].values[order])
+                seg_idx.append(d.index.values[order])
+                self.seg_ranges[strand_key] = (n_seg, n_seg + len(d))
+                n_seg += len(d)
+
         dt = time() - t0
         self.logger.info(
             f"constructed nested lists of {len(df)} features on {len(self.strand_keys)} strands in {dt:.3f}s"
         )
-        self.is_compiled = is_compiled
+        if is_compiled and classifier is not None:
+            self.seg_starts = np.concatenate(seg_starts or [[]]).astype(np.int64)
+            self.seg_ends = np.concatenate(seg_ends or [[]]).astype(np.int64)
+            self.seg_idx = np.concatenate(seg_idx or [[]]).astype(np.int64)
+            self.seg_cid = classifier.cid_table[self.seg_idx]
+            self.tag_values = classifier.tag_values()
+
+    @classmethod
+    def from_binary_index(cls, path):
+        """
+        Memory-map the binary AnnotationIndex stored in path. No nested lists
+        are built and classifications are decoded only when first needed,
+        so this is near-instant and the data are shared between processes.
+        """
+        t0 = time()
+        index = AnnotationIndex(AnnotationIndex.get_filename(path))
+        cl = IndexedClassifier(index)
+        ga = cls(None, lambda idx: cl.process(idx), is_compiled=True, classifier=cl)
+
+        ga.strand_keys = index.strand_keys
+        bounds = index.strand_bounds.tolist()
+        for i, strand_key in enumerate(index.strand_keys):
+            ga.seg_ranges[strand_key] = (bounds[i], bounds[i + 1])
+
+        ga.seg_starts = index.seg_start
+        ga.seg_ends = index.seg_end
+        ga.seg_idx = index.seg_idx
+        ga.seg_cid = index.seg_cid
+        ga.tag_values = cl.tag_values()
+        dt = time() - t0
+        cls.logger.info(
+            f"mapped binary annotation index with {len(ga.seg_starts)} segments "
+            f"on {len(ga.strand_keys)} strands in {dt:.3f} seconds"
+        )
+        return ga
 
     @classmethod
     def from_compiled_index(cls, path):
@@ -310,7 +604,7 @@ class GenomeAnnotation:
         ## Create a secondary Annotator which uses the non-overlapping combinations
         ## and the pre-classified annotations for the actual tagging
         cl = CompiledClassifier(cdf, classifications)
-        gc = cls(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        gc = cls(cdf, lambda idx: cl.process(idx), is_compiled=True, classifier=cl)
         return gc
 
     @classmethod
@@ -352,7 +646,14 @@ class GenomeAnnotation:
     def query_idx(self, chrom, start, end, strand):
         strand_key = (chrom, strand)
         if not strand_key in self.strand_map:
-            return self.empty
+            if not strand_key in self.seg_ranges:
+                return self.empty
+
+            # loaded from a binary index: build the nested list on demand
+            a, b = self.seg_ranges[strand_key]
+            self.strand_map[strand_key] = ncls.NCLS(
+                self.seg_starts[a:b], self.seg_ends[a:b], self.seg_idx[a:b]
+            )
 
         nested_list = self.strand_map[strand_key]
         return query(nested_list, start, end)
@@ -371,6 +672,152 @@ class GenomeAnnotation:
         idx = self.query_idx_blocks(chrom, strand, blocks)
         return self.processor(idx)
 
+    def query_segments_batch(self, chroms, strands, blocks):
+        """
+        Vectorized overlap search of the aligned blocks of many reads against
+        the compiled, non-overlapping segments. Every read needs at least one
+        block.
+
+        :return: per block the range [lo, hi) of overlapping segments (empty
+            ranges are set to lo=len(segments), hi=-1), and per read the
+            first block index, the lowest lo and the highest hi
+        :rtype: tuple of np.arrays (lo, hi, first, lo_min, hi_max)
+        """
+        n_blocks = np.array([len(b) for b in blocks], dtype=np.int64)
+        first = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum(n_blocks, out=first[1:])
+        coords = np.fromiter(
+            itertools.chain.from_iterable(itertools.chain.from_iterable(blocks)),
+            dtype=np.int64,
+            count=2 * first[-1],
+        )
+        x0 = coords[0::2]
+        x1 = coords[1::2]
+
+        # integer strand key per read, -1 for strands without annotation
+        key_ids = {}
+        key_list = []
+        read_keys = np.empty(len(blocks), dtype=np.int64)
+        for i, strand_key in enumerate(zip(chroms, strands)):
+            k = key_ids.get(strand_key, None)
+            if k is None:
+                k = len(key_list) if strand_key in self.seg_ranges else -1
+                if k >= 0:
+                    key_list.append(strand_key)
+                key_ids[strand_key] = k
+
+            read_keys[i] = k
+
+        block_keys = np.repeat(read_keys, n_blocks)
+        n_seg = len(self.seg_starts)
+        lo = np.full(len(x0), n_seg, dtype=np.int64)
+        hi = np.full(len(x0), -1, dtype=np.int64)
+        for k, strand_key in enumerate(key_list):
+            a, b = self.seg_ranges[strand_key]
+            mask = block_keys == k
+            # same semantics as NCLS.find_overlap: start < x1 and end > x0
+            lo[mask] = a + np.searchsorted(self.seg_ends[a:b], x0[mask], "right")
+            hi[mask] = a + np.searchsorted(self.seg_starts[a:b], x1[mask], "left")
+
+        empty = hi <= lo
+        lo[empty] = n_seg
+        hi[empty] = -1
+
+        lo_min = np.minimum.reduceat(lo, first[:-1])
+        hi_max = np.maximum.reduceat(hi, first[:-1])
+
+        return lo, hi, first, lo_min, hi_max
+
+    def query_tags_batch(self, chroms, strands, blocks):
+        """
+        Annotate many reads at once using the compiled segment arrays.
+
+        :return: list with a (gF, gN, gS, gT) tuple of tag values per read,
+            or None if the read does not overlap any feature
+        """
+        if not len(self.seg_starts):
+            return [None] * len(blocks)
+
+        lo, hi, first, lo_min, hi_max = self.query_segments_batch(
+            chroms, strands, blocks
+        )
+        # reads that overlap exactly one segment are a simple lookup
+        single = (hi_max - lo_min) == 1
+        cids = self.seg_cid[np.where(single, lo_min, 0)]
+
+        results = []
+        tag_values = self.tag_values
+        for i, (n, cid) in enumerate(zip((hi_max - lo_min).tolist(), cids.tolist())):
+            if n <= 0:
+                results.append(None)
+            elif n == 1:
+                results.append(tag_values[cid])
+            else:
+                # several segments. Build the same index set as query_idx_blocks()
+                # to get the identical joined annotation. The result only
+                # depends on the segment ranges of the blocks, so cache it
+                j0, j1 = first[i], first[i + 1]
+                key = (tuple(lo[j0:j1].tolist()), tuple(hi[j0:j1].tolist()))
+                res = self.multi_cache.get(key, None)
+                if res is None:
+                    idx = set()
+                    for a, b in zip(*key):
+                        if a < b:
+                            idx |= frozenset(self.seg_idx[a:b].tolist())
+
+                    gf, gn, gs, gt = self.processor(frozenset(idx))
+                    res = (",".join(gf), ",".join(gn), ",".join(gs), ",".join(gt))
+                    self.multi_cache[key] = res
+
+                results.append(res)
+
+        return results
+
+    def query_blocks_batch(self, chroms, strands, blocks, antisense=False):
+        """
+        Annotate a batch of aligned reads, given as lists of chromosome names,
+        strands and aligned blocks (as returned by pysam get_blocks()).
+        With antisense=True, the hits on the opposite strand are appended
+        to the sense hits.
+
+        :return: list with a (gF, gN, gS, gT) tuple of tag values per read,
+            or None if the read does not overlap any feature
+        """
+        if self.is_compiled and self.classifier is not None:
+            results = self.query_tags_batch(chroms, strands, blocks)
+            if antisense:
+                as_strands = [as_strand[strand] for strand in strands]
+                results_as = self.query_tags_batch(chroms, as_strands, blocks)
+                results = [
+                    tuple([",".join(x) for x in zip(s, a)]) if (s and a) else s or a
+                    for s, a in zip(results, results_as)
+                ]
+
+            return results
+
+        results = []
+        for chrom, strand, read_blocks in zip(chroms, strands, blocks):
+            gf, gn, gs, gt = [
+                list(x) for x in self.query_blocks(chrom, strand, read_blocks)
+            ]
+            if antisense:
+                gf_as, gn_as, gs_as, gt_as = self.query_blocks(
+                    chrom, as_strand[strand], read_blocks
+                )
+                gf += gf_as
+                gn += gn_as
+                gs += gs_as
+                gt += gt_as
+
+            if len(gf):
+                results.append(
+                    (",".join(gf), ",".join(gn), ",".join(gs), ",".join(gt))
+                )
+            else:
+                results.append(None)
+
+        return results
+
     def compile(self, path=""):
         chroms = []
         strands = []
@@ -429,14 +876,19 @@ class GenomeAnnotation:
         ## Create a secondary Annotator which uses the non-overlapping combinations
         ## and the pre-classified annotations for the actual tagging
         cl = CompiledClassifier(cdf, classifications)
-        gc = GenomeAnnotation(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        gc = GenomeAnnotation(
+            cdf, lambda idx: cl.process(idx), is_compiled=True, classifier=cl
+        )
+        if path:
+            AnnotationIndex.write(AnnotationIndex.get_filename(path), gc)
 
         return gc
 
-    def annotate_BAM(self, src, out, antisense=False, interval=5):
+    def annotate_BAM(
+        self, src, out, antisense=False, interval=5, chunk_size=10000
+    ):
         import pysam
 
-        as_strand = {"+": "-", "-": "+"}
         self.logger.info(
             f"beginning BAM annotation: {src} -> {out}. is_compiled={self.is_compiled}"
         )
@@ -444,32 +896,32 @@ class GenomeAnnotation:
         out = pysam.AlignmentFile(out, "wbu", template=bam)
         t0 = time()
         T = interval
-        for n, read in enumerate(bam.fetch(until_eof=True)):
-            if not read.is_unmapped:
-                chrom = bam.get_reference_name(read.tid)
-                strand = "-" if read.is_reverse else "+"
-
-                gf, gn, gs, gt = self.query_blocks(chrom, strand, read.get_blocks())
-                if antisense:
-                    gf_as, gn_as, gs_as, gt_as = self.query_blocks(
-                        chrom, as_strand[strand], read.get_blocks()
-                    )
-                    gf += gf_as
-                    gn += gn_as
-                    gs += gs_as
-                    gt += gt_as
-
-                if len(gf):
-                    read.tags += [
-                        ("gF", ",".join(gf)),
-                        ("gN", ",".join(gn)),
-                        ("gS", ",".join(gs)),
-                        ("gT", ",".join(gt)),
-                    ]
+        n = 0
+        dt = 0
+        reads = bam.fetch(until_eof=True)
+        while True:
+            chunk = list(itertools.islice(reads, chunk_size))
+            if not chunk:
+                break
+
+            mapped = [read for read in chunk if not read.is_unmapped]
+            chroms = [bam.get_reference_name(read.tid) for read in mapped]
+            strands = ["-" if read.is_reverse else "+" for read in mapped]
+            blocks = [read.get_blocks() for read in mapped]
+            results = self.query_blocks_batch(
+                chroms, strands, blocks, antisense=antisense
+            )
+            for read, res in zip(mapped, results):
+                if res:
+                    gf, gn, gs, gt = res
+                    read.tags += [("gF", gf), ("gN", gn), ("gS", gs), ("gT", gt)]
                 else:
                     read.tags += [("gF", "INTERGENIC")]
 
-            out.write(read)
+            for read in chunk:
+                out.write(read)
+
+            n += len(chunk)
             dt = time() - t0
             if dt > T:
                 self.logger.info(
@@ -478,7 +930,7 @@ class GenomeAnnotation:
                 T += interval
 
         self.logger.info(
-            f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+            f"processed {n} alignments in {dt:.2f} seconds ({n/max(dt, 1e-9):.2f} reads/second)"
         )
 
 
@@ -524,8 +976,20 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    if CompiledClassifier.files_exist(args.compiled) and args.use_compiled:
+    if args.use_compiled and AnnotationIndex.exists(args.compiled):
+        ga = GenomeAnnotation.from_binary_index(args.compiled)
+
+    elif CompiledClassifier.files_exist(args.compiled) and args.use_compiled:
         ga = GenomeAnnotation.from_compiled_index(args.compiled)
+        # older caches lack the binary index. Add it for the next run, if
+        # we can. The cache may well be read-only (e.g. shared by a group)
+        try:
+            AnnotationIndex.write(AnnotationIndex.get_filename(args.compiled), ga)
+        except OSError as err:
+            AnnotationIndex.logger.warning(
+                f"could not add the binary annotation index to '{args.compiled}' "
+                f"({err}). Continuing with the compiled annotation"
+            )
 
     elif args.tabular and os.access(args.tabular, os.R_OK):
         ga = GenomeAnnotation.from_uncompiled_df(args.tabular)
@@ -0,0 +1,376 @@
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+# Minimal native BAM writing for unaligned reads. Records are encoded
+# directly into their binary representation and compressed into BGZF
+# blocks, so that worker processes can hand ready-to-write bytes to a
+# collector, which only has to concatenate them in order.
+
+import struct
+import zlib
+import numpy as np
+
+# BGZF blocks may hold at most 64 kB of data. htslib uses the same
+# slightly smaller limit, which guarantees that even incompressible data
+# fits into a single block.
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_MAX_BLOCK = 0x10000
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_TAIL = struct.Struct("<II")
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+# fixed part of a BAM record for unmapped reads
+BAM_CORE = np.dtype(
+    [
+        ("block_size", "<i4"),
+        ("refID", "<i4"),
+        ("pos", "<i4"),
+        ("l_read_name", "u1"),
+        ("mapq", "u1"),
+        ("bin", "<u2"),
+        ("n_cigar_op", "<u2"),
+        ("flag", "<u2"),
+        ("l_seq", "<u4"),
+        ("next_refID", "<i4"),
+        ("next_pos", "<i4"),
+        ("tlen", "<i4"),
+    ]
+)
+# reg2bin(-1, 0), which is what htslib stores for unplaced reads
+UNMAPPED_BIN = 4680
+
+# 4-bit nucleotide codes as defined in the SAM specification.
+# Anything that is not a valid IUPAC code becomes 'N' (15)
+NT16 = np.full(256, 15, dtype=np.uint8)
+for i, c in enumerate("=ACMGRSVTWYHKDBN"):
+    NT16[ord(c)] = i
+    NT16[ord(c.lower())] = i
+
+QUAL_TABLE = bytes([max(i - 33, 0) for i in range(256)])
+
+# struct formats of the numeric tag types, and the B array subtype for each
+# array.array typecode (as returned by pysam)
+TAG_FORMATS = {"c": "b", "C": "B", "s": "h", "S": "H", "i": "i", "I": "I", "f": "f"}
+ARRAY_SUBTYPES = {"b": "c", "B": "C", "h": "s", "H": "S", "i": "i", "I": "I", "f": "f"}
+# types for non-negative integer tags, smallest first (as chosen by pysam)
+UINT_TYPES = [("C", 2**8), ("S", 2**16), ("I", 2**32)]
+
+
+def bgzf_block(data, level=6):
+    """
+    compress up to BGZF_BLOCK_SIZE bytes into a single, complete BGZF block
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    if len(cdata) + BGZF_HEADER.size + BGZF_TAIL.size > BGZF_MAX_BLOCK:
+        # can only happen for incompressible data. Store instead.
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+
+    bsize = len(cdata) + BGZF_HEADER.size + BGZF_TAIL.size
+    return b"".join(
+        [
+            BGZF_HEADER.pack(
+                0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, bsize - 1
+            ),
+            cdata,
+            BGZF_TAIL.pack(zlib.crc32(data), len(data)),
+        ]
+    )
+
+
+def bgzf_compress(data, level=6, pool=None):
+    """
+    compress an arbitrary amount of data into a sequence of complete BGZF
+    blocks. The result can be concatenated with other BGZF data.
+    If a concurrent.futures.ThreadPoolExecutor is passed as pool, blocks are
+    compressed in parallel (zlib releases the GIL). The output does not
+    depend on the number of threads.
+    """
+    blocks = [data[i : i + BGZF_BLOCK_SIZE] for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+    if pool is not None and len(blocks) > 1:
+        return b"".join(pool.map(bgzf_block, blocks, [level] * len(blocks)))
+
+    return b"".join([bgzf_block(block, level=level) for block in blocks])
+
+
+def compression_pool(threads):
+    """
+    returns a thread pool for bgzf_compress() or None if threads < 2
+    """
+    if threads < 2:
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=threads)
+
+
+def header_bytes(header):
+    """
+    binary BAM header for a pysam.AlignmentHeader (or a dict describing one)
+    without reference sequences, as appropriate for unaligned BAM.
+    """
+    import pysam
+
+    if isinstance(header, dict):
+        header = pysam.AlignmentHeader.from_dict(header)
+
+    text = str(header).rstrip("\n").encode("ascii") + b"\n"
+    return b"".join(
+        [b"BAM\1", struct.pack("<i", len(text)), text, struct.pack("<i", 0)]
+    )
+
+
+def tags_to_text(tags):
+    """
+    text form of the tags of a read, as returned by pysam's
+    get_tags(with_value_type=True). Fields look like in SAM and are separated
+    by tabs, but numbers keep their binary type (c, C, s, S, i, I or f), so
+    that encode_tags() restores the tags exactly.
+    """
+    fields = []
+    for tag, value, vtype in tags:
+        if vtype == "B":
+            value = ",".join([ARRAY_SUBTYPES[value.typecode]] + [str(v) for v in value])
+
+        fields.append(f"{tag}:{vtype}:{value}")
+
+    return "\t".join(fields)
+
+
+def encode_tags(text):
+    """
+    binary BAM representation of tags given in the text form of
+    tags_to_text()
+    """
+    parts = []
+    for field in text.split("\t"):
+        if not field:
+            continue
+
+        tag, vtype, value = field.split(":", 2)
+        if vtype == "Z" or vtype == "H":
+            parts.append(f"{tag}{vtype}{value}\0".encode("ascii"))
+        elif vtype == "A":
+            parts.append(f"{tag}A{value}".encode("ascii"))
+        elif vtype == "B":
+            sub, *values = value.split(",")
+            conv = float if sub == "f" else int
+            parts.append(
+                struct.pack(
+                    f"<2s2si{len(values)}{TAG_FORMATS[sub]}",
+                    tag.encode("ascii"),
+                    ("B" + sub).encode("ascii"),
+                    len(values),
+                    *map(conv, values),
+                )
+            )
+        else:
+            conv = float if vtype == "f" else int
+            parts.append(
+                struct.pack(
+                    "<2sc" + TAG_FORMATS[vtype],
+                    tag.encode("ascii"),
+                    vtype.encode("ascii"),
+                    conv(value),
+                )
+            )
+
+    return b"".join(parts)
+
+
+def int_tag(tag, value):
+    """
+    binary BAM representation of a tag with a non-negative integer value,
+    in the smallest type that holds it
+    """
+    for vtype, limit in UINT_TYPES:
+        if value < limit:
+            return struct.pack(
+                "<2sc" + TAG_FORMATS[vtype],
+                tag.encode("ascii"),
+                vtype.encode("ascii"),
+                value,
+            )
+
+    raise ValueError(f"value {value} of tag {tag} is too large")
+
+
+def encode_aux(texts):
+    """
+    encode_tags() for a list of texts at once. Returns the concatenated
+    binary tags and their length for each text.
+    """
+    joined = "\n".join(texts)
+    n_fields = joined.count("\t") + len(texts)
+    # every field has at least two colons. If there are exactly two per field
+    # and as many ':Z:' as fields, all fields are string tags without colons
+    # in their values, and can be converted in one go
+    if (
+        all(texts)
+        and joined.count(":") == 2 * n_fields
+        and joined.count(":Z:") == n_fields
+    ):
+        joined = joined.replace(":Z:", "Z").replace("\t", "\0")
+        lines = (joined.replace("\n", "\0\n") + "\0").split("\n")
+        return "".join(lines).encode("ascii"), str_lengths(lines)
+
+    aux = [encode_tags(text) for text in texts]
+    return b"".join(aux), str_lengths(aux)
+
+
+def str_lengths(strings):
+    return np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+
+
+def encode_seqs(seqs, lens=None):
+    """
+    pack a list of sequences into 4-bit BAM encoding at once. Returns the
+    concatenated packed sequences and the number of bytes for each.
+    """
+    if lens is None:
+        lens = str_lengths(seqs)
+
+    codes = NT16[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+    # pad odd-length sequences so that pairs of bases never straddle two reads
+    odd = (lens & 1).astype(bool)
+    if odd.any():
+        codes = np.insert(codes, np.cumsum(lens)[odd], 0)
+
+    packed = (codes[0::2] << 4) | codes[1::2]
+    return packed.tobytes(), (lens + 1) >> 1
+
+
+def interleave(parts):
+    """
+    Assemble records from their parts. parts is a list of (buffer, lengths),
+    where buffer holds the concatenation of that part over all records.
+    Returns the concatenated records and the offsets at which each record
+    starts (plus the total length).
+    """
+    lens = np.stack([l for buf, l in parts], axis=1)
+    rec_lens = lens.sum(axis=1)
+    offsets = np.zeros(len(rec_lens) + 1, dtype=np.int64)
+    np.cumsum(rec_lens, out=offsets[1:])
+    # where each part starts in the output
+    dst = offsets[:-1, None] + np.cumsum(lens, axis=1) - lens
+
+    # scatter each part to its place. Smaller index types save memory traffic
+    itype = np.int32 if offsets[-1] < 2**31 else np.int64
+    out = np.empty(offsets[-1], dtype=np.uint8)
+    for j, (buf, l) in enumerate(parts):
+        src = np.frombuffer(buf, dtype=np.uint8)
+        shift = (dst[:, j] - (np.cumsum(l) - l)).astype(itype)
+        out[np.repeat(shift, l) + np.arange(len(src), dtype=itype)] = src
+
+    return out.tobytes(), offsets
+
+
+def encode_unmapped(qnames, seqs, quals, tags, flag=4, aux=None):
+    """
+    encode a chunk of unmapped reads into binary BAM records.
+
+    qnames, seqs, quals: lists of strings (quals in phred+33 ASCII)
+    tags: list of (tag name, list of string or int values), one value per
+        read. Reads with a value of None do not get the tag.
+    aux: optional list with further tags of each read, in the text form of
+        tags_to_text(). They are placed before tags.
+
+    Returns the concatenated records and the byte offsets at which each
+    record starts (plus the total length).
+    """
+    n = len(seqs)
+    if not n:
+        return b"", np.zeros(1, dtype=np.int64)
+
+    l_seq = str_lengths(seqs)
+    l_qual = str_lengths(quals)
+    if (l_seq != l_qual).any():
+        i = (l_seq != l_qual).argmax()
+        raise ValueError(
+            f"read '{qnames[i]}' has {l_seq[i]} bases but {l_qual[i]} quality scores"
+        )
+
+    l_name = str_lengths(qnames) + 1
+    parts = [
+        (None, np.full(n, BAM_CORE.itemsize, dtype=np.int64)),
+        (("\0".join(qnames) + "\0").encode("ascii"), l_name),
+        encode_seqs(seqs, l_seq),
+        ("".join(quals).encode("ascii").translate(QUAL_TABLE), l_seq),
+    ]
+    if aux is not None:
+        parts.append(encode_aux(aux))
+
+    for name, values in tags:
+        prefix = name + "Z"
+        if isinstance(next((v for v in values if v is not None), None), int):
+            binary = [None if v is None else int_tag(name, v) for v in values]
+            lens = np.array(
+                [0 if b is None else len(b) for b in binary], dtype=np.int64
+            )
+            parts.append((b"".join([b for b in binary if b is not None]), lens))
+            continue
+
+        if None in values:
+            present = [v for v in values if v is not None]
+            lens = np.zeros(n, dtype=np.int64)
+            has_tag = np.array([v is not None for v in values])
+            lens[has_tag] = str_lengths(present) + len(prefix) + 1
+            values = present
+
+        else:
+            lens = str_lengths(values) + len(prefix) + 1
+
+        if not values:
+            parts.append((b"", lens))
+            continue
+
+        parts.append(
+            ((prefix + ("\0" + prefix).join(values) + "\0").encode("ascii"), lens)
+        )
+
+    core = np.zeros(n, dtype=BAM_CORE)
+    core["block_size"] = sum([l for buf, l in parts]) - 4
+    core["refID"] = -1
+    core["pos"] = -1
+    core["l_read_name"] = l_name
+    core["bin"] = UNMAPPED_BIN
+    core["flag"] = flag
+    core["l_seq"] = l_seq
+    core["next_refID"] = -1
+    core["next_pos"] = -1
+    parts[0] = (core.tobytes(), parts[0][1])
+
+    return interleave(parts)
+
+
+class BAMWriter:
+    """
+    Writes pre-encoded BAM data. The header is written on construction, data
+    passed to write() must already be BGZF compressed (see
+    bgzf_compress()). close() appends the BGZF EOF marker.
+    """
+
+    def __init__(self, fname, header, level=6, pool=None):
+        self.fname = fname
+        self.level = level
+        self.pool = pool
+        self.out = open(fname, "wb")
+        self.out.write(bgzf_compress(header_bytes(header), level=level))
+
+    def write(self, data):
+        self.out.write(data)
+
+    def write_records(self, records):
+        self.write(
+            bgzf_compress(b"".join(records), level=self.level, pool=self.pool)
+        )
+
+    def close(self):
+        self.out.write(BGZF_EOF)
+        self.out.close()
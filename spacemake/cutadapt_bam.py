@@ -7,19 +7,129 @@ __version__ = "0.9"
 __author__ = ["Marvin Jens"]
 __license__ = "GPL"
 
-import multiprocessing as mp
+from functools import partial
+from itertools import islice
 from spacemake.parallel import (
-    put_or_abort,
-    queue_iter,
-    join_with_empty_queues,
+    Checkpoint,
     chunkify,
     ExceptionLogging,
-    log_qerr,
+    HAVE_SHARED_MEMORY,
+    Pipeline,
+)
+from spacemake.bam import (
+    BAMWriter,
+    BGZF_EOF,
+    bgzf_compress,
+    compression_pool,
+    encode_unmapped,
+    header_bytes,
+    str_lengths,
+    tags_to_text,
 )
 from time import time
+import re
 import pysam
 import logging
 
+# command line arguments that do not affect the output (see Checkpoint)
+CHECKPOINT_IGNORE = [
+    "checkpoint",
+    "checkpoint_interval",
+    "resume",
+    "threads_read",
+    "threads_write",
+    "threads_work",
+    "shared_memory",
+    "max_mb_in_flight",
+    "monitor_file",
+    "monitor_interval",
+    "stats_out",
+    "start_report",
+    "polyA_report",
+]
+
+
+def add_trim_arguments(parser):
+    "adds the arguments that control trimming (see trim_chunk()) to parser"
+    parser.add_argument(
+        "--adapters-right",
+        help="FASTA file with adapter sequences to trim from the right (3') end of the reads",
+        default="",
+    )
+    parser.add_argument(
+        "--adapters-left",
+        help="FASTA file with adapter sequences to trim from the left (5') end of the reads",
+        default="",
+    )
+    parser.add_argument(
+        "--start-sequence",
+        help=(
+            "trim this sequence (e.g. the SMART adapter), or a suffix of it, from "
+            "the start of the reads, like Drop-seq's TrimStartingSequence "
+            "(default=off)"
+        ),
+        default="",
+    )
+    parser.add_argument(
+        "--start-mismatches",
+        help="mismatches allowed for --start-sequence (default=0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--start-min-bases",
+        help="minimal number of bases of --start-sequence to trim (default=5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--start-tag",
+        help="tag for the first base kept after trimming --start-sequence (default=ZS)",
+        default="ZS",
+    )
+    parser.add_argument(
+        "--start-report",
+        help="write a summary of --start-sequence trimming here",
+        default="",
+    )
+    parser.add_argument(
+        "--polyA-min-bases",
+        help=(
+            "trim polyA tails of at least this many bases from the end of the "
+            "reads, like Drop-seq's PolyATrimmer (default=0 off)"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--polyA-mismatches",
+        help="mismatches allowed in polyA tails (default=0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--polyA-tag",
+        help="tag for the start of the trimmed polyA tail (default=ZP)",
+        default="ZP",
+    )
+    parser.add_argument(
+        "--polyA-report",
+        help="write a summary of polyA trimming here",
+        default="",
+    )
+    parser.add_argument(
+        "--min-length",
+        help="minimal allowed read-length left after trimming (default=18)",
+        type=int,
+        default=18,
+    )
+    parser.add_argument(
+        "--min-qual",
+        help="minimal quality score for quality trimming (default=20)",
+        type=int,
+        default=20,
+    )
+
 
 def parse_cmdline():
     import argparse
@@ -43,34 +153,13 @@ def parse_cmdline():
         help="bam output mode (default=b0)",
         default="b0",
     )
-    parser.add_argument(
-        "--adapters-right",
-        help="FASTA file with adapter sequences to trim from the right (3') end of the reads",
-        default="",
-    )
-    parser.add_argument(
-        "--adapters-left",
-        help="FASTA file with adapter sequences to trim from the left (5') end of the reads",
-        default="",
-    )
+    add_trim_arguments(parser)
     parser.add_argument(
         "--skim",
         help="skim through the BAM by investigating only every <skim>-th record (default=1 off)",
         default=1,
         type=int,
     )
-    parser.add_argument(
-        "--min-length",
-        help="minimal allowed read-length left after trimming (default=18)",
-        type=int,
-        default=18,
-    )
-    parser.add_argument(
-        "--min-qual",
-        help="minimal quality score for quality trimming (default=20)",
-        type=int,
-        default=20,
-    )
     parser.add_argument(
         "--threads-read",
         help="number of threads for reading bam_in (default=1)",
@@ -89,42 +178,373 @@ def parse_cmdline():
         type=int,
         default=1,
     )
+    parser.add_argument(
+        "--shared-memory",
+        help=(
+            "pass chunks of reads to the workers via shared memory instead of "
+            "pipes (requires Python >= 3.8)"
+        ),
+        default=False,
+        action="store_true",
+    )
     parser.add_argument(
         "--n-chunk",
-        help="number of reads per chunk. Chunks are processes in parallel by workers (default=20000)",
+        help=(
+            "number of reads in the first chunk. Chunks are processed in parallel "
+            "by workers and later chunks adapt their size to the speed of the "
+            "workers, except with --checkpoint (default=20000)"
+        ),
         type=int,
         default=20000,
     )
+    parser.add_argument(
+        "--checkpoint",
+        default="",
+        help=(
+            "periodically commit the output to this directory, so that an "
+            "interrupted run can be continued with --resume. --bam-out is "
+            "assembled from there at the end and the directory is removed. "
+            "Chunks then have a fixed size (--n-chunk), so that the output does "
+            "not depend on interruptions"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=300,
+        type=float,
+        help="seconds between commits to the --checkpoint directory (default=300)",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help=(
+            "continue from the --checkpoint directory, if it was created with "
+            "the same input and parameters. Otherwise start from scratch"
+        ),
+    )
+    parser.add_argument(
+        "--monitor-file",
+        default="",
+        help=(
+            "write queue depths, throughput and idle time of reader, workers and "
+            "writer, and memory use of the parallel run to this file (JSON lines)"
+        ),
+    )
+    parser.add_argument(
+        "--monitor-interval",
+        default=5,
+        type=float,
+        help="seconds between samples for --monitor-file (default=5)",
+    )
+    parser.add_argument(
+        "--max-mb-in-flight",
+        help=(
+            "upper limit for the amount of input (in MB) that is on its way from "
+            "the reader to the output (default=128)"
+        ),
+        type=float,
+        default=128,
+    )
 
     parser.add_argument(
         "--stats-out",
         help="write tab-separated table with trimming results here",
         default="",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.shared_memory and not HAVE_SHARED_MEMORY:
+        parser.error("--shared-memory requires Python 3.8 or newer")
+
+    return args
 
 
 def load_adapters(right, left):
-    import cutadapt.adapters
+    """
+    reads the adapters to trim from the right (3') and left (5') end of the
+    reads from FASTA files (either may be empty). Returns a plain,
+    picklable spec of the adapters for make_adapters().
+    """
     from spacemake.util import fasta_chunks
 
-    adapters_right = []
-    if args.adapters_right:
-        for seq_id, seq in fasta_chunks(open(right)):
-            name = seq_id.split()[0]
-            adapters_right.append(
-                (name, seq, cutadapt.adapters.BackAdapter(seq, name=name))
+    spec = dict(right=[], left=[])
+    for end, fname in [("right", right), ("left", left)]:
+        if fname:
+            for seq_id, seq in fasta_chunks(open(fname)):
+                spec[end].append((seq_id.split()[0], seq))
+
+    return spec
+
+
+def make_adapters(spec):
+    """
+    builds the cutadapt adapters for trim_chunk() from a spec as returned by
+    load_adapters(), together with an AdapterSeeds index over all of them
+    """
+    import cutadapt.adapters
+
+    adapters_right = [
+        (name, seq, cutadapt.adapters.BackAdapter(seq, name=name))
+        for name, seq in spec["right"]
+    ]
+    adapters_left = [
+        (name, seq, cutadapt.adapters.NonInternalFrontAdapter(seq, name=name))
+        for name, seq in spec["left"]
+    ]
+    seeds = AdapterSeeds(
+        [(adap, SEED_WHERE["right"]) for name, seq, adap in adapters_right]
+        + [(adap, SEED_WHERE["left"]) for name, seq, adap in adapters_left]
+    )
+    return adapters_right, adapters_left, seeds
+
+
+# where cutadapt looks for the k-mers of BackAdapter and
+# NonInternalFrontAdapter (see their _kmer_finder() methods)
+SEED_WHERE = {
+    "right": dict(back_adapter=True, front_adapter=False),
+    "left": dict(back_adapter=False, front_adapter=True, internal=False),
+}
+
+# 2-bit codes of the bases. Anything else can not be part of a k-mer
+NT4 = np.full(256, 4, dtype=np.uint8)
+for i, c in enumerate("ACGT"):
+    NT4[ord(c)] = i
+
+# k-mers up to this length are looked up in a table with 4**k entries
+MAX_SEED_K = 10
+# k-mers which are searched in at most this many positions per read (close
+# to its ends) are only looked up there, others everywhere
+MAX_GATHER = 8
+# longer k-mers which are searched everywhere are only looked up where a
+# prefix of this length matches
+SCAN_K = 6
+
+
+def window_positions(offsets, ends, k, front, back):
+    """
+    start positions of the k-mers within the first <front> and the last
+    <back> bases of each read (ending at ends), given the offsets of the
+    reads in the chunk.
+    """
+    n = len(ends)
+    parts = []
+    for width, rel in [(front, 0), (back, ends - back)]:
+        if width < k:
+            continue
+
+        t = np.arange(width - k + 1)
+        off = np.broadcast_to(np.asarray(rel).reshape(-1, 1), (n, 1)) + t
+        valid = (off >= 0) & (off + k <= ends[:, None])
+        parts.append((offsets[:-1, None] + off)[valid])
+
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(parts)
+
+
+class AdapterSeeds:
+    """
+    Multi-pattern seed index over a list of cutadapt adapters.
+    Before aligning an adapter, cutadapt checks that at least one of a set
+    of k-mers occurs in the read, each within a window relative to the start
+    or end of the read (see cutadapt.kmer_heuristic). Otherwise match_to()
+    returns None. This index finds the occurrences of the k-mers of all
+    adapters in a whole chunk of reads at once, with one table lookup per
+    k-mer length, so that match_to() only needs to be called for candidates.
+
+    Adapters with wildcards, or with k-mers longer than MAX_SEED_K (which
+    does not happen with the default error rate), are not filtered and
+    always candidates.
+    """
+
+    def __init__(self, adapters):
+        """
+        adapters: list of (cutadapt adapter, dict(back_adapter=...,
+            front_adapter=..., internal=...)) as used by the adapter's
+            KmerFinder
+        """
+        from cutadapt.kmer_heuristic import create_positions_and_kmers
+
+        self.n_adapters = len(adapters)
+        self.unfiltered = []
+        # per k-mer: list of (adapter index, window start, window stop)
+        windows = defaultdict(list)
+        for j, (adap, where) in enumerate(adapters):
+            search = create_positions_and_kmers(
+                adap.sequence, adap.min_overlap, adap.max_error_rate, **where
+            )
+            kmers = [kmer for start, stop, kmer_list in search for kmer in kmer_list]
+            if (
+                adap.adapter_wildcards
+                or adap.read_wildcards
+                or not kmers
+                or max(map(len, kmers)) > MAX_SEED_K
+                or set("".join(kmers)) - set("ACGT")
+            ):
+                self.unfiltered.append(j)
+                continue
+
+            for start, stop, kmer_list in search:
+                for kmer in kmer_list:
+                    windows[kmer].append((j, start, stop))
+
+        # per k-mer length: a table from 2-bit code to k-mer index, the
+        # windows of each k-mer in CSR layout (first index and count), and
+        # how far from the start and end of a read the k-mers are searched
+        # if they are only looked up there (None if everywhere)
+        self.by_length = {}
+        for k in sorted(set(map(len, windows))):
+            kmers = [kmer for kmer in windows if len(kmer) == k]
+            table = np.full(4**k, -1, dtype=np.int32)
+            table[[self.kmer_code(kmer) for kmer in kmers]] = np.arange(len(kmers))
+
+            entries = [windows[kmer] for kmer in kmers]
+            flat = [w for ws in entries for w in ws]
+            counts = np.array([len(ws) for ws in entries], dtype=np.int64)
+            start = np.array([start for j, start, stop in flat], dtype=np.int64)
+            stop = np.array(
+                [np.iinfo(np.int64).max if stop is None else stop for j, start, stop in flat],
+                dtype=np.int64,
             )
+            reach = None
+            if ((start < 0) | ((stop >= 0) & (stop < np.iinfo(np.int64).max))).all():
+                reach = (stop[start >= 0].max(initial=0), -start[start < 0].min(initial=0))
+                if sum(reach) - 2 * (k - 1) > MAX_GATHER:
+                    reach = None
+
+            self.by_length[k] = (
+                table,
+                np.cumsum(counts) - counts,
+                counts,
+                np.array([j for j, start, stop in flat], dtype=np.int64),
+                start,
+                stop,
+                reach,
+            )
+
+        # k-mers searched everywhere are found from the 2-bit codes of all
+        # positions up to length scan_k. Longer ones are only looked up where
+        # one of their prefixes occurs
+        scanned = [k for k, v in self.by_length.items() if v[-1] is None]
+        self.scan_k = max([k for k in scanned if k <= SCAN_K], default=0)
+        self.prefixes = None
+        if max(scanned, default=0) > SCAN_K:
+            self.scan_k = SCAN_K
+            self.prefixes = np.zeros(4**SCAN_K, dtype=bool)
+            for kmer in windows:
+                if len(kmer) > SCAN_K and self.by_length[len(kmer)][-1] is None:
+                    self.prefixes[self.kmer_code(kmer[:SCAN_K])] = True
 
-    adapters_left = []
-    if args.adapters_left:
-        for seq_id, seq in fasta_chunks(open(left)):
-            name = seq_id.split()[0]
-            adapters_left.append(
-                (name, seq, cutadapt.adapters.NonInternalFrontAdapter(seq, name=name))
+    @staticmethod
+    def kmer_code(kmer):
+        code = 0
+        for c in kmer:
+            code = (code << 2) | int(NT4[ord(c)])
+
+        return code
+
+    def candidates(self, seqs, ends, block=2048):
+        """
+        Returns a boolean array of shape (n_adapters, len(seqs)). Where it
+        is False, the k-mers of adapter j do not occur in seqs[i][:ends[i]],
+        and match_to() would return None for that sequence.
+        Reads are processed in blocks, so that the work arrays stay in the
+        CPU cache.
+        """
+        n = len(seqs)
+        cand = np.zeros((self.n_adapters, n), dtype=bool)
+        cand[self.unfiltered] = True
+        if self.by_length:
+            for i in range(0, n, block):
+                self._candidates(seqs[i : i + block], ends[i : i + block], cand[:, i : i + block])
+
+        return cand
+
+    def _candidates(self, seqs, ends, cand):
+        n = len(seqs)
+        lens = str_lengths(seqs)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        nt = NT4[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+        # positions of characters other than ACGT. No k-mer may contain one
+        invalid = np.flatnonzero(nt > 3)
+        nt &= 3
+        ends = np.asarray(ends, dtype=np.int64)
+        read_ids = np.repeat(np.arange(n), lens)
+
+        def codes_at(pos, k):
+            code = np.zeros(len(pos), dtype=np.int64)
+            for i in range(k):
+                code <<= 2
+                code |= nt[pos + i]
+
+            return code
+
+        # (k, positions, k-mer index) of all k-mers found
+        found = []
+
+        def lookup(k, pos, code):
+            kid = self.by_length[k][0].take(code)
+            hits = np.flatnonzero(kid >= 0)
+            found.append((k, pos[hits] if pos is not None else hits, kid[hits]))
+
+        # rolling 2-bit codes of the k-mers at all positions, extended in
+        # place one base at a time. code[p] is the k-mer starting at p
+        code = np.zeros(len(nt), dtype=np.int64)
+        for k in range(1, min(self.scan_k, len(nt)) + 1):
+            code_k = code[: len(nt) - k + 1]
+            np.left_shift(code_k, 2, out=code_k)
+            np.bitwise_or(code_k, nt[k - 1 :], out=code_k)
+            if k in self.by_length and self.by_length[k][-1] is None:
+                lookup(k, None, code_k)
+
+        if self.prefixes is not None and len(nt) >= SCAN_K:
+            pre = np.flatnonzero(self.prefixes.take(code_k))
+            for k, (table, first, counts, adapter, start, stop, reach) in self.by_length.items():
+                if k > SCAN_K and reach is None:
+                    pos = pre[pre + k <= len(nt)]
+                    lookup(k, pos, codes_at(pos, k))
+
+        for k, (table, first, counts, adapter, start, stop, reach) in self.by_length.items():
+            if reach is not None:
+                # k-mers that are only searched close to the ends: look only
+                # there instead of everywhere
+                pos = window_positions(offsets, ends, k, *reach)
+                lookup(k, pos, codes_at(pos, k))
+
+        for k, hits, kid in found:
+            table, first, counts, adapter, start, stop, reach = self.by_length[k]
+            if len(invalid):
+                # the next invalid character must not be within the k-mer
+                nxt = np.searchsorted(invalid, hits)
+                valid = invalid[np.minimum(nxt, len(invalid) - 1)] >= hits + k
+                valid |= nxt == len(invalid)
+                hits = hits[valid]
+                kid = kid[valid]
+
+            if not len(hits):
+                continue
+
+            # all windows in which each hit k-mer is searched
+            n_win = counts[kid]
+            hit = np.repeat(np.arange(len(hits)), n_win)
+            win = first[kid][hit] + np.arange(len(hit)) - np.repeat(
+                np.cumsum(n_win) - n_win, n_win
             )
 
-    return adapters_right, adapters_left
+            # is the k-mer inside the window (python slice semantics) of
+            # its read?
+            hits = hits[hit]
+            rid = read_ids[hits]
+            off = hits - offsets[rid]
+            end = ends[rid]
+            lo = start[win]
+            lo = np.where(lo < 0, np.maximum(end + lo, 0), np.minimum(lo, end))
+            hi = stop[win]
+            hi = np.where(hi < 0, np.maximum(end + hi, 0), np.minimum(hi, end))
+            inside = (off >= lo) & (off + k <= hi)
+            cand[adapter[win[inside]], rid[inside]] = True
 
 
 def make_header(bam):
@@ -157,7 +577,7 @@ class SimpleRead:
         self.query_name = name
         self.query_sequence = seq
         self.query_qualities = qual
-        self.tags = {}
+        self.tags = tags
 
     @classmethod
     def from_BAM(cls, read):
@@ -176,6 +596,32 @@ class SimpleRead:
         for read in bam_src:
             yield SimpleRead.from_BAM(read)
 
+    @staticmethod
+    def iter_packed_BAM(bam_src):
+        """
+        yields (name, sequence, quality string, tags) tuples suitable for
+        chunkify(packed=True). The tags are in the text form of
+        bam.tags_to_text().
+        """
+        for read in bam_src:
+            yield (
+                read.query_name,
+                read.query_sequence,
+                pysam.array_to_qualitystring(read.query_qualities),
+                tags_to_text(read.get_tags(with_value_type=True)),
+            )
+
+    @staticmethod
+    def iter_unpack(chunk):
+        for name, seq, qual, tags in chunk:
+            tags = [field.split(":", 2) for field in tags.split("\t") if field]
+            yield SimpleRead(
+                name,
+                seq,
+                pysam.qualitystring_to_array(qual),
+                {tag: value for tag, vtype, value in tags},
+            )
+
     @staticmethod
     def iter_to_BAM(sr_src, header=None):
         for read in sr_src:
@@ -189,96 +635,407 @@ class SimpleRead:
             yield aln
 
 
-def process_reads(read_source, args, stats={}, total={}, lhist={}):
-    adapters_right, adapters_left = load_adapters(
-        args.adapters_right, args.adapters_left
-    )
-    for read in read_source:
-        read_seq = read.query_sequence
-        read_qual = read.query_qualities
-        # print(read_qual)
-        start = 0
-        end = len(read_seq)
-
-        stats["N_input"] += 1
-        total["bp_input"] += end
-        trimmed_names_right = []
-        trimmed_bases_right = []
-
-        trimmed_names_left = []
-        trimmed_bases_left = []
-
-        # quality trimming
-        qtrim = np.array(read_qual) < args.min_qual
-        # print(qtrim)
-        # print(
-        #     f"qtrim.argmax()={qtrim.argmax()} qtrim[::-1].argmax()={qtrim[::-1].argmax()}"
-        # )
-        if qtrim.sum():
-            # the first position where q < min_q (from the 3' end) should be the new end.
-            new_end = end - (qtrim[::-1].argmax() + 1)
-            n_trimmed = end - new_end
-            end = new_end
-            trimmed_bases_right.append(n_trimmed)
-            trimmed_names_right.append("Q")
-
-            stats["N_Qtrimmed"] += 1
-            total["bp_Qtrimmed"] += n_trimmed
-            total["bp_trimmed"] += n_trimmed
-
-        # right end adapter trimming
-        if (end - start) >= args.min_length:
-            for adap_name, adap_seq, adap in adapters_right:
-                match = adap.match_to(read_seq[start:end])
-                if match:
-                    new_end = min(end, match.rstart)
-                    n_trimmed = end - new_end
-                    end = new_end
-                    trimmed_bases_right.append(n_trimmed)
-                    trimmed_names_right.append(adap_name)
-
-                    stats["N_" + adap_name] += 1
-                    total["bp_" + adap_name] += n_trimmed
-                    total["bp_trimmed"] += n_trimmed
-
-        # left end adapter trimming
-        if (end - start) >= args.min_length:
-            for adap_name, adap_seq, adap in adapters_left:
-                match = adap.match_to(read_seq[start:end])
-                if match:
-                    # print(adap_name, adap, match)
-                    new_start = max(start, match.rstop)
-                    n_trimmed = new_start - start
-                    start = new_start
-                    trimmed_bases_left.append(n_trimmed)
-                    trimmed_names_left.append(adap_name)
-
-                    stats["N_" + adap_name] += 1
-                    total["bp_" + adap_name] += n_trimmed
-                    total["bp_trimmed"] += n_trimmed
-
-        # enough left?
-        if (end - start) >= args.min_length:
-            stats["N_kept"] += 1
-            total["bp_kept"] += end
-            lhist[end] += 1
-            # print(f"keeping read up to {end}")
-            read.query_sequence = read_seq[start:end]
-            read.query_qualities = read_qual[start:end]
-            if trimmed_names_right:
-                read.set_tag("A3", ",".join(trimmed_names_right))
-                read.set_tag("T3", ",".join([str(s) for s in trimmed_bases_right]))
+# tags set by trim_chunk() for adapter trimming, in the order in which they
+# are set (see also trim_tags())
+TRIM_TAGS = ["A3", "T3", "A5", "T5"]
 
-            if trimmed_names_left:
-                read.set_tag("A5", ",".join(trimmed_names_left))
-                read.set_tag("T5", ",".join([str(s) for s in trimmed_bases_left]))
 
-            yield read
-            # bam_out.write(read)
-            # print(read)
-        else:
-            stats["N_discarded"] += 1
-            total["bp_discarded"] += end
+def drop_tags(text, tags):
+    "removes the given tags from tags in the text form of bam.tags_to_text()"
+    return "\t".join([field for field in text.split("\t") if field[:2] not in tags])
+
+
+def quality_trim_ends(quals, lens, min_qual):
+    """
+    For a chunk of quality strings (phred+33) with lengths lens, returns the
+    position of the last base with a quality below min_qual in each read, or
+    the read length if there is none. Bases from there on are trimmed.
+    """
+    offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    q = np.frombuffer("".join(quals).encode("ascii"), dtype=np.uint8)
+    low = np.flatnonzero(q < min_qual + 33)
+
+    ends = np.array(lens, dtype=np.int64)
+    if len(low):
+        # which read each low quality base belongs to. Keep only the last one
+        # per read
+        rid = np.searchsorted(offsets, low, side="right") - 1
+        last = np.ones(len(low), dtype=bool)
+        last[:-1] = rid[1:] != rid[:-1]
+        rid = rid[last]
+        ends[rid] = low[last] - offsets[rid]
+
+    return ends
+
+
+def start_trim_lengths(seqs, starts, ends, sequence, min_bases, mismatches):
+    """
+    Trimming of a starting sequence, like Drop-seq's TrimStartingSequence:
+    for each read seqs[i][starts[i]:ends[i]], the length of the longest
+    suffix of sequence (at least min_bases long) with which the read
+    begins, allowing for the given number of mismatches. 0 if there is none.
+    """
+    n = len(seqs)
+    L = len(sequence)
+    trim = np.zeros(n, dtype=np.int64)
+    if not n or L < min_bases:
+        return trim
+
+    todo = np.flatnonzero(ends - starts >= min_bases)
+    if not mismatches:
+        # the read has to begin with min_bases bases found in sequence
+        seeds = {sequence[i : i + min_bases] for i in range(L - min_bases + 1)}
+        todo = np.array(
+            [
+                i
+                for i, start in zip(todo.tolist(), starts[todo].tolist())
+                if seqs[i][start : start + min_bases] in seeds
+            ],
+            dtype=np.int64,
+        )
+
+    if not len(todo):
+        return trim
+
+    # the first L bases of each read, padded with 0
+    avail = np.minimum(ends[todo] - starts[todo], L)
+    first = np.frombuffer(
+        "".join(
+            [
+                seqs[i][start : start + l].ljust(L, "\0")
+                for i, start, l in zip(
+                    todo.tolist(), starts[todo].tolist(), avail.tolist()
+                )
+            ]
+        ).encode("ascii"),
+        dtype=np.uint8,
+    ).reshape(len(todo), L)
+    seq = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+    found = np.zeros(len(todo), dtype=np.int64)
+    for l in range(L, min_bases - 1, -1):
+        check = (found == 0) & (avail >= l)
+        if not check.any():
+            continue
+
+        mism = (first[:, :l] != seq[L - l :]).sum(axis=1)
+        found[check & (mism <= mismatches)] = l
+
+    trim[todo] = found
+    return trim
+
+
+def polyA_trim_lengths(seqs, starts, ends, min_bases, mismatches):
+    """
+    PolyA trimming, like Drop-seq's PolyATrimmer: for each read
+    seqs[i][starts[i]:ends[i]], the length of the longest run of A's at its
+    end which contains at most the given number of other bases and starts
+    with an A. 0 if it is shorter than min_bases.
+    """
+    n = len(seqs)
+    trim = np.zeros(n, dtype=np.int64)
+    lens = ends - starts
+    todo = np.flatnonzero(lens >= max(min_bases, 1))
+    reads = list(zip(todo.tolist(), starts[todo].tolist(), ends[todo].tolist()))
+    if not mismatches:
+        # simply the A's at the end
+        for i, start, end in reads:
+            seq = seqs[i]
+            if seq[end - 1] == "A":
+                run = end - start - len(seq[start:end].rstrip("A"))
+                if run >= min_bases:
+                    trim[i] = run
+
+        return trim
+
+    if not len(todo):
+        return trim
+
+    # the reads, reversed and padded with 0
+    W = lens[todo].max()
+    rev = np.frombuffer(
+        "".join(
+            [seqs[i][start:end][::-1].ljust(W, "\0") for i, start, end in reads]
+        ).encode("ascii"),
+        dtype=np.uint8,
+    ).reshape(len(todo), W)
+    is_A = rev == ord("A")
+    # bases that are in reach without exceeding the mismatches
+    reach = np.cumsum(~is_A, axis=1) <= mismatches
+    reach &= np.arange(W) < lens[todo, None]
+    # the run ends with the last A in reach (counted from the end of the read)
+    in_run = is_A & reach
+    run = W - np.argmax(in_run[:, ::-1], axis=1)
+    run[~in_run.any(axis=1)] = 0
+    trim[todo] = np.where(run >= min_bases, run, 0)
+    return trim
+
+
+class TrimCounts:
+    """
+    Collects the counts of one chunk for the stats and total dicts of
+    trim_chunk(). Keys which are new to those dicts are added in the order in
+    which they first occur in the chunk, as if the reads had been counted one
+    by one. The stats output sorts by count and keeps that order for ties.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.first = {}
+
+    def add(self, which, key, value, first):
+        """
+        which: 'stats' or 'total'
+        first: (read index, step) of the first read counted
+        """
+        k = (which, key)
+        self.counts[k] += value
+        self.first[k] = min(self.first.get(k, first), first)
+
+    def update(self, stats, total):
+        dicts = dict(stats=stats, total=total)
+        for k in sorted(self.counts, key=self.first.get):
+            which, key = k
+            dicts[which][key] += int(self.counts[k])
+
+
+def trim_tags(args):
+    "the tags set by trim_chunk() for the given args, in the order they are set"
+    tags = []
+    if args.start_sequence:
+        tags.append(args.start_tag)
+
+    if args.polyA_min_bases:
+        tags.append(args.polyA_tag)
+
+    return tags + TRIM_TAGS
+
+
+def trim_chunk(
+    seqs, quals, adapters, args, stats={}, total={}, lhist={}, trim_hists={}
+):
+    """
+    Trims a chunk of reads, given as lists of sequences and quality strings
+    (phred+33). A starting sequence and polyA tails are trimmed first (if
+    requested in args, see start_trim_lengths() and polyA_trim_lengths()),
+    then low quality bases and adapters. Quality trimming and all bookkeeping
+    are done for the whole chunk at once. The adapters (see make_adapters())
+    are only matched against reads that are still long enough after quality
+    trimming, and for which their seeds (see AdapterSeeds) hit.
+
+    Returns the indices of the reads that are kept, their new start and end
+    and a list of (tag, values) with the trim_tags() for the kept reads (None
+    where a read was not trimmed). Counts are added to stats, total and lhist
+    exactly as if the reads had been trimmed one at a time, and the numbers
+    of bases trimmed from the start and as polyA to trim_hists["start"] and
+    trim_hists["polyA"].
+    """
+    adapters_right, adapters_left, seeds = adapters
+    n = len(seqs)
+    tags = {tag: [None] * n for tag in trim_tags(args)}
+    if not n:
+        return np.zeros(0, dtype=np.int64), [], [], [(tag, []) for tag in tags]
+
+    lens = str_lengths(seqs)
+    starts = np.zeros(n, dtype=np.int64)
+    ends = lens.copy()
+    # steps at which a read is counted, for TrimCounts
+    step_left = 4 + len(adapters_right)
+    step_final = step_left + len(adapters_left)
+
+    counts = TrimCounts()
+    counts.add("stats", "N_input", n, (0, 0))
+    counts.add("total", "bp_input", lens.sum(), (0, 0))
+
+    def count_trimmed(name, trim, step):
+        trimmed = np.flatnonzero(trim)
+        if len(trimmed):
+            n_trimmed = trim[trimmed].sum()
+            first = (trimmed[0], step)
+            counts.add("stats", "N_" + name, len(trimmed), first)
+            counts.add("total", "bp_" + name, n_trimmed, first)
+            counts.add("total", "bp_trimmed", n_trimmed, first)
+
+        return trimmed.tolist()
+
+    # like Drop-seq's TrimStartingSequence and PolyATrimmer. The tags hold
+    # the first base that is kept and the start of the polyA tail after
+    # trimming the start
+    if args.start_sequence:
+        trim = start_trim_lengths(
+            seqs,
+            starts,
+            ends,
+            args.start_sequence,
+            args.start_min_bases,
+            args.start_mismatches,
+        )
+        starts += trim
+        for i in count_trimmed("start_trimmed", trim, 1):
+            tags[args.start_tag][i] = int(starts[i])
+
+        for l, count in zip(*np.unique(trim, return_counts=True)):
+            trim_hists["start"][int(l)] += int(count)
+
+    if args.polyA_min_bases:
+        trim = polyA_trim_lengths(
+            seqs, starts, ends, args.polyA_min_bases, args.polyA_mismatches
+        )
+        ends -= trim
+        for i in count_trimmed("polyA_trimmed", trim, 2):
+            tags[args.polyA_tag][i] = int(ends[i] - starts[i])
+
+        for l, count in zip(*np.unique(trim, return_counts=True)):
+            trim_hists["polyA"][int(l)] += int(count)
+
+    qtrim = np.maximum(ends - quality_trim_ends(quals, lens, args.min_qual), 0)
+    ends -= qtrim
+    count_trimmed("Qtrimmed", qtrim, 3)
+
+    # names of the trimmed adapters and number of trimmed bases, for each
+    # read that was trimmed
+    trimmed_right = defaultdict(list)
+    trimmed_left = defaultdict(list)
+    long_enough = (ends - starts) >= args.min_length
+    for i in np.flatnonzero(long_enough & (qtrim > 0)).tolist():
+        trimmed_right[i].append(("Q", int(qtrim[i])))
+
+    def candidates(idx):
+        "seeds of the reads idx, as far as they are not trimmed yet"
+        return seeds.candidates(
+            [seqs[i][start:] for i, start in zip(idx, starts[idx].tolist())],
+            ends[idx] - starts[idx],
+        )
+
+    # The adapters are matched one after the other, each only to the reads
+    # where its seeds hit (see AdapterSeeds). Reads that an adapter trims
+    # are looked up again, as the seeds of the following adapters may no
+    # longer hit.
+    if starts.any():
+        cand = candidates(list(range(n)))
+    else:
+        cand = seeds.candidates(seqs, ends)
+
+    # right end adapter trimming
+    for j, (adap_name, adap_seq, adap) in enumerate(adapters_right):
+        changed = []
+        for i in np.flatnonzero(long_enough & cand[j]).tolist():
+            start = int(starts[i])
+            end = int(ends[i])
+            match = adap.match_to(seqs[i][start:end])
+            if match:
+                new_end = start + min(end - start, match.rstart)
+                n_trimmed = end - new_end
+                ends[i] = new_end
+                trimmed_right[i].append((adap_name, n_trimmed))
+                changed.append(i)
+
+                counts.add("stats", "N_" + adap_name, 1, (i, 4 + j))
+                counts.add("total", "bp_" + adap_name, n_trimmed, (i, 4 + j))
+                counts.add("total", "bp_trimmed", n_trimmed, (i, 4 + j))
+
+        if changed:
+            cand[:, changed] = candidates(changed)
+
+    # left end adapter trimming
+    long_enough = (ends - starts) >= args.min_length
+    for j, (adap_name, adap_seq, adap) in enumerate(adapters_left):
+        changed = []
+        for i in np.flatnonzero(long_enough & cand[len(adapters_right) + j]).tolist():
+            start = int(starts[i])
+            match = adap.match_to(seqs[i][start : ends[i]])
+            if match:
+                new_start = start + match.rstop
+                n_trimmed = new_start - start
+                starts[i] = new_start
+                trimmed_left[i].append((adap_name, n_trimmed))
+                changed.append(i)
+
+                step = (i, step_left + j)
+                counts.add("stats", "N_" + adap_name, 1, step)
+                counts.add("total", "bp_" + adap_name, n_trimmed, step)
+                counts.add("total", "bp_trimmed", n_trimmed, step)
+
+        if changed:
+            cand[:, changed] = candidates(changed)
+
+    for (name_tag, bases_tag), trimmed in [
+        (("A3", "T3"), trimmed_right),
+        (("A5", "T5"), trimmed_left),
+    ]:
+        for i, names_bases in trimmed.items():
+            tags[name_tag][i] = ",".join([name for name, b in names_bases])
+            tags[bases_tag][i] = ",".join([str(b) for name, b in names_bases])
+
+    # enough left?
+    kept = (ends - starts) >= args.min_length
+    keep = np.flatnonzero(kept)
+    if len(keep):
+        counts.add("stats", "N_kept", len(keep), (keep[0], step_final))
+        counts.add("total", "bp_kept", ends[keep].sum(), (keep[0], step_final))
+        for end, count in zip(*np.unique(ends[keep], return_counts=True)):
+            lhist[int(end)] += int(count)
+
+    discard = np.flatnonzero(~kept)
+    if len(discard):
+        counts.add("stats", "N_discarded", len(discard), (discard[0], step_final))
+        counts.add(
+            "total", "bp_discarded", ends[discard].sum(), (discard[0], step_final)
+        )
+
+    counts.update(stats, total)
+    keep_list = keep.tolist()
+    return (
+        keep,
+        starts[keep].tolist(),
+        ends[keep].tolist(),
+        [(tag, [values[i] for i in keep_list]) for tag, values in tags.items()],
+    )
+
+
+def write_trim_report(fname, name, stats, total, hist):
+    """
+    summary of start or polyA trimming (name is 'start' or 'polyA'), laid
+    out like the OUTPUT_SUMMARY of the Drop-seq tools: the number of reads,
+    of trimmed reads and bases, and a histogram of the number of bases
+    trimmed per read.
+    """
+    import os
+    import sys
+
+    with open(fname, "wt") as f:
+        f.write(f"## {os.path.basename(__file__)} {' '.join(sys.argv[1:])}\n\n")
+        f.write(f"## METRICS CLASS\t{name}_trimming\n")
+        f.write("NUM_READS\tNUM_READS_TRIMMED\tNUM_BASES_TRIMMED\n")
+        f.write(
+            f"{stats['N_input']}\t{stats[f'N_{name}_trimmed']}\t"
+            f"{total[f'bp_{name}_trimmed']}\n\n"
+        )
+        f.write("## HISTOGRAM\tjava.lang.Integer\nBIN\tVALUE\n")
+        for k, v in sorted(hist.items()):
+            f.write(f"{k}\t{v}\n")
+
+
+def write_reports(stats_out, args, stats, total, lhist, trim_hists):
+    """
+    writes the table of trimming results to stats_out (if given) and the
+    --start-report and --polyA-report
+    """
+    if stats_out:
+        with open(stats_out, "wt") as f:
+            f.write("key\tcount\tpercent\n")
+            for k, v in sorted(stats.items(), key=lambda x: -x[1]):
+                f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
+
+            for k, v in sorted(total.items(), key=lambda x: -x[1]):
+                f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
+
+            for k, v in sorted(lhist.items()):
+                f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
+
+    for name, fname in [("start", args.start_report), ("polyA", args.polyA_report)]:
+        if fname:
+            write_trim_report(fname, name, stats, total, trim_hists[name])
 
 
 def skim_reads(read_source, skim):
@@ -316,320 +1073,242 @@ def main_single(args):
     stats = defaultdict(int)
     total = defaultdict(int)
     lhist = defaultdict(int)
+    trim_hists = dict(start=defaultdict(int), polyA=defaultdict(int))
 
+    adapters = make_adapters(load_adapters(args.adapters_right, args.adapters_left))
     t0 = time()
-    for read in process_reads(
-        skim_reads(bam_in.fetch(until_eof=True), args.skim),
-        args,
-        stats=stats,
-        total=total,
-        lhist=lhist,
+    for n_chunk, reads in chunkify(
+        skim_reads(bam_in.fetch(until_eof=True), args.skim), n_chunk=args.n_chunk
     ):
-        bam_out.write(read)
+        keep, starts, ends, tags = trim_chunk(
+            [read.query_sequence for read in reads],
+            [pysam.array_to_qualitystring(read.query_qualities) for read in reads],
+            adapters,
+            args,
+            stats=stats,
+            total=total,
+            lhist=lhist,
+            trim_hists=trim_hists,
+        )
+        for k, (i, start, end) in enumerate(zip(keep.tolist(), starts, ends)):
+            read = reads[i]
+            read_seq = read.query_sequence
+            read_qual = read.query_qualities
+            read.query_sequence = read_seq[start:end]
+            read.query_qualities = read_qual[start:end]
+            for tag, values in tags:
+                if values[k] is not None:
+                    read.set_tag(tag, values[k])
+
+            bam_out.write(read)
 
     dt = time() - t0
     logger.info(
         f"processed {stats['N_input']} reads in {dt:.1f} seconds ({stats['N_input']/dt:.1f} reads/second)."
     )
+    write_reports(args.stats_out, args, stats, total, lhist, trim_hists)
 
-    if args.stats_out:
-        with open(args.stats_out, "wt") as f:
-            f.write("key\tcount\tpercent\n")
-            for k, v in sorted(stats.items(), key=lambda x: -x[1]):
-                f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
 
-            for k, v in sorted(total.items(), key=lambda x: -x[1]):
-                f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
+## Parallel implementation
+def bgzf_level(mode):
+    "compression level for a BAM output mode ('b', 'bu' or 'b0' to 'b9')"
+    m = re.fullmatch(r"b([0-9u]?)", mode)
+    if not m:
+        raise ValueError(f"parallel trimming only writes BAM, not mode '{mode}'")
 
-            for k, v in sorted(lhist.items()):
-                f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
+    level = m.group(1)
+    if not level:
+        return 6
 
+    if level == "u":
+        return 0
 
-## Parallel implementation
-def parallel_read(Qsam, args, Qerr, abort_flag, stat_list):
+    return int(level)
+
+
+def read_chunks(args, chunk_size=None, skip=0):
     """
-    reads from BAM file, converts to string, groups the records into chunks for
-    faster parallel processing, and puts these on a mp.Queue()
+    reads from BAM file, converts to string, and groups the records into
+    chunks for faster parallel processing. The first chunk holds --n-chunk
+    reads, later ones follow chunk_size() (see parallel.Pipeline). The first
+    skip reads are discarded (to resume from a checkpoint).
     """
-    with ExceptionLogging("read_BAM", Qerr=Qerr, exc_flag=abort_flag) as el:
-        bam_header = stat_list[-1]
-        bam_in = pysam.AlignmentFile(
-            args.bam_in, "rb", check_sq=False, threads=args.threads_read
+    bam_in = pysam.AlignmentFile(
+        args.bam_in, "rb", check_sq=False, threads=args.threads_read
+    )
+    # read_source = BAM_to_string(skim_reads(bam_in.fetch(until_eof=True), args.skim))
+    if args.skim:
+        read_source = SimpleRead.iter_packed_BAM(
+            skim_reads(bam_in.fetch(until_eof=True), args.skim)
         )
-        bam_header.append(make_header(bam_in))
-
-        # read_source = BAM_to_string(skim_reads(bam_in.fetch(until_eof=True), args.skim))
-        if args.skim:
-            read_source = SimpleRead.iter_BAM(
-                skim_reads(bam_in.fetch(until_eof=True), args.skim)
-            )
-        else:
-            read_source = SimpleRead.iter_BAM(bam_in.fetch(until_eof=True))
+    else:
+        read_source = SimpleRead.iter_packed_BAM(bam_in.fetch(until_eof=True))
+
+    for n_chunk, chunk in chunkify(
+        islice(read_source, skip, None),
+        n_chunk=args.n_chunk,
+        packed=True,
+        shared=args.shared_memory,
+        chunk_size=chunk_size,
+    ):
+        logging.debug(f"dispatching chunk {n_chunk} ({len(chunk.buf)} bytes)")
+        yield chunk
 
-        for chunk in chunkify(read_source, n_chunk=args.n_chunk):
-            logging.debug(
-                f"placing {chunk[0]} {len(chunk[1])} in queue of depth {Qsam.qsize()}"
-            )
-            if put_or_abort(Qsam, chunk, abort_flag):
-                el.logger.warning("shutdown flag was raised!")
-                break
 
+class Trimmer:
+    """
+    Trims chunks of reads with trim_chunk() and collects the counts. The
+    adapters are built once, from a spec as returned by load_adapters().
+    Also used by preprocess, to trim reads right after barcode extraction.
+    """
 
-def parallel_trim(Qsam, Qres, args, Qerr, abort_flag, stat_list):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"parallel_trim() starting up with Qsam={Qsam}, Qres={Qres} and args={args}"
+    def __init__(self, args, adapters):
+        self.args = args
+        self.adapters = make_adapters(adapters)
+        self.reset()
+
+    def reset(self):
+        self.stats_ = defaultdict(int)
+        self.total = defaultdict(int)
+        self.lhist = defaultdict(int)
+        self.trim_hists = dict(start=defaultdict(int), polyA=defaultdict(int))
+
+    def trim(self, seqs, quals):
+        "trim_chunk() with our adapters and counts"
+        return trim_chunk(
+            seqs,
+            quals,
+            self.adapters,
+            self.args,
+            stats=self.stats_,
+            total=self.total,
+            lhist=self.lhist,
+            trim_hists=self.trim_hists,
         )
 
-        _stats = defaultdict(int)
-        _total = defaultdict(int)
-        _lhist = defaultdict(int)
-
-        for n_chunk, reads in queue_iter(Qsam, abort_flag):
-            result = list(
-                process_reads(
-                    reads,
-                    args,
-                    stats=_stats,
-                    total=_total,
-                    lhist=_lhist,
-                )
-            )
-            Qres.put((n_chunk, result))
-
-        el.logger.debug("synchronizing cache and counts")
-        stats, total, lhist = stat_list[:3]
-        stats.append(_stats)
-        total.append(_total)
-        lhist.append(_lhist)
-
-
-def process_ordered_results(res_queue, args, Qerr, abort_flag, stat_list, timeout=10):
-    with ExceptionLogging("collector", Qerr=Qerr, exc_flag=abort_flag) as el:
-        import heapq
-        import time
-
-        heap = []
-        n_chunk_needed = 0
-        t0 = time.time()
-        t1 = t0
-        n_rec = 0
-
-        logger = el.logger
-        # out = Output(args)
-        bam_header = stat_list[-1]
-        while (not len(bam_header)) and timeout > 0:
-            if abort_flag:
-                logger.info("aborting during startup...")
-                return
-
-            logger.info("waiting for header to get ready")
-            time.sleep(1)
-            timeout -= 1
-
-        if timeout < 0:
-            raise ValueError("header was not made available. Did the dispatcher die?")
-
-        header = bam_header.pop()
-        bam_out = pysam.AlignmentFile(
-            args.bam_out,
-            f"w{args.bam_out_mode}",
-            header=header,
-            threads=args.threads_write,
+    def stats(self):
+        "counts since the last call (see parallel.merge_stats)"
+        stats = dict(
+            stats=self.stats_,
+            total=self.total,
+            lhist=self.lhist,
+            trim_hists=self.trim_hists,
         )
+        self.reset()
+        return stats
 
-        for n_chunk, results in queue_iter(res_queue, abort_flag):
-            heapq.heappush(heap, (n_chunk, results))
-
-            # as long as the root of the heap is the next needed chunk
-            # pass results on to storage
-            while heap and (heap[0][0] == n_chunk_needed):
-                n_chunk, results = heapq.heappop(heap)  # retrieves heap[0]
-                for aln in SimpleRead.iter_to_BAM(results, header=bam_out.header):
-                    #     # print("record in process_ordered_results", record)
-                    bam_out.write(aln)
-                    n_rec += 1
-
-                n_chunk_needed += 1
-
-            # debug output on average throughput
-            t2 = time.time()
-            if t2 - t1 > 30:
-                dT = t2 - t0
-                rate = n_rec / dT
-                logger.info(
-                    "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
-                        n_rec, dT, rate
-                    )
-                )
-                t1 = t2
 
-        # out.close()
-        # by the time None pops from the queue, all chunks
-        # should have been processed!
-        if not abort_flag.value:
-            assert len(heap) == 0
-        else:
-            logger.warning(
-                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
-            )
+class TrimWorker(Trimmer):
+    """
+    Trims the reads of a chunk and encodes the remaining ones as
+    compressed BAM, with their original tags. Used as worker of a
+    parallel.Pipeline.
+    """
 
-        dT = time.time() - t0
-        logger.info(
-            "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
-                n_rec, dT, n_rec / dT
-            )
+    def __init__(self, args, adapters):
+        super().__init__(args, adapters)
+        self.level = bgzf_level(args.bam_out_mode)
+        self.pool = compression_pool(args.threads_write)
+        self.tags_re = re.compile(
+            r"(?:^|\t)(?:%s):" % "|".join(trim_tags(args)), re.MULTILINE
         )
 
-
-## TODO: push these two into parallel/util modules
-
-
-def count_dict_sum(sources):
-    dst = defaultdict(float)
-    for src in sources:
-        for k, v in src.items():
-            dst[k] += v
-
-    return dst
+    def __call__(self, chunk):
+        """
+        returns the number of input reads and the BGZF compressed
+        records of the trimmed reads
+        """
+        names, seqs, quals, aux = chunk.columns()
+        keep, starts, ends, tags = self.trim(seqs, quals)
+        keep = keep.tolist()
+        aux = [aux[i] for i in keep]
+        if self.tags_re.search("\n".join(aux)):
+            # reads that were trimmed before. Like pysam's set_tag(), replace
+            # the old values with the new ones, at the end
+            for k, text in enumerate(aux):
+                new = [tag for tag, values in tags if values[k] is not None]
+                if new:
+                    aux[k] = drop_tags(text, new)
+
+        records, offsets = encode_unmapped(
+            [names[i] for i in keep],
+            [seqs[i][start:end] for i, start, end in zip(keep, starts, ends)],
+            [quals[i][start:end] for i, start, end in zip(keep, starts, ends)],
+            tags,
+            aux=aux,
+        )
+        return len(chunk), bgzf_compress(records, level=self.level, pool=self.pool)
 
 
 def main_parallel(args):
     logging.basicConfig(level=logging.DEBUG)
 
-    # queues for communication between processes
-    Qsam = mp.Queue(args.threads_work * 10)  # reads from parallel_read->parallel_trim
-    Qres = mp.Queue()  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-
-    stats = manager.list()
-    total = manager.list()
-    lhist = manager.list()
-    bam_header = manager.list()
-    stat_lists = [stats, total, lhist, bam_header]
-    print(stat_lists[-1])
-    with ExceptionLogging("main_combinatorial", exc_flag=abort_flag) as el:
-
-        # read BAM in chunks and put them in Qsam
-        dispatcher = mp.Process(
-            target=parallel_read,
-            name="dispatcher",
-            args=(Qsam, args, Qerr, abort_flag, stat_lists),
-        )
-
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of BAM from Qsam
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.threads_work):
-            w = mp.Process(
-                target=parallel_trim,
-                name=f"worker_{i}",
-                args=(Qsam, Qres, args, Qerr, abort_flag, stat_lists),
+    with ExceptionLogging("main_parallel") as el:
+        bam_in = pysam.AlignmentFile(args.bam_in, "rb", check_sq=False)
+        header = make_header(bam_in)
+        bam_in.close()
+
+        level = bgzf_level(args.bam_out_mode)
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = Checkpoint(
+                args.checkpoint,
+                ["bam_out"],
+                Checkpoint.make_signature(
+                    args,
+                    inputs=[args.bam_in, args.adapters_right, args.adapters_left],
+                    ignore=CHECKPOINT_IGNORE,
+                ),
+                heads={"bam_out": bgzf_compress(header_bytes(header), level=level)},
+                resume=args.resume,
+                interval=args.checkpoint_interval,
             )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag, stat_lists),
-        )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qsam, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.threads_work):
-            Qsam.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
-        )
-        # signal the collector to stop
-        Qres.put(None)
-
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
-
-    if args.stats_out:
-        stats = count_dict_sum(stats)
-        total = count_dict_sum(total)
-        lhist = count_dict_sum(lhist)
-
-        with open(args.stats_out, "wt") as f:
-            f.write("key\tcount\tpercent\n")
-            for k, v in sorted(stats.items(), key=lambda x: -x[1]):
-                f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
-
-            for k, v in sorted(total.items(), key=lambda x: -x[1]):
-                f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
-
-            for k, v in sorted(lhist.items()):
-                f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
-
-        # N = count_dict_sum(Ns)
-        # if N["total"]:
-        #     el.logger.info(
-        #         f"Run completed. Overall combinatorial barcode assignment "
-        #         f"rate was {100.0 * N['called']/N['total']}"
-        #     )
-        # else:
-        #     el.logger.error("No reads were processed!")
-
-        # if args.update_cache:
-        #     qcount1 = count_dict_sum(qcounts1)
-        #     qcount2 = count_dict_sum(qcounts2)
-        #     cache1 = dict_merge(qcaches1)
-        #     cache2 = dict_merge(qcaches2)
-        #     store_cache(args.bc1_cache, cache1, qcount1)
-        #     store_cache(args.bc2_cache, cache2, qcount2)
-
-        # if args.save_stats:
-        #     bccount1 = count_dict_sum(bccounts1)
-        #     bccount2 = count_dict_sum(bccounts2)
-        #     with open(args.save_stats, "w") as f:
-        #         for k, v in sorted(N.items()):
-        #             f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
-
-        #         for k, v in sorted(bccount1.items()):
-        #             f.write(
-        #                 f"BC1\t{k}\t{v}\t{100.0 * v/max(bccount1['total'], 1):.2f}\n"
-        #             )
-
-        #         for k, v in sorted(bccount2.items()):
-        #             f.write(
-        #                 f"BC2\t{k}\t{v}\t{100.0 * v/max(bccount2['total'], 1):.2f}\n"
-        #             )
+            bam_out = checkpoint.stream("bam_out")
+            source = partial(read_chunks, args, skip=checkpoint.n_items)
+        else:
+            bam_out = BAMWriter(args.bam_out, header, level=level)
+            source = partial(read_chunks, args)
+
+        def write(result):
+            n, data = result
+            bam_out.write(data)
+            return n
+
+        # dispatcher reads BAM in chunks, workers trim and encode them,
+        # and the trimmed reads are written here, in order
+        worker_stats = Pipeline(
+            source,
+            partial(
+                TrimWorker,
+                args,
+                load_adapters(args.adapters_right, args.adapters_left),
+            ),
+            write,
+            n_workers=args.threads_work,
+            max_bytes=int(args.max_mb_in_flight * 2**20),
+            monitor_file=args.monitor_file,
+            monitor_interval=args.monitor_interval,
+            checkpoint=checkpoint,
+        ).run()
+        bam_out.close()
+        if checkpoint:
+            checkpoint.finalize({"bam_out": args.bam_out}, tail=BGZF_EOF)
+
+        el.logger.info("Pipeline has finished. Merging worker statistics.")
+
+    write_reports(
+        args.stats_out,
+        args,
+        defaultdict(int, worker_stats["stats"]),
+        defaultdict(int, worker_stats["total"]),
+        worker_stats["lhist"],
+        worker_stats["trim_hists"],
+    )
 
 
 if __name__ == "__main__":
     args = parse_cmdline()
-    if args.threads_work == 1:
+    if args.threads_work == 1 and not args.checkpoint:
         main_single(args)
     else:
         main_parallel(args)
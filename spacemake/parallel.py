@@ -4,7 +4,14 @@ __license__ = "GPL"
 __email__ = ["marvin.jens@mdc-berlin.de"]
 
 import logging
+import os
+import queue
+import sys
 import time
+from collections import defaultdict
+
+# multiprocessing.shared_memory, needed for PackedChunk.share()
+HAVE_SHARED_MEMORY = sys.version_info >= (3, 8)
 
 
 def put_or_abort(Q, item, abort_flag, timeout=1):
@@ -17,8 +24,6 @@ def put_or_abort(Q, item, abort_flag, timeout=1):
     Returns: False if put() was succesful, True if execution
     should be aborted.
     """
-    import queue
-
     sent = False
     # logging.warning(f"sent={sent} abort_flag={abort_flag}")
     while not (sent or abort_flag.value):
@@ -42,8 +47,6 @@ def queue_iter(Q, abort_flag, stop_item=None, timeout=1):
     The abort_flag is handled analogous to put_or_abort, only
     that it ends the iteration instead
     """
-    import queue
-
     # logging.debug(f"queue_iter({queue})")
     while True:
         if abort_flag.value:
@@ -92,22 +95,176 @@ def join_with_empty_queues(proc, Qs, abort_flag, timeout=1):
     return contents
 
 
-def chunkify(src, n_chunk=1000):
+class PackedChunk:
+    """
+    A chunk of records, each a tuple of n_fields strings, packed into a single
+    newline-separated bytes buffer. Sending it through a mp.Queue pickles one
+    bytes object instead of thousands of small tuples and strings, and the
+    receiving end only decodes the records when they are accessed.
+    Fields must not contain newlines, which also means that a block of raw
+    FASTQ data is a valid PackedChunk with n_fields=4.
+
+    After share(), the buffer lives in a multiprocessing.shared_memory block
+    and only its name is pickled. The receiving process copies the data out
+    and releases the shared memory. This requires Python 3.8 or newer (see
+    HAVE_SHARED_MEMORY).
+    """
+
+    def __init__(self, buf, n_fields):
+        self.buf = buf
+        self.n_fields = n_fields
+        self.shm_name = None
+        self._offsets = None
+
+    @classmethod
+    def pack(cls, records, n_fields=None):
+        records = list(records)
+        if n_fields is None:
+            n_fields = len(records[0]) if records else 1
+
+        fields = [f for rec in records for f in rec]
+        if len(fields) != n_fields * len(records):
+            raise ValueError(f"all records must have {n_fields} fields")
+
+        if not fields:
+            return cls(b"", n_fields)
+
+        return cls(("\n".join(fields) + "\n").encode("utf-8"), n_fields)
+
+    @property
+    def offsets(self):
+        """
+        byte offsets at which each record starts, plus the end of the buffer
+        """
+        if self._offsets is None:
+            import numpy as np
+
+            nl = np.flatnonzero(np.frombuffer(self.buf, dtype=np.uint8) == 10)
+            self._offsets = np.concatenate(
+                [[0], nl[self.n_fields - 1 :: self.n_fields] + 1]
+            )
+
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return tuple(self.buf[start : end - 1].decode("utf-8").split("\n"))
+
+    def columns(self):
+        """
+        decodes the whole chunk at once. Returns one list per field.
+        """
+        lines = self.buf.decode("utf-8").split("\n")
+        n = len(lines) // self.n_fields
+        k = self.n_fields
+        return [lines[i : n * k : k] for i in range(k)]
+
+    def __iter__(self):
+        return zip(*self.columns())
+
+    def share(self):
+        """
+        moves the buffer into shared memory. The memory is released by the
+        process that unpickles this chunk.
+        """
+        from multiprocessing import shared_memory, resource_tracker
+
+        if self.shm_name is None and self.buf:
+            shm = shared_memory.SharedMemory(create=True, size=len(self.buf))
+            shm.buf[: len(self.buf)] = self.buf
+            self.shm_name = shm.name
+            shm.close()
+            # ownership passes to the receiving process. Otherwise the
+            # resource tracker of this process would remove the memory as
+            # soon as this process exits, even if it was not consumed yet.
+            resource_tracker.unregister(shm._name, "shared_memory")
+
+        return self
+
+    def __getstate__(self):
+        if self.shm_name is not None:
+            return (None, self.n_fields, self.shm_name, len(self.buf))
+        else:
+            return (self.buf, self.n_fields, None, len(self.buf))
+
+    def __setstate__(self, state):
+        buf, self.n_fields, shm_name, size = state
+        self.shm_name = None
+        self._offsets = None
+        if shm_name is not None:
+            from multiprocessing import shared_memory
+
+            shm = shared_memory.SharedMemory(name=shm_name)
+            buf = bytes(shm.buf[:size])
+            shm.close()
+            shm.unlink()
+
+        self.buf = buf
+
+
+def nbytes(obj):
+    """
+    approximate size of a chunk (or result) in bytes, for memory accounting
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if isinstance(obj, PackedChunk):
+        return len(obj.buf)
+    if hasattr(obj, "nbytes"):
+        # numpy arrays, memoryview
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum([nbytes(x) for x in obj])
+
+    import sys
+
+    return sys.getsizeof(obj)
+
+
+def chunkify(src, n_chunk=1000, packed=False, shared=False, chunk_size=None):
     """
     Iterator which collects up to n_chunk items from iterable <src> and yields them
-    as a list.
+    as a list. If packed=True, items must be tuples of strings and chunks are
+    yielded as PackedChunk instead (in shared memory if shared=True).
+    If chunk_size is given, it is called before each chunk and returns the
+    desired chunk size in bytes (see Pipeline). Then, n_chunk is only the
+    size of the first chunk and subsequent chunks are sized according to
+    the average size of the items seen so far.
     """
-    chunk = []
+    from itertools import islice
+
+    def make(chunk):
+        if not packed:
+            return chunk
+
+        chunk = PackedChunk.pack(chunk)
+        if shared:
+            chunk.share()
+
+        return chunk
+
+    src = iter(src)
     n = 0
-    for x in src:
-        chunk.append(x)
-        if len(chunk) >= n_chunk:
-            yield n, chunk
-            n += 1
-            chunk = []
-
-    if chunk:
+    n_items = 0
+    n_bytes = 0
+    while True:
+        items = list(islice(src, n_chunk))
+        if not items:
+            break
+
+        chunk = make(items)
+        if chunk_size is not None:
+            n_items += len(items)
+            n_bytes += nbytes(chunk)
+            n_chunk = max(int(chunk_size() * n_items / max(n_bytes, 1)), 1)
+
         yield n, chunk
+        n += 1
 
 
 def log_qerr(qerr):
@@ -117,6 +274,50 @@ def log_qerr(qerr):
             logging.error(f"subprocess {name} exception {line}")
 
 
+def merge_stats(total, *deltas):
+    """
+    Merges dictionaries of stats (e.g. from a worker) into total, in place.
+    Numbers (and lists) are added up, dictionaries are merged recursively.
+    Other values are combined with their update() method or, if they have
+    none, with the merge() classmethod of their type. Passing several
+    deltas at once calls merge() only once per key.
+    """
+    nested = defaultdict(list)
+    merged = defaultdict(list)
+    for delta in deltas:
+        for k, v in delta.items():
+            if k not in total:
+                total[k] = v
+            elif isinstance(v, dict):
+                nested[k].append(v)
+            elif hasattr(total[k], "update"):
+                total[k].update(v)
+            elif hasattr(total[k], "merge"):
+                merged[k].append(v)
+            else:
+                total[k] += v
+
+    for k, vs in nested.items():
+        merge_stats(total[k], *vs)
+
+    for k, vs in merged.items():
+        total[k] = type(total[k]).merge([total[k]] + vs)
+
+    return total
+
+
+def count_dict_sum(sources):
+    "sums up the values of count dictionaries, e.g. stats from several workers"
+    from collections import defaultdict
+
+    dst = defaultdict(float)
+    for src in sources:
+        for k, v in src.items():
+            dst[k] += v
+
+    return dst
+
+
 class ExceptionLogging:
     """
     A context manager that handles otherwise uncaught exceptions by logging
@@ -158,3 +359,796 @@ class ExceptionLogging:
             if self.exc_flag:
                 self.logger.error(f"raising exception flag {self.exc_flag}")
                 self.exc_flag.value = True
+
+
+class ByteBudget:
+    """
+    Limits the amount of data in flight between processes: acquire() blocks
+    as long as adding a chunk of nbytes would exceed max_bytes or max_chunks,
+    release() returns the capacity. A single chunk is always admitted if
+    nothing else is in flight, so that oversized chunks can not dead-lock.
+    """
+
+    def __init__(self, max_bytes=2**27, max_chunks=1000):
+        import multiprocessing as mp
+
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks
+        self.in_flight = mp.Array("q", 2)  # bytes, chunks
+        self.cond = mp.Condition(self.in_flight.get_lock())
+
+    def acquire(self, nbytes, abort_flag, timeout=1):
+        """
+        Returns: False if the capacity was acquired, True if execution
+        should be aborted (analogous to put_or_abort).
+        """
+        with self.cond:
+            while not abort_flag.value:
+                n_bytes, n_chunks = self.in_flight[:]
+                if not n_chunks or (
+                    n_bytes + nbytes <= self.max_bytes and n_chunks < self.max_chunks
+                ):
+                    self.in_flight[0] += nbytes
+                    self.in_flight[1] += 1
+                    break
+
+                self.cond.wait(timeout)
+
+        return abort_flag.value
+
+    def release(self, nbytes):
+        with self.cond:
+            self.in_flight[0] -= nbytes
+            self.in_flight[1] -= 1
+            self.cond.notify_all()
+
+    @property
+    def bytes(self):
+        return self.in_flight[0]
+
+    @property
+    def chunks(self):
+        return self.in_flight[1]
+
+
+class ChunkSizer:
+    """
+    The desired size of input chunks in bytes, shared between processes.
+    update() is fed with the time workers needed to process chunks and
+    adjusts the size, such that processing a chunk takes about target_time
+    seconds: long enough to make the overhead per chunk negligible, short
+    enough to keep all workers busy. The size is kept within
+    [min_bytes, max_bytes].
+    """
+
+    def __init__(
+        self, chunk_bytes=2**20, min_bytes=2**16, max_bytes=2**24, target_time=0.25
+    ):
+        import multiprocessing as mp
+
+        self.min_bytes = min_bytes
+        self.max_bytes = max(max_bytes, min_bytes)
+        self.target_time = target_time
+        self.rate = None
+        self.size = mp.Value("d", self.clip(chunk_bytes), lock=False)
+
+    def clip(self, size):
+        return min(max(size, self.min_bytes), self.max_bytes)
+
+    def __call__(self):
+        return int(self.size.value)
+
+    def update(self, nbytes, dt):
+        if dt <= 0 or nbytes <= 0:
+            return
+
+        # processing speed (bytes/second) of a single worker, smoothed
+        rate = nbytes / dt
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.8 * self.rate + 0.2 * rate
+
+        self.size.value = self.clip(self.rate * self.target_time)
+
+
+def rss_mb(pid):
+    "resident memory of a process in MB (Linux only, None otherwise)"
+    import os
+
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def queue_depth(Q):
+    "approximate number of items in a mp.Queue (None where not supported)"
+    try:
+        return Q.qsize()
+    except NotImplementedError:
+        return None
+
+
+class PipelineMonitor:
+    """
+    Samples the activity of a Pipeline every <interval> seconds: queue
+    depths, reorder backlog, data in flight, throughput and idle time of
+    the reader, each worker and the sink, and the resident memory of all
+    processes. Samples are written as JSON lines to fname (if given) and
+    a summary goes to the log every log_interval seconds. Together, these
+    show whether the reader, the workers or the sink limit the throughput.
+    """
+
+    def __init__(self, fname="", interval=5, log_interval=30, logger=None):
+        self.fname = fname
+        self.interval = interval
+        self.log_interval = log_interval
+        self.logger = logger or logging.getLogger("monitor")
+        self.out = open(fname, "w") if fname else None
+        self.t0 = time.time()
+        self.t_sample = self.t0
+        self.t_log = self.t0
+        # per worker: [chunks, idle seconds, busy seconds] in the current window
+        self.workers = {}
+        self.sink_busy = 0.0
+        self.n_items = 0
+        self.reader = (0, 0.0, 0.0)
+
+    def chunk_done(self, worker, t_idle, t_busy):
+        w = self.workers.setdefault(worker, [0, 0.0, 0.0])
+        w[0] += 1
+        w[1] += t_idle
+        w[2] += t_busy
+
+    def sink_done(self, dt):
+        self.sink_busy += dt
+
+    def due(self):
+        return time.time() - self.t_sample >= self.interval
+
+    def sample(self, n_items, reader_clock, procs, **gauges):
+        """
+        records one sample. n_items is the total number of items passed to
+        the sink so far, reader_clock holds the number of chunks dispatched,
+        and the seconds spent reading and blocked by backpressure. gauges
+        are included as they are.
+        """
+        import json
+
+        t = time.time()
+        dt = max(t - self.t_sample, 1e-6)
+        reader = tuple(reader_clock[:])
+        d_reader = [b - a for a, b in zip(self.reader, reader)]
+        rss = {"main": rss_mb("self")}
+        for p in procs:
+            if p.pid is not None and p.exitcode is None:
+                rss[p.name] = rss_mb(p.pid)
+
+        record = dict(
+            t=round(t - self.t0, 3),
+            items=n_items,
+            items_per_second=round((n_items - self.n_items) / dt, 1),
+            reader=dict(
+                chunks_per_second=round(d_reader[0] / dt, 2),
+                busy=round(d_reader[1] / dt, 3),
+                blocked=round(d_reader[2] / dt, 3),
+            ),
+            workers={
+                name: dict(
+                    chunks_per_second=round(n / dt, 2),
+                    idle=round(idle / max(idle + busy, 1e-6), 3),
+                )
+                for name, (n, idle, busy) in sorted(self.workers.items())
+            },
+            sink_busy=round(self.sink_busy / dt, 3),
+            rss_mb={k: round(v, 1) for k, v in rss.items() if v is not None},
+            **gauges,
+        )
+        record["rss_mb_total"] = round(sum(record["rss_mb"].values()), 1)
+
+        if self.out:
+            self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
+
+        if t - self.t_log >= self.log_interval:
+            self.log(record)
+            self.t_log = t
+
+        self.t_sample = t
+        self.n_items = n_items
+        self.reader = reader
+        self.sink_busy = 0.0
+        self.workers = {name: [0, 0.0, 0.0] for name in self.workers}
+        return record
+
+    def log(self, r):
+        workers = r["workers"].values()
+        n = max(len(workers), 1)
+        self.logger.info(
+            f"{r['t']:.0f}s: {r['items']} items ({r['items_per_second']:.0f}/s) "
+            f"queues in={r.get('queue_in')} out={r.get('queue_out')} "
+            f"heap={r.get('heap')} in_flight={r.get('in_flight_mb', 0):.1f}MB "
+            f"chunk={r.get('chunk_mb', 0):.2f}MB | "
+            f"reader busy={100 * r['reader']['busy']:.0f}% "
+            f"blocked={100 * r['reader']['blocked']:.0f}% | "
+            f"workers {sum([w['chunks_per_second'] for w in workers]):.1f} chunks/s "
+            f"idle={100 * sum([w['idle'] for w in workers]) / n:.0f}% | "
+            f"sink busy={100 * r['sink_busy']:.0f}% | "
+            f"RSS={r['rss_mb_total']:.0f}MB"
+        )
+
+    def close(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+
+
+class _CheckpointStream:
+    "file-like front end for one output stream of a Checkpoint"
+
+    def __init__(self, checkpoint, name):
+        self.checkpoint = checkpoint
+        self.name = name
+
+    def write(self, data):
+        self.checkpoint.write(self.name, data)
+
+    def close(self):
+        pass
+
+
+class Checkpoint:
+    """
+    Periodically commits the ordered output of a Pipeline, so that an
+    interrupted run can be resumed instead of starting from scratch.
+
+    Output streams (e.g. "assigned" and "unassigned") are written to segment
+    files in the checkpoint directory. After each chunk, the Pipeline calls
+    chunk_done(). Every <interval> seconds, the current segments are synced
+    to disk and recorded in manifest.json, together with the number of
+    chunks and input items (reads) they hold and a pickle of the stats
+    accumulated up to this point. finalize() writes each output as
+    head + segments + tail and removes the directory.
+
+    With resume=True, an existing checkpoint with the same signature (a
+    JSON-serializable description of the inputs and parameters) is picked
+    up: n_items tells the source how much input to skip and stats holds the
+    stats of the committed part. Otherwise the directory is cleared. The
+    heads are stored at the start of a run and reused upon resume. For the
+    output to be byte-identical to an uninterrupted run, chunk boundaries
+    must not depend on timing (the Pipeline uses fixed-size chunks when it
+    has a checkpoint).
+    """
+
+    def __init__(self, path, streams, signature, heads={}, resume=False, interval=300):
+        import json
+
+        self.path = path
+        self.streams = list(streams)
+        # normalize, e.g. tuples become lists, for comparison with the manifest
+        self.signature = json.loads(json.dumps(signature))
+        self.interval = interval
+        self.logger = logging.getLogger("checkpoint")
+        self.segments = []
+        self.n_chunks = 0
+        self.n_items = 0
+        self.stats = {}
+        self.stats_file = None
+
+        os.makedirs(path, exist_ok=True)
+        if resume and self.load():
+            self.logger.info(
+                f"resuming from '{path}' after {self.n_chunks} chunks "
+                f"({self.n_items} items)"
+            )
+        else:
+            self.clear()
+            for stream in self.streams:
+                self._write_synced(f"{stream}.head", heads.get(stream, b""))
+
+        self.open_segment()
+
+    @staticmethod
+    def make_signature(args, inputs=[], ignore=[]):
+        """
+        signature from the command line arguments (except those named in
+        ignore, which do not affect the output) and the size and
+        modification time of the input files.
+        """
+        files = {}
+        for fname in inputs:
+            if fname and os.path.isfile(fname):
+                st = os.stat(fname)
+                files[fname] = [st.st_size, int(st.st_mtime)]
+
+        args = {k: v for k, v in sorted(vars(args).items()) if k not in ignore}
+        return dict(args=args, inputs=files)
+
+    def fname(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_synced(self, name, data):
+        with open(self.fname(name), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        "reads the manifest. Returns False if there is no matching checkpoint"
+        import json
+        import pickle
+
+        try:
+            with open(self.fname("manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if manifest["signature"] != self.signature:
+            self.logger.warning(
+                f"checkpoint in '{self.path}' was made with different input or "
+                "parameters. Starting from scratch."
+            )
+            return False
+
+        self.segments = manifest["segments"]
+        self.n_chunks = manifest["n_chunks"]
+        self.n_items = manifest["n_items"]
+        self.stats_file = manifest["stats"]
+        if self.stats_file:
+            with open(self.fname(self.stats_file), "rb") as f:
+                self.stats = pickle.load(f)
+
+        # remove whatever was written after the last commit
+        keep = set(["manifest.json", self.stats_file])
+        keep |= set([f"{stream}.head" for stream in self.streams])
+        for seg in self.segments:
+            keep |= set(seg["files"].values())
+
+        for name in os.listdir(self.path):
+            if name not in keep:
+                os.remove(self.fname(name))
+
+        return True
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(self.fname(name))
+
+    def open_segment(self):
+        k = len(self.segments)
+        self.current = {s: f"{s}.{k:06d}.seg" for s in self.streams}
+        self.files = {s: open(self.fname(f), "wb") for s, f in self.current.items()}
+        self.pending_chunks = 0
+        self.pending_items = 0
+        self.t_commit = time.time()
+
+    def stream(self, name):
+        return _CheckpointStream(self, name)
+
+    def write(self, stream, data):
+        self.files[stream].write(data)
+
+    def chunk_done(self, n_items, get_stats):
+        """
+        called after each chunk has been written. get_stats() returns the
+        stats up to and including this chunk and is only called on commit.
+        """
+        self.pending_chunks += 1
+        self.pending_items += n_items or 0
+        if time.time() - self.t_commit >= self.interval:
+            self.commit(get_stats())
+
+    def close_segment(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+    def commit(self, stats):
+        import json
+        import pickle
+
+        self.close_segment()
+        self.n_chunks += self.pending_chunks
+        self.n_items += self.pending_items
+        self.segments.append(
+            dict(files=self.current, n_chunks=self.n_chunks, n_items=self.n_items)
+        )
+        # the previous stats stay valid until the new manifest is in place
+        stats_file = f"stats.{len(self.segments):06d}.pkl"
+        self._write_synced(stats_file, pickle.dumps(stats))
+        manifest = dict(
+            signature=self.signature,
+            n_chunks=self.n_chunks,
+            n_items=self.n_items,
+            stats=stats_file,
+            segments=self.segments,
+        )
+        self._write_synced("manifest.tmp", json.dumps(manifest, indent=1).encode())
+        os.replace(self.fname("manifest.tmp"), self.fname("manifest.json"))
+        if self.stats_file:
+            os.remove(self.fname(self.stats_file))
+
+        self.stats_file = stats_file
+        self.logger.info(
+            f"committed {self.n_chunks} chunks ({self.n_items} items) to '{self.path}'"
+        )
+        self.open_segment()
+
+    def finalize(self, outputs, tail=b""):
+        """
+        writes the complete outputs ({stream: file name}) from the segments
+        and removes the checkpoint.
+        """
+        import shutil
+
+        self.close_segment()
+        for stream, dest in outputs.items():
+            parts = [f"{stream}.head"]
+            parts += [seg["files"][stream] for seg in self.segments]
+            parts.append(self.current[stream])
+            with open(dest, "wb") as out:
+                for name in parts:
+                    with open(self.fname(name), "rb") as f:
+                        shutil.copyfileobj(f, out, 2**22)
+
+                out.write(tail)
+
+        shutil.rmtree(self.path)
+        self.logger.info(f"wrote {list(outputs.values())} and removed '{self.path}'")
+
+
+def _pipeline_dispatch(
+    source, chunk_size, budget, Qin, n_workers, Qerr, abort_flag, clock
+):
+    with ExceptionLogging("dispatcher", Qerr=Qerr, exc_flag=abort_flag) as el:
+        src = iter(source(chunk_size))
+        n_chunk = 0
+        while True:
+            t0 = time.time()
+            chunk = next(src, None)
+            if chunk is None:
+                break
+
+            t1 = time.time()
+            size = nbytes(chunk)
+            if budget.acquire(size, abort_flag) or put_or_abort(
+                Qin, (n_chunk, size, chunk), abort_flag
+            ):
+                el.logger.warning("shutdown flag was raised!")
+                break
+
+            # chunks, seconds reading and seconds blocked by backpressure
+            clock[0] += 1
+            clock[1] += t1 - t0
+            clock[2] += time.time() - t1
+            n_chunk += 1
+
+        for i in range(n_workers):
+            # each worker consumes exactly one None
+            if put_or_abort(Qin, None, abort_flag):
+                break
+
+
+def _pipeline_work(worker, Qin, Qres, Qerr, abort_flag, stats_interval):
+    import multiprocessing as mp
+
+    name = mp.current_process().name
+    with ExceptionLogging(name, Qerr=Qerr, exc_flag=abort_flag) as el:
+        work = worker()
+        get_stats = getattr(work, "stats", lambda: None)
+        t_stats = time.time()
+        t_ready = t_stats
+        for n_chunk, size, chunk in queue_iter(Qin, abort_flag):
+            t0 = time.time()
+            result = work(chunk)
+            t1 = time.time()
+            stats = None
+            if t1 - t_stats > stats_interval:
+                # periodic delta of our stats, for live reporting and to
+                # avoid one huge message at the end
+                stats = get_stats()
+                t_stats = t1
+
+            # the collector also learns how long we were waiting for input
+            msg = (n_chunk, size, name, t0 - t_ready, t1 - t0, result, stats)
+            if put_or_abort(Qres, msg, abort_flag):
+                el.logger.warning("shutdown flag was raised!")
+                break
+
+            t_ready = time.time()
+
+        if not abort_flag.value:
+            # tell the collector that this worker is done
+            el.logger.debug("sending final stats")
+            put_or_abort(Qres, (None, 0, name, 0, 0, None, get_stats()), abort_flag)
+
+
+class Pipeline:
+    """
+    Runs
+
+        source -> dispatcher -> n_workers x worker -> sink
+
+    with one dispatcher and n_workers worker processes. The sink runs in the
+    calling process.
+
+    source: callable that takes a chunk_size function and returns an
+        iterable of chunks. chunk_size() returns the currently desired size
+        of a chunk in bytes. The source is executed in the dispatcher
+        process, so it should open its input itself.
+    worker: callable that is executed once in each worker process and
+        returns the work function (or callable object) which turns a chunk
+        into a result. If the work object has a stats() method, it is
+        called periodically (every stats_interval seconds) and at the end.
+        It should return a dictionary with the stats accumulated since the
+        previous call. These deltas are sent along with the results and
+        merged (see merge_stats()) into Pipeline.stats, which run() returns.
+    sink: callable that receives the results, in the order of the chunks if
+        ordered=True, or as they arrive otherwise. If it returns a number, it
+        is used for progress reporting (e.g. the number of records written).
+
+    The desired chunk size starts at chunk_bytes and adapts to the measured
+    processing time of the workers (see ChunkSizer). The input chunks that
+    are on their way from the dispatcher to the sink (in queues, workers or
+    waiting for an earlier chunk) may not exceed max_bytes or max_chunks
+    (default 10 per worker) in total. This bounds the memory use,
+    independent of read length, and a slow sink throttles the dispatcher.
+    If an exception occurs anywhere, all processes are shut down without
+    dead-locking and run() raises.
+    A PipelineMonitor samples the state of the pipeline every
+    monitor_interval seconds and writes it to monitor_file (if given).
+    If a Checkpoint is given, the source is called with chunk_size=None
+    and has to yield chunks of a fixed number of items, starting after the
+    checkpoint's n_items. Stats are then sent with every chunk, so that
+    the stats of each commit match the output written so far, and the
+    sink is expected to write to the checkpoint's streams.
+    Since source and worker are passed to sub-processes, they should be
+    picklable, e.g. functools.partial(SomeWorkerClass, args).
+    """
+
+    def __init__(
+        self,
+        source,
+        worker,
+        sink,
+        n_workers=2,
+        ordered=True,
+        max_bytes=2**27,
+        max_chunks=None,
+        chunk_bytes=2**20,
+        target_time=0.25,
+        stats_interval=10,
+        monitor_file="",
+        monitor_interval=5,
+        checkpoint=None,
+        name="pipeline",
+        timeout=1,
+    ):
+        self.source = source
+        self.worker = worker
+        self.sink = sink
+        self.n_workers = max(n_workers, 1)
+        self.ordered = ordered
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks or 10 * self.n_workers
+        self.chunk_bytes = chunk_bytes
+        self.target_time = target_time
+        self.stats_interval = stats_interval
+        self.monitor_file = monitor_file
+        self.monitor_interval = monitor_interval
+        self.checkpoint = checkpoint
+        self.timeout = timeout
+        self.logger = logging.getLogger(name)
+        self.n_chunks = 0
+        self.n_items = 0
+        self.stats = {}
+        self.pending_stats = []
+        if checkpoint:
+            if not ordered:
+                raise ValueError("a checkpoint requires ordered=True")
+
+            # one stats delta per chunk, merged in the order of the output
+            self.stats_interval = 0
+            self.stats = checkpoint.stats
+
+    def run(self):
+        """
+        processes all chunks from source. Returns the merged stats of all
+        workers.
+        """
+        import multiprocessing as mp
+
+        # queues are unbounded, the ByteBudget limits how much is in flight
+        Qin = mp.Queue()
+        Qres = mp.Queue()
+        # child-processes can report errors back to the main process here
+        Qerr = mp.Queue()
+        abort_flag = mp.Value("b")
+        abort_flag.value = False
+
+        budget = ByteBudget(self.max_bytes, self.max_chunks)
+        reader_clock = mp.Array("d", 3, lock=False)
+        # leave room for at least two chunks per worker
+        chunk_size = ChunkSizer(
+            self.chunk_bytes,
+            min_bytes=min(2**16, self.chunk_bytes),
+            max_bytes=self.max_bytes // (2 * self.n_workers),
+            target_time=self.target_time,
+        )
+
+        procs = [
+            mp.Process(
+                target=_pipeline_dispatch,
+                name="dispatcher",
+                args=(
+                    self.source,
+                    None if self.checkpoint else chunk_size,
+                    budget,
+                    Qin,
+                    self.n_workers,
+                    Qerr,
+                    abort_flag,
+                    reader_clock,
+                ),
+            )
+        ]
+        for i in range(self.n_workers):
+            procs.append(
+                mp.Process(
+                    target=_pipeline_work,
+                    name=f"worker_{i}",
+                    args=(
+                        self.worker,
+                        Qin,
+                        Qres,
+                        Qerr,
+                        abort_flag,
+                        self.stats_interval,
+                    ),
+                )
+            )
+
+        for p in procs:
+            p.start()
+
+        self.logger.info(f"started dispatcher and {self.n_workers} workers")
+        monitor = PipelineMonitor(
+            self.monitor_file, interval=self.monitor_interval, logger=self.logger
+        )
+
+        def sample(heap_size):
+            return monitor.sample(
+                self.n_items,
+                reader_clock,
+                procs,
+                queue_in=queue_depth(Qin),
+                queue_out=queue_depth(Qres),
+                heap=heap_size,
+                in_flight_mb=round(budget.bytes / 2**20, 2),
+                in_flight_chunks=budget.chunks,
+                chunk_mb=round(chunk_size() / 2**20, 3),
+            )
+
+        try:
+            self.collect(Qres, abort_flag, procs, budget, chunk_size, monitor, sample)
+        except BaseException:
+            abort_flag.value = True
+            raise
+        finally:
+            self.shutdown(procs, [Qin, Qres, Qerr], abort_flag)
+            monitor.close()
+
+        if abort_flag.value:
+            raise RuntimeError("pipeline was aborted due to errors in a sub-process")
+
+        return self.merged_stats()
+
+    def merged_stats(self):
+        merge_stats(self.stats, *self.pending_stats)
+        self.pending_stats = []
+        return self.stats
+
+    def collect(self, Qres, abort_flag, procs, budget, chunk_size, monitor, sample):
+        import heapq
+
+        heap = []
+        n_chunk_needed = 0
+        n_done = 0
+        t0 = time.time()
+
+        while n_done < self.n_workers and not abort_flag.value:
+            if monitor.due():
+                sample(len(heap))
+
+            try:
+                item = Qres.get(timeout=self.timeout)
+            except queue.Empty:
+                for p in procs:
+                    if p.exitcode:
+                        self.logger.error(f"{p.name} died with exit code {p.exitcode}")
+                        abort_flag.value = True
+                continue
+
+            n_chunk, size, worker, t_idle, t_busy, result, stats = item
+            if n_chunk is None:
+                # worker is done
+                if stats:
+                    self.pending_stats.append(stats)
+                n_done += 1
+                continue
+
+            monitor.chunk_done(worker, t_idle, t_busy)
+            chunk_size.update(size, t_busy)
+            if not self.ordered:
+                self.consume(result, size, stats, budget, monitor)
+            else:
+                heapq.heappush(heap, (n_chunk, size, result, stats))
+                # as long as the root of the heap is the next needed chunk
+                # pass results on to the sink
+                while heap and (heap[0][0] == n_chunk_needed):
+                    n_chunk, size, result, stats = heapq.heappop(heap)
+                    self.consume(result, size, stats, budget, monitor)
+                    n_chunk_needed += 1
+
+        sample(len(heap))
+
+        if abort_flag.value:
+            self.logger.warning(
+                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
+            )
+        else:
+            # by the time all workers are done, all chunks
+            # should have been processed!
+            assert len(heap) == 0
+
+        dT = time.time() - t0
+        self.logger.info(
+            f"finished processing {self.n_chunks} chunks ({self.n_items} items) in "
+            f"{dT:.0f} seconds (average {self.n_items / max(dT, 1e-3):.0f} items/second)."
+        )
+
+    def consume(self, result, size, stats, budget, monitor):
+        t0 = time.time()
+        n = self.sink(result)
+        monitor.sink_done(time.time() - t0)
+        budget.release(size)
+        self.n_chunks += 1
+        if n is not None:
+            self.n_items += n
+
+        if stats:
+            # merged in batches, as merging large objects can be slow
+            self.pending_stats.append(stats)
+            if len(self.pending_stats) >= 100:
+                self.merged_stats()
+
+        if self.checkpoint:
+            self.checkpoint.chunk_done(n, self.merged_stats)
+
+    def shutdown(self, procs, Qs, abort_flag):
+        """
+        joins all sub-processes. Queues are emptied if the pipeline was
+        aborted, so that processes blocked on put() can terminate.
+        """
+        for p in procs:
+            contents = join_with_empty_queues(p, Qs, abort_flag, timeout=self.timeout)
+            if any(contents):
+                self.logger.info(
+                    f"{len(contents[0])} input and {len(contents[1])} result "
+                    f"chunks were drained upon abort of {p.name}."
+                )
+                log_qerr(contents[-1])
+
+        # errors reported after the last join
+        qerr = []
+        while not Qs[-1].empty():
+            try:
+                qerr.append(Qs[-1].get(timeout=self.timeout))
+            except queue.Empty:
+                break
+
+        log_qerr(qerr)
@@ -9,9 +9,10 @@ from spacemake.preprocess.fastq import (
     setup_logging,
     main_combinatorial,
     main_dropseq,
+    main_dropseq_streaming,
 )
 
-from spacemake.parallel import ExceptionLogging
+from spacemake.parallel import ExceptionLogging, HAVE_SHARED_MEMORY
 
 
 def cmdline():
@@ -30,8 +31,28 @@ def cmdline():
                 "bc1/2 are referenced in --cell or --cell-raw, but no reference barcodes are specified via --bc{{1,2}}-ref"
             )
 
+        if args.shards > 1 and args.out_assigned.startswith("/dev/"):
+            raise ValueError("--shards requires output file names, not a device")
+
+        if args.out_off_whitelist and not args.whitelist:
+            raise ValueError("--out-off-whitelist requires --whitelist")
+
+        if args.trim and args.out_format != "bam":
+            raise ValueError("--trim requires bam output format")
+
+        if args.checkpoint and args.streaming:
+            raise ValueError("--checkpoint is not supported with --streaming")
+
+        if args.resume and not args.checkpoint:
+            raise ValueError("--resume requires a --checkpoint directory")
+
+        if args.shared_memory and not HAVE_SHARED_MEMORY:
+            raise ValueError("--shared-memory requires Python 3.8 or newer")
+
         if args.bc1_ref or args.bc2_ref:
             main_combinatorial(args)
+        elif args.streaming:
+            main_dropseq_streaming(args)
         else:
             main_dropseq(args)
 
@@ -5,29 +5,62 @@ __license__ = "GPL"
 __email__ = ["marvin.jens@mdc-berlin.de"]
 
 import argparse
+import ast
+import itertools
+import json
+import re
 import logging
 import time
 import os
 import sys
+import zlib
 from numpy.core.fromnumeric import argsort
 import pandas as pd
 import numpy as np
 import pysam
 import multiprocessing as mp
-from collections import defaultdict
-#from Bio import pairwise2
+from collections import defaultdict, namedtuple
+from functools import partial
 from Bio import SeqIO
 
 from spacemake.parallel import (
-    put_or_abort,
-    queue_iter,
-    join_with_empty_queues,
+    Checkpoint,
     chunkify,
     ExceptionLogging,
+    PackedChunk,
+    Pipeline,
 )
-from spacemake.util import read_fq
+from spacemake.util import read_fq, FASTQBlockReader, parse_fq_block
+from spacemake.bam import (
+    BAMWriter,
+    BGZF_EOF,
+    bgzf_compress,
+    compression_pool,
+    encode_unmapped,
+    header_bytes,
+)
+from spacemake.cutadapt_bam import add_trim_arguments
 
 NO_CALL = "NNNNNNNN"
+# command line arguments that do not affect the output (see Checkpoint)
+CHECKPOINT_IGNORE = [
+    "checkpoint",
+    "checkpoint_interval",
+    "resume",
+    "parallel",
+    "streaming",
+    "threads_write",
+    "shared_memory",
+    "max_mb_in_flight",
+    "monitor_file",
+    "monitor_interval",
+    "log_file",
+    "log_level",
+    "save_stats",
+    "save_trim_stats",
+    "start_report",
+    "polyA_report",
+]
 
 # TODO:
 # * add support for three segments
@@ -50,6 +83,91 @@ def read_source(args):
             yield id1, seq1, id1, "READ2 IS NOT AVAILABLE", "READ2 IS NOT AVAILABLE"
 
 
+def read_chunks(args, chunk_size=None, n_chunk=1000, skip=0):
+    """
+    Yields chunks of reads. For FASTQ input, a chunk is a pair of raw FASTQ
+    blocks with the same number of records, wrapped as PackedChunk, so that
+    parsing happens in the workers (see unpack_reads()). Other input (BAM)
+    is packed into a PackedChunk of (id1, seq1, id2, seq2, qual2) records.
+    If chunk_size is given (see parallel.Pipeline), it is called before each
+    chunk and returns the desired size in bytes. Otherwise, or for the first
+    chunk, n_chunk reads are taken. The first skip reads are discarded (to
+    resume from a checkpoint).
+    """
+
+    def pack(block):
+        chunk = PackedChunk(block, n_fields=4)
+        if args.shared_memory:
+            chunk.share()
+
+        return chunk
+
+    if any([fname.endswith(".bam") for fname in [args.read1, args.read2] if fname]):
+        for n, chunk in chunkify(
+            itertools.islice(read_source(args), skip, None),
+            n_chunk=n_chunk,
+            packed=True,
+            shared=args.shared_memory,
+            chunk_size=chunk_size,
+        ):
+            yield chunk
+        return
+
+    readers = [FASTQBlockReader(args.read1)]
+    if args.read2:
+        readers.append(FASTQBlockReader(args.read2))
+
+    for r in readers:
+        r.skip(skip)
+
+    while True:
+        if chunk_size is not None and readers[0].n_records:
+            # size of a read pair, same number of records from each mate
+            bytes_per_read = sum([r.bytes_per_record for r in readers])
+            n_chunk = max(int(chunk_size() / bytes_per_read), 1)
+
+        blocks = [r.take(n_chunk) for r in readers]
+        if not all(blocks):
+            # mimic zip() in read_source() if the mates are out of sync
+            break
+
+        if args.read2:
+            yield pack(blocks[0]), pack(blocks[1])
+        else:
+            yield pack(blocks[0]), None
+
+
+def unpack_columns(chunk):
+    """
+    turns a chunk from read_chunks() into the lists
+    (id1, seq1, id2, seq2, qual2)
+    """
+    if isinstance(chunk, PackedChunk):
+        return chunk.columns()
+
+    block1, block2 = chunk
+    id1, seq1, qual1 = parse_fq_block(block1.buf)
+    if block2 is None:
+        na = ["READ2 IS NOT AVAILABLE"] * len(id1)
+        return id1, seq1, id1, na, na
+
+    id2, seq2, qual2 = parse_fq_block(block2.buf)
+    n = min(len(id1), len(id2))
+    if n < len(id1) or n < len(id2):
+        # mimic zip() in read_source() if the mates are out of sync at the end
+        return id1[:n], seq1[:n], id2[:n], seq2[:n], qual2[:n]
+
+    return id1, seq1, id2, seq2, qual2
+
+
+def unpack_reads(chunk):
+    """
+    turns a chunk from read_chunks() into a list of
+    (id1, seq1, id2, seq2, qual2) tuples, same as produced by read_source()
+    """
+    return list(zip(*unpack_columns(chunk)))
+
+
 def hamming(seqA, seqB, costs, match=2):
     score = 0
     for a, b, c in zip(seqA, seqB, costs):
@@ -64,21 +182,272 @@ def hamming(seqA, seqB, costs, match=2):
     return score
 
 
+# 2-bit codes for the four bases. N gets its own code so that it only
+# matches itself (like the string comparison in hamming()), anything else
+# is coded as 5 and never matches.
+BASE_CODES = np.full(256, 5, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGTN"):
+    BASE_CODES[_base] = _code
+
+# one-hot lookup: code -> row of channel flags. Code 5 maps to all zeros.
+ONE_HOT = np.eye(6, 5)
+
+
+def encode_2bit(seqs, L):
+    """
+    Encode a list of sequences, each at least L nt long, as an (n, L) uint8
+    matrix of base codes (A=0, C=1, G=2, T=3, N=4). Longer sequences are
+    truncated to L, mirroring the zip() in hamming().
+    """
+    buf = "".join([s[:L] for s in seqs]).encode("ascii")
+    return BASE_CODES[np.frombuffer(buf, dtype=np.uint8)].reshape(len(seqs), L)
+
+
+# longest sequence that still fits into a uint64 key next to its length
+MAX_PACKED = 29
+
+
+def pack_2bit(seqs):
+    """
+    Pack sequences of up to MAX_PACKED nt into uint64 keys: 2 bits per base,
+    first base in the most significant position, followed by 6 bits holding
+    the length. Returns the keys and a boolean mask which is False for
+    sequences that can not be packed (too long, or not only ACGT).
+    """
+    keys = np.zeros(len(seqs), dtype=np.uint64)
+    valid = np.zeros(len(seqs), dtype=bool)
+    lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    for L in np.unique(lens):
+        if L > MAX_PACKED:
+            continue
+
+        if L == lens[0] and (lens == L).all():
+            idx = slice(None)
+            codes = encode_2bit(seqs, L)
+        else:
+            idx = np.flatnonzero(lens == L)
+            codes = encode_2bit([seqs[i] for i in idx], L)
+
+        k = np.zeros(len(codes), dtype=np.uint64)
+        for j in range(L):
+            k = (k << np.uint64(2)) | (codes[:, j] & 3).astype(np.uint64)
+
+        keys[idx] = (k << np.uint64(6)) | np.uint64(L)
+        valid[idx] = (codes < 4).all(axis=1)
+
+    return keys, valid
+
+
+def unpack_2bit(keys):
+    """
+    Inverse of pack_2bit() for valid keys. Returns a list of strings.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    res = [None] * len(keys)
+    lens = (keys & np.uint64(63)).astype(np.int64)
+    for L in np.unique(lens):
+        idx = np.flatnonzero(lens == L)
+        k = keys[idx] >> np.uint64(6)
+        codes = np.zeros((len(idx), L), dtype=np.uint8)
+        for j in range(L - 1, -1, -1):
+            codes[:, j] = k & np.uint64(3)
+            k >>= np.uint64(2)
+
+        buf = np.frombuffer(b"ACGT", dtype=np.uint8)[codes].tobytes().decode("ascii")
+        for n, i in enumerate(idx):
+            res[i] = buf[n * L : (n + 1) * L]
+
+    return res
+
+
+class BarcodeCounter:
+    """
+    Counts barcodes as 2-bit packed integer keys (see pack_2bit()), which
+    are accumulated in numpy arrays and only reduced every few million
+    barcodes. Barcodes that can not be packed (containing N, or longer than
+    MAX_PACKED) are counted in a plain dictionary. Picklable, so that worker
+    processes can send their counts to the main process.
+    """
+
+    def __init__(self, compact_every=2**22):
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.n_pending = 0
+        self.compact_every = compact_every
+        self.overflow = defaultdict(int)
+
+    def add(self, barcodes):
+        keys, valid = pack_2bit(barcodes)
+        if not valid.all():
+            keys = keys[valid]
+            for i in np.flatnonzero(~valid):
+                self.overflow[barcodes[i]] += 1
+
+        self._add(keys, np.ones(len(keys), dtype=np.int64))
+
+    def _add(self, keys, counts):
+        self.pending.append((keys, counts))
+        self.n_pending += len(keys)
+        if self.n_pending >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        if not self.pending:
+            return
+
+        keys = np.concatenate([self.keys] + [k for k, c in self.pending])
+        counts = np.concatenate([self.counts] + [c for k, c in self.pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(
+            inverse.ravel(), weights=counts, minlength=len(self.keys)
+        ).astype(np.int64)
+        self.pending = []
+        self.n_pending = 0
+
+    def __getstate__(self):
+        self._compact()
+        return self.__dict__
+
+    def update(self, other):
+        "adds the counts of another BarcodeCounter"
+        other._compact()
+        self._add(other.keys, other.counts)
+        for bc, n in other.overflow.items():
+            self.overflow[bc] += n
+
+    def __len__(self):
+        self._compact()
+        return len(self.keys) + len(self.overflow)
+
+    def items(self):
+        "returns a list of (barcode, count) sorted by barcode"
+        self._compact()
+        items = list(zip(unpack_2bit(self.keys), self.counts.tolist()))
+        items.extend(self.overflow.items())
+        return sorted(items)
+
+    @classmethod
+    def merge(cls, counters):
+        merged = cls()
+        for counter in counters:
+            merged.update(counter)
+
+        return merged
+
+
+def read_whitelist(fname):
+    """
+    returns the barcodes from a puck barcode file (column 'cell_bc',
+    'barcodes' or 'barcode', tab- or comma-separated) or from a plain list
+    with one barcode per line.
+    """
+    import gzip
+
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "rt") as f:
+        header = f.readline().rstrip("\n")
+
+    sep = "\t" if "\t" in header else ","
+    for col in ["cell_bc", "barcodes", "barcode"]:
+        if col in header.split(sep):
+            return pd.read_csv(fname, sep=sep, usecols=[col])[col].astype(str).tolist()
+
+    return pd.read_csv(fname, sep=sep, header=None, usecols=[0])[0].astype(str).tolist()
+
+
+class BarcodeWhitelist:
+    """
+    Set of cell barcodes (e.g. from one or more puck barcode files), stored
+    as a sorted array of 2-bit packed keys (see pack_2bit()). A barcode is
+    on the whitelist if it is within max_mismatches (Hamming distance) of a
+    listed barcode. Barcodes that do not match exactly are expanded into
+    their 3 x L single-base substitutions, once per allowed mismatch, so
+    that each mismatch multiplies the lookups for those barcodes by 3 x L.
+    Barcodes that can not be packed (containing N, or longer than
+    MAX_PACKED) are kept in a plain set and only match exactly.
+    """
+
+    def __init__(self, fnames, max_mismatches=0):
+        keys = []
+        self.other = set()
+        for fname in fnames:
+            barcodes = read_whitelist(fname)
+            k, valid = pack_2bit(barcodes)
+            keys.append(k[valid])
+            self.other.update([barcodes[i] for i in np.flatnonzero(~valid)])
+            logging.getLogger("whitelist").debug(
+                f"loaded {len(barcodes)} barcodes from '{fname}'"
+            )
+
+        self.keys = np.unique(np.concatenate(keys + [np.zeros(0, dtype=np.uint64)]))
+        self.max_mismatches = max_mismatches
+
+    def __len__(self):
+        return len(self.keys) + len(self.other)
+
+    def contains(self, keys):
+        if not len(self.keys):
+            return np.zeros(keys.shape, dtype=bool)
+
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        return self.keys[idx] == keys
+
+    @staticmethod
+    def substitutions(keys, L):
+        """
+        all single-base substitutions of each row of keys, for barcodes of up
+        to L nt. Positions beyond the length of a barcode produce keys that
+        can not match any barcode of that length.
+        """
+        shifts = np.uint64(6) + np.uint64(2) * np.arange(L, dtype=np.uint64)
+        flips = (np.arange(1, 4, dtype=np.uint64)[:, None] << shifts).ravel()
+        return (keys[:, :, None] ^ flips).reshape(len(keys), -1)
+
+    def query(self, barcodes):
+        "returns a boolean array, True for each barcode on the whitelist"
+        keys, valid = pack_2bit(barcodes)
+        found = np.zeros(len(barcodes), dtype=bool)
+        found[valid] = self.contains(keys[valid])
+        if self.other:
+            for i in np.flatnonzero(~valid):
+                found[i] = barcodes[i] in self.other
+
+        todo = np.flatnonzero(valid & ~found)
+        candidates = keys[todo][:, None]
+        L = max([len(barcodes[i]) for i in todo], default=0)
+        for d in range(self.max_mismatches):
+            if not len(todo):
+                break
+
+            candidates = self.substitutions(candidates, L)
+            hit = self.contains(candidates).any(axis=1)
+            found[todo[hit]] = True
+            todo = todo[~hit]
+            candidates = candidates[~hit]
+
+        return found
+
+
 class BarcodeMatcher:
-    def __init__(self, fname, length_specific=True, place="left"):
+    def __init__(self, fname, length_specific=True, place="left", max_cells=2**23):
         self.logger = logging.getLogger("BarcodeMatcher")
         self.length_specific = length_specific
+        self.max_cells = max_cells
         self.names, self.seqs = self.load_targets(fname)
         self.slen = np.array([len(s) for s in self.seqs])
         if len(self.names) == 0:
             self.logger.warning(f"no references loaded! Disabling matching for {fname}")
             self.align = self.align_na
+            self.align_batch = self.align_batch_na
         else:
             self.lmin = self.slen.min()
             self.lmax = self.slen.max()
             self.place = place
             self.costs = {}
             self.slen_masks = {}
+            self.ref_matrix = {}
             for l in range(self.lmin, self.lmax + 1):
                 self.slen_masks[l] = (self.slen == l).nonzero()[0]
                 cost = np.ones(l)
@@ -92,6 +461,10 @@ class BarcodeMatcher:
                     cost[4:8] = 3  # the diagnostic 4-mer
 
                 self.costs[l] = cost
+                # references of length l as flattened one-hot (n_refs, l * 5)
+                # matrix. Scoring queries then becomes a single matrix product.
+                codes = encode_2bit(self.seqs[self.slen_masks[l]], l)
+                self.ref_matrix[l] = ONE_HOT[codes].reshape(len(codes), l * 5).T
 
             self.logger.debug(
                 f"initialized from {len(self.names)} sequences from lmin={self.lmin} to lmax={self.lmax}"
@@ -115,81 +488,453 @@ class BarcodeMatcher:
             [-1],
         )
 
-    def align(self, query, debug=False):
-        results = []
-        scores = []
-        # select set of barcode sequences to align with
-        if len(query) < self.lmin:
-            return (
-                [NO_CALL],
-                [NO_CALL],
-                [-1],
-            )
+    def align_batch_na(self, queries):
+        return [self.align_na(q) for q in queries]
+
+    def score_batch(self, queries, lq):
+        """
+        Scores queries (all at least lq nt long) against all references of
+        length lq at once. Gives the same scores as hamming() with the
+        per-position costs for lq, as an (n_queries, n_refs) matrix.
+
+        A match at position l is worth 2, a mismatch costs costs[l]. If the
+        query has an 'A' at a zero-cost position, the mismatch is rewarded
+        with +1 (see hamming()). Writing this as
+            base_q + sum_l match_qrl * (2 + costs[l] - bonus_ql)
+        turns the weighted comparison into a product of one-hot matrices.
+        """
+        costs = self.costs[lq]
+        codes = encode_2bit(queries, lq)
+        bonus = (codes == 0) & (costs == 0)
+        base = bonus.sum(axis=1) - costs.sum()
+        weights = ONE_HOT[codes] * (2 + costs - bonus)[:, :, np.newaxis]
+        return base[:, np.newaxis] + weights.reshape(len(queries), lq * 5).dot(
+            self.ref_matrix[lq]
+        )
 
-        if self.length_specific:
-            lq = min(len(query), self.lmax)
+    def align_batch(self, queries):
+        """
+        Vectorized version of align() for a list of queries. Queries are
+        grouped by the reference length they are compared to and each group
+        is scored in one array operation (split into blocks to keep the score
+        matrix below max_cells entries).
+        Returns a list of (names, seqs, scores) with all tied best matches,
+        in the order of the queries.
+        """
+        results = [None] * len(queries)
+        by_len = defaultdict(list)
+        for i, query in enumerate(queries):
+            if len(query) < self.lmin:
+                results[i] = self.align_na(query)
+            else:
+                by_len[min(len(query), self.lmax)].append(i)
+
+        for lq, idx in by_len.items():
             lmask = self.slen_masks[lq]
+            if not len(lmask):
+                for i in idx:
+                    results[i] = self.align_na(queries[i])
+                continue
+
             seqs_sel = self.seqs[lmask]
             names_sel = self.names[lmask]
-        else:
-            seqs_sel = self.seqs
-            names_sel = self.names
+            n_block = max(1, self.max_cells // len(lmask))
+            for j in range(0, len(idx), n_block):
+                block = idx[j : j + n_block]
+                scores = self.score_batch([queries[i] for i in block], lq)
+                best = scores.max(axis=1)
+                for i, row, top in zip(block, scores, best):
+                    ties = row == top
+                    results[i] = names_sel[ties], seqs_sel[ties], row[ties]
 
-        costs = self.costs[lq]
-        # perform the alignments and keep results
-        for seq in seqs_sel:
-            res = hamming(query, seq, costs)
-            # print(query, seq, res)
-            results.append(res)
-            scores.append(res)
-
-        # identify best alignments and return tied, best barcode matches
-        scores = np.array(scores)
-        if debug:
-            I = scores.argsort()[::-1]
+        return results
+
+    def align(self, query, debug=False):
+        if debug and len(query) >= self.lmin:
+            lq = min(len(query), self.lmax)
+            lmask = self.slen_masks[lq]
+            scores = self.score_batch([query], lq)[0]
             print("Q  ", query)
-            for i in I:
-                seq = seqs_sel[i]
-                res = results[i]
-                print("*  ", seq, res)
+            for i in scores.argsort()[::-1]:
+                print("*  ", self.seqs[lmask][i], scores[i])
+
+        return self.align_batch([query])[0]
+
+
+class NeighborhoodIndex:
+    """
+    Pre-computed lookup of alignment results for all reference barcodes and
+    every sequence within a Hamming distance of <radius> to any of them.
+    The results come from the full, weighted scoring in
+    BarcodeMatcher.align_batch(), so a hit is exactly what align() would
+    have returned. Neighbors that tie between different references are kept
+    as explicit (NO_CALL, NO_CALL, score) entries, such that only queries
+    missing from the index need to be aligned.
+    """
+
+    def __init__(self, matcher, radius=1):
+        self.logger = logging.getLogger("NeighborhoodIndex")
+        self.radius = radius
+        self.lookup = {}
+        self.n_ambig = 0
+        if radius < 0 or not len(matcher.names):
+            return
+
+        t0 = time.time()
+        neighbors = dict.fromkeys(
+            n for ref in matcher.seqs for n in self.neighbors(str(ref), radius)
+        )
+        queries = list(neighbors.keys())
+        # many neighbors share the same result. Keep only one copy of each.
+        unique = {}
+        for query, res in zip(queries, matcher.align_batch(queries)):
+            name, seq, score = TieBreaker.resolve(*res)
+            result = (str(name), str(seq), float(score))
+            self.lookup[query] = unique.setdefault(result, result)
+            if name == NO_CALL:
+                self.n_ambig += 1
+
+        dt = time.time() - t0
+        self.logger.info(
+            f"radius={radius} index of {len(self.lookup)} sequences "
+            f"({self.n_ambig} ambiguous) for {len(matcher.names)} references "
+            f"built in {dt:.2f} seconds, using ~{self.memory() / 2**20:.1f} MB"
+        )
+
+    @staticmethod
+    def neighbors(seq, radius, alphabet="ACGT"):
+        "yields seq and all sequences with up to <radius> substitutions"
+        yield seq
+        for r in range(1, radius + 1):
+            for pos in itertools.combinations(range(len(seq)), r):
+                choices = [[b for b in alphabet if b != seq[i]] for i in pos]
+                for subst in itertools.product(*choices):
+                    s = list(seq)
+                    for i, b in zip(pos, subst):
+                        s[i] = b
+                    yield "".join(s)
+
+    def memory(self):
+        "approximate memory footprint of the lookup in bytes"
+        values = {id(v): v for v in self.lookup.values()}.values()
+        return (
+            sys.getsizeof(self.lookup)
+            + sum(sys.getsizeof(k) for k in self.lookup.keys())
+            + sum(sys.getsizeof(v) + sum(map(sys.getsizeof, v)) for v in values)
+        )
+
+    def get(self, query, lmax):
+        return self.lookup.get(query[:lmax])
+
+
+class BarcodeCache:
+    """
+    Barcode assignments (name, seq, score) for queries, keyed by the
+    pack_2bit() encoding of the query truncated to the longest reference.
+    Stored in a compact binary file which is memory-mapped, so any number of
+    worker processes can binary-search it without loading or copying it.
+
+    File layout (little endian):
+        8 bytes     magic b"SMKBCC01" (the last two bytes are the version)
+        uint64      n, number of entries
+        uint64      size of the JSON header
+        JSON header (lmax, names & seqs), zero-padded to a multiple of 8
+        uint64[n]   keys, sorted
+        int32[n]    index into names & seqs, -1 for ambiguous (NO_CALL)
+        float32[n]  score
+        float32[n]  number of times the query was observed
+    """
+
+    magic = b"SMKBCC01"
+    logger = logging.getLogger("BarcodeCache")
+
+    def __init__(self, keys, refs, scores, counts, names=[], seqs=[], lmax=None):
+        self.lmax = lmax
+        self.keys = keys
+        self.refs = refs
+        self.scores = scores
+        self.counts = counts
+        self.names = list(names)
+        self.seqs = list(seqs)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.zeros(0, dtype=np.uint64),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.float32),
+        )
+
+    @classmethod
+    def from_dict(cls, cache, query_count, lmax):
+        """
+        Build a sorted cache from {query: (name, seq, score)}. Queries that
+        can not be packed are skipped, counts of queries that are identical
+        after truncation to lmax are summed up.
+        """
+        queries = list(cache.keys())
+        keys, valid = pack_2bit([q[:lmax] for q in queries])
+        ref_idx = {}
+        names = []
+        seqs = []
+        refs = np.zeros(len(queries), dtype=np.int32)
+        scores = np.zeros(len(queries), dtype=np.float32)
+        counts = np.zeros(len(queries), dtype=np.float32)
+        for i, q in enumerate(queries):
+            name, seq, score = cache[q]
+            if name == NO_CALL:
+                refs[i] = -1
+            else:
+                if name not in ref_idx:
+                    ref_idx[name] = len(names)
+                    names.append(str(name))
+                    seqs.append(str(seq))
+                refs[i] = ref_idx[name]
+            scores[i] = score
+            counts[i] = query_count.get(q, 0)
+
+        return cls(
+            keys[valid], refs[valid], scores[valid], counts[valid], names, seqs, lmax
+        )._compact()
+
+    def _compact(self):
+        "sort by key and collapse duplicate keys, summing up their counts"
+        if not len(self.keys):
+            return self
+
+        I = self.keys.argsort(kind="stable")
+        keys = self.keys[I]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        starts = first.nonzero()[0]
+        self.counts = np.add.reduceat(self.counts[I], starts).astype(np.float32)
+        self.keys = keys[starts]
+        self.refs = self.refs[I][starts]
+        self.scores = self.scores[I][starts]
+        return self
+
+    @classmethod
+    def load(cls, fname, lmax=None):
+        if not fname or not os.access(fname, os.R_OK):
+            return cls.empty()
+
+        t0 = time.time()
+        with open(fname, "rb") as f:
+            magic = f.read(len(cls.magic))
+            if magic[:6] == cls.magic[:6] and magic != cls.magic:
+                raise ValueError(
+                    f"'{fname}' is a barcode cache of version "
+                    f"{magic[6:].decode('ascii', 'replace')}, expected "
+                    f"{cls.magic[6:].decode('ascii')}"
+                )
+            if magic != cls.magic:
+                # written by a previous version of spacemake
+                return cls.load_tsv(fname, lmax)
+
+            n, l_header = np.frombuffer(f.read(16), dtype="<u8")
+            header = json.loads(f.read(int(l_header)).rstrip(b"\0"))
+
+        ofs = len(cls.magic) + 16 + int(l_header)
+        columns = []
+        for dtype in ["<u8", "<i4", "<f4", "<f4"]:
+            if n:
+                columns.append(
+                    np.memmap(fname, dtype=dtype, mode="r", offset=ofs, shape=(int(n),))
+                )
+            else:
+                columns.append(np.zeros(0, dtype=dtype))
+            ofs += int(n) * np.dtype(dtype).itemsize
+
+        dt = time.time() - t0
+        cls.logger.debug(f"memory-mapped {n} cached assignments from '{fname}' in {dt:.3f} seconds")
+        return cls(*columns, header["names"], header["seqs"], header["lmax"])
+
+    @classmethod
+    def load_tsv(cls, fname, lmax):
+        "reads the tab-separated cache format used by previous versions"
+        df = pd.read_csv(
+            fname,
+            sep="\t",
+            index_col=None,
+            names=["query", "seq", "name", "score", "count"],
+        )
+        cache = {}
+        query_count = {}
+        for row in df.itertuples():
+            cache[row.query] = (row.name, row.seq, row.score)
+            query_count[row.query] = row.count
+
+        cls.logger.debug(f"converted {len(cache)} queries from tab-separated '{fname}'")
+        return cls.from_dict(cache, query_count, lmax)
+
+    def write(self, fname):
+        header = json.dumps(
+            dict(lmax=self.lmax, names=self.names, seqs=self.seqs)
+        ).encode("utf-8")
+        header += b"\0" * (-len(header) % 8)
+        # write to a temporary file first. Readers that have the old version
+        # memory-mapped keep seeing it until they re-open.
+        tmp = fname + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.magic)
+            f.write(np.array([len(self.keys), len(header)], dtype="<u8").tobytes())
+            f.write(header)
+            f.write(np.asarray(self.keys, dtype="<u8").tobytes())
+            f.write(np.asarray(self.refs, dtype="<i4").tobytes())
+            f.write(np.asarray(self.scores, dtype="<f4").tobytes())
+            f.write(np.asarray(self.counts, dtype="<f4").tobytes())
+
+        os.replace(tmp, fname)
+
+    def lookup(self, queries, lmax):
+        """
+        Vectorized lookup of a list of queries. Returns a list of
+        (name, seq, score) or None for queries that are not cached.
+        """
+        results = [None] * len(queries)
+        if not len(self.keys) or not len(queries):
+            return results
+
+        keys, valid = pack_2bit([q[:lmax] for q in queries])
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos >= len(self.keys)] = 0
+        found = valid & (self.keys[pos] == keys)
+        for i in found.nonzero()[0]:
+            j = pos[i]
+            ref = self.refs[j]
+            score = float(self.scores[j])
+            if ref < 0:
+                results[i] = (NO_CALL, NO_CALL, score)
+            else:
+                results[i] = (self.names[ref], self.seqs[ref], score)
 
-        i = scores.argmax()
-        ties = scores == scores[i]
-        return names_sel[ties], seqs_sel[ties], scores[ties]
+        return results
+
+    def get(self, query, lmax):
+        return self.lookup([query], lmax)[0]
+
+    @classmethod
+    def merge(cls, caches):
+        """
+        Merges caches into a new, sorted and compacted cache. Counts are
+        summed up for keys present in more than one of them.
+        """
+        names = []
+        seqs = []
+        ref_idx = {}
+        parts = []
+        lmax = None
+        for c in caches:
+            if c.lmax is not None:
+                lmax = c.lmax
+            remap = np.zeros(len(c.names) + 1, dtype=np.int32)
+            remap[-1] = -1  # refs == -1 index the last element
+            for i, (name, seq) in enumerate(zip(c.names, c.seqs)):
+                if name not in ref_idx:
+                    ref_idx[name] = len(names)
+                    names.append(name)
+                    seqs.append(seq)
+                remap[i] = ref_idx[name]
+
+            parts.append((c.keys, remap[c.refs], c.scores, c.counts))
+
+        if not parts:
+            return cls.empty()
+
+        keys, refs, scores, counts = [np.concatenate(x) for x in zip(*parts)]
+        return cls(keys, refs, scores, counts, names, seqs, lmax)._compact()
 
 
 class TieBreaker:
-    def __init__(self, fname, place="left"):
+    def __init__(self, fname, place="left", index_radius=-1):
         self.logger = logging.getLogger("TieBreaker")
         self.matcher = BarcodeMatcher(fname, place=place)
+        self.index = NeighborhoodIndex(self.matcher, radius=index_radius)
+        self.lmax = int(getattr(self.matcher, "lmax", 0))
         self.query_count = defaultdict(float)
         self.bc_count = defaultdict(float)
+        # new assignments of this process (delta w.r.t. the stored cache)
         self.cache = {}
+        self.stored = BarcodeCache.empty()
+        self.stored_hits = {}
+        self.prefetched = {}
         self.n_hit = 0
+        self.n_index = 0
         self.n_align = 0
 
+    @staticmethod
+    def resolve(names, seqs, scores):
+        if (len(names) == 1) or (len(set(names)) == 1):
+            # unambiguous best hit
+            return names[0], seqs[0], scores[0]
+        else:
+            # potentially do more involved resolving?
+            return (NO_CALL, NO_CALL, scores[0])
+
+    def prefetch(self, queries):
+        """
+        Looks up all distinct queries that are not in the index in the stored
+        cache, and aligns the ones that are not cached in one batch. The
+        results are picked up (and counted) by subsequent align() calls.
+        """
+        new = [
+            q
+            for q in dict.fromkeys(queries)
+            if not (
+                q in self.cache
+                or q in self.stored_hits
+                or q in self.prefetched
+                or self.index.get(q, self.lmax) is not None
+            )
+        ]
+        missing = []
+        for query, res in zip(new, self.stored.lookup(new, self.lmax)):
+            if res is None:
+                missing.append(query)
+            else:
+                self.stored_hits[query] = res
+
+        for query, res in zip(missing, self.matcher.align_batch(missing)):
+            self.prefetched[query] = self.resolve(*res)
+
     def align(self, query, debug=False, w=1):
         self.query_count[query] += w
-        if not query in self.cache:
-            self.n_align += w
+        indexed = self.index.get(query, self.lmax)
+        if indexed is not None and not debug:
+            self.n_index += w
+            result = indexed
+
+        elif query in self.cache:
+            self.n_hit += w
+            result = self.cache[query]
 
-            names, seqs, scores = self.matcher.align(query, debug)
-            if debug:
-                for n, s, S in zip(names, seqs, scores):
-                    print(f"{n}\t{s}\t{S}")
+        elif query in self.stored_hits or (
+            query not in self.prefetched
+            and self.stored.get(query, self.lmax) is not None
+        ):
+            self.n_hit += w
+            if query not in self.stored_hits:
+                self.stored_hits[query] = self.stored.get(query, self.lmax)
+            result = self.stored_hits[query]
 
-            if (len(names) == 1) or (len(set(names)) == 1):
-                # unambiguous best hit
-                result = names[0], seqs[0], scores[0]
+        else:
+            self.n_align += w
+
+            if query in self.prefetched and not debug:
+                result = self.prefetched.pop(query)
             else:
-                # potentially do more involved resolving?
-                result = (NO_CALL, NO_CALL, scores[0])
+                names, seqs, scores = self.matcher.align(query, debug)
+                if debug:
+                    for n, s, S in zip(names, seqs, scores):
+                        print(f"{n}\t{s}\t{S}")
 
-            self.cache[query] = result
+                result = self.resolve(names, seqs, scores)
 
-        else:
-            self.n_hit += w
-            result = self.cache[query]
+            self.cache[query] = result
 
         self.bc_count[result[0]] += w
         self.bc_count["total"] += w
@@ -207,31 +952,75 @@ class TieBreaker:
             return results[i], queries[i]
 
     def load_cache(self, fname):
-        self.logger.debug(f"pre-populating alignment cache from '{fname}'")
-        if fname:
-            try:
-                df = pd.read_csv(
-                    fname,
-                    sep="\t",
-                    index_col=None,
-                    names=["query", "seq", "name", "score", "count"],
+        self.logger.debug(f"opening stored alignment cache '{fname}'")
+        try:
+            stored = BarcodeCache.load(fname, self.lmax)
+        except (OSError, ValueError) as err:
+            self.logger.warning(f"error while loading caches: {err}")
+        else:
+            if stored.lmax not in (None, self.lmax):
+                self.logger.warning(
+                    f"ignoring '{fname}' which was made for references of length "
+                    f"up to {stored.lmax}, not {self.lmax}"
                 )
-            except OSError as err:
-                self.logger.warning(f"error while loading caches: {err}")
             else:
-                for row in df.itertuples():
-                    self.cache[row.query] = (row.name, row.seq, row.score)
+                self.stored = stored
+
+        self.logger.debug(f"{len(self.stored)} queries are available.")
 
-        self.logger.debug(f"loaded {len(self.cache)} queries.")
+    def cache_delta(self):
+        """
+        The assignments made by this process that are not in the stored
+        cache yet, with their observation counts since the last call.
+        Merging all deltas (BarcodeCache.merge) sums up the counts.
+        """
+        counts = self.query_count
+        self.query_count = defaultdict(float)
+        observed = {q: self.cache[q] for q in counts if q in self.cache}
+        return BarcodeCache.from_dict(observed, counts, self.lmax)
+
+    def stats_delta(self):
+        """
+        hit counts and counts of assigned barcodes since the last call
+        """
+        N = {"cache_hit": self.n_hit, "index_hit": self.n_index}
+        bc_count = self.bc_count
+        self.n_hit = 0
+        self.n_index = 0
+        self.bc_count = defaultdict(float)
+        return N, bc_count
 
 
-def store_cache(fname, cache, query_count, mincount=2):
-    with open(fname, "w") as f:
-        print(cache.keys())
-        for query in sorted(cache.keys()):
-            if query_count[query] >= mincount:
-                name, seq, score = cache[query]
-                f.write(f"{query}\t{seq}\t{name}\t{score}\t{query_count[query]}\n")
+def store_cache(fname, deltas, mincount=2):
+    """
+    Merges the new assignments from all workers, and adds those which were
+    observed at least mincount times to the stored cache in <fname>.
+    """
+    logger = logging.getLogger("store_cache")
+    delta = BarcodeCache.merge(deltas)
+    keep = delta.counts >= mincount
+    delta = BarcodeCache(
+        delta.keys[keep],
+        delta.refs[keep],
+        delta.scores[keep],
+        delta.counts[keep],
+        delta.names,
+        delta.seqs,
+        delta.lmax,
+    )
+    try:
+        stored = BarcodeCache.load(fname, delta.lmax)
+    except ValueError as err:
+        # e.g. written by a newer version. Do not overwrite it
+        logger.warning(f"not updating the barcode cache: {err}")
+        return
+
+    merged = BarcodeCache.merge([stored, delta])
+    merged.write(fname)
+    logger.info(
+        f"added {len(merged) - len(stored)} new assignments to '{fname}', "
+        f"which now holds {len(merged)}"
+    )
 
 
 def report_stats(N, prefix=""):
@@ -239,16 +1028,23 @@ def report_stats(N, prefix=""):
         logging.info(f"{prefix}{k}\t{v}\t{100.0 * v/N['total']:.2f}")
 
 
-def match_BC1(bc1_matcher, seq, qstart, tstart, N, debug=False, threshold=0.5):
+def BC1_choices(seq, qstart, tstart):
     if tstart == 0:  # the start of opseq primer is intact
-        bc1 = seq[qstart - 8 : qstart]
-        BC1, ref1, score1 = bc1_matcher.align(bc1, debug=debug)
+        return [seq[qstart - 8 : qstart]]
     else:
         # we have a possible deletion, or mutation. Check both options
-        bc1_choices = [
+        return [
             seq[qstart - 8 : qstart],
             seq[qstart - tstart - 8 : qstart - tstart],
         ]  # deletion  # mutation
+
+
+def match_BC1(bc1_matcher, seq, qstart, tstart, N, debug=False, threshold=0.5):
+    bc1_choices = BC1_choices(seq, qstart, tstart)
+    if len(bc1_choices) == 1:
+        bc1 = bc1_choices[0]
+        BC1, ref1, score1 = bc1_matcher.align(bc1, debug=debug)
+    else:
         (BC1, ref1, score1), bc1 = bc1_matcher.align_choices(bc1_choices)
 
     N[f"BC1_score_{score1}"] += 1
@@ -290,354 +1086,478 @@ def match_BC2(bc2_matcher, seq, qend, tend, N, threshold=0.5):
     return bc2, BC2, ref2, score2
 
 
-def opseq_local_align(
-    seq,
-    opseq="GAATCACGATACGTACACCAGT",
+def check_opseq_alignment(
+    res,
     min_opseq_score=22,
     min_start=8,
     max_end=22 + 12,
     allow_start_gap=False,
     allow_end_gap=False,
 ):
-    results = pairwise2.align.localmd(
-        opseq, seq, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True, score_only=False
-    )
     tstart = 0
     tend = 0
-    if len(results) < 1:
+    if res is None:
+        return res, tstart, tend
+
+    qstart = res.start
+    qend = res.end
+    L = len(res.seqB)
+    # print(res)
+    # print(
+    #     f"flags {qstart < min_start} {qend > max_end} {res.score < min_opseq_score}"
+    # )
+    if (
+        (min_start and (qstart < min_start))
+        or (max_end and (qend > max_end))
+        or (res.score < min_opseq_score)
+    ):
         res = None
     else:
-        res = results[0]
-        qstart = res.start
-        qend = res.end
-        L = len(res.seqB)
-        # print(res)
-        # print(
-        #     f"flags {qstart < min_start} {qend > max_end} {res.score < min_opseq_score}"
-        # )
-        if (
-            (min_start and (qstart < min_start))
-            or (max_end and (qend > max_end))
-            or (res.score < min_opseq_score)
-        ):
-            res = None
-        else:
-            # check for start/end gaps
-            # backtrack from qstart in seqA until we hit '-'
-            if not allow_start_gap:
-                while res.seqA[qstart - tstart - 1] != "-":
-                    if qstart - tstart - 1 <= 0:
-                        tstart = -1
-                        res = None
-                        break
-                    tstart += 1
-
-            if res is not None and not allow_end_gap:
-                # and scan forward from qend until we hit '-'
-                while res.seqA[qend + tend] != "-":
-                    if qend + tend >= len(res.seqA) - 8:
-                        tend = -1
-                        res = None
-                        break
-                    tend += 1
+        # check for start/end gaps
+        # backtrack from qstart in seqA until we hit '-'
+        if not allow_start_gap:
+            while res.seqA[qstart - tstart - 1] != "-":
+                if qstart - tstart - 1 <= 0:
+                    tstart = -1
+                    res = None
+                    break
+                tstart += 1
+
+        if res is not None and not allow_end_gap:
+            # and scan forward from qend until we hit '-'
+            while res.seqA[qend + tend] != "-":
+                if qend + tend >= len(res.seqA) - 8:
+                    tend = -1
+                    res = None
+                    break
+                tend += 1
     # print("end results", res, tstart, tend)
     return res, tstart, tend
 
 
-def process_ordered_results(res_queue, args, Qerr, abort_flag):
-    with ExceptionLogging("collector", Qerr=Qerr, exc_flag=abort_flag) as el:
-        import heapq
-        import time
+# set to False once the private pairwise2 functions used by
+# pairwise2_local_align() turned out to be missing or incompatible
+PAIRWISE2_INTERNALS = True
 
-        heap = []
-        n_chunk_needed = 0
-        t0 = time.time()
-        t1 = t0
-        n_rec = 0
 
-        logger = el.logger
-        out = Output(args)
-
-        for n_chunk, results in queue_iter(res_queue, abort_flag):
-            heapq.heappush(heap, (n_chunk, results))
-
-            # as long as the root of the heap is the next needed chunk
-            # pass results on to storage
-            while heap and (heap[0][0] == n_chunk_needed):
-                n_chunk, results = heapq.heappop(heap)  # retrieves heap[0]
-                for assigned, record in results:
-                    # print("record in process_ordered_results", record)
-                    out.write(assigned, record)
-                    n_rec += 1
+def pairwise2_local_align(
+    seqA, seqB, match=2, mismatch=-1.5, gap_open=-3, gap_extend=-1
+):
+    """
+    Returns the same (list of one) alignment as
+
+        pairwise2.align.localmd(seqA, seqB, match, mismatch, gap_open,
+            gap_extend, gap_open, gap_extend, one_alignment_only=True)
+
+    but several times faster. pairwise2 spends most of its time scanning
+    the entire score matrix in Python for cells holding the best score
+    (_find_start). Here, the C matrix fill and the traceback of pairwise2
+    itself are used, only the scan for start cells is done row by row and
+    the start rules of _recover_alignments() are applied up front.
+    These are private functions of Biopython (written against 1.88). If
+    they are missing or their signatures have changed, localmd() is used
+    instead.
+    """
+    global PAIRWISE2_INTERNALS
+    if PAIRWISE2_INTERNALS:
+        try:
+            return _pairwise2_local_align(
+                seqA, seqB, match, mismatch, gap_open, gap_extend
+            )
+        except (ImportError, AttributeError, TypeError, ValueError) as err:
+            PAIRWISE2_INTERNALS = False
+            logging.getLogger("pairwise2_local_align").warning(
+                f"can not use the internals of this Biopython version ({err!r}). "
+                "Falling back to the slower pairwise2.align.localmd()"
+            )
 
-                n_chunk_needed += 1
+    from Bio import pairwise2
+
+    return pairwise2.align.localmd(
+        seqA,
+        seqB,
+        match,
+        mismatch,
+        gap_open,
+        gap_extend,
+        gap_open,
+        gap_extend,
+        one_alignment_only=True,
+    )
 
-            # debug output on average throughput
-            t2 = time.time()
-            if t2 - t1 > 30:
-                dT = t2 - t0
-                rate = n_rec / dT
-                logger.info(
-                    "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
-                        n_rec, dT, rate
-                    )
-                )
-                t1 = t2
 
-        out.close()
-        # by the time None pops from the queue, all chunks
-        # should have been processed!
-        if not abort_flag.value:
-            assert len(heap) == 0
-        else:
-            logger.warning(
-                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
+def _pairwise2_local_align(seqA, seqB, match, mismatch, gap_open, gap_extend):
+    from Bio.pairwise2 import (
+        _recover_alignments,
+        _reverse_matrices,
+        affine_penalty,
+        identity_match,
+    )
+    from Bio.cpairwise2 import _make_score_matrix_fast
+
+    if not seqA or not seqB:
+        return []
+
+    gap_fn = affine_penalty(gap_open, gap_extend, 0)
+    score_matrix, trace_matrix, best = _make_score_matrix_fast(
+        seqA,
+        seqB,
+        identity_match(match, mismatch),
+        gap_open,
+        gap_extend,
+        gap_open,
+        gap_extend,
+        0,
+        (False, False),
+        False,
+        False,
+    )
+    # same tolerance as pairwise2: rint(abs(score - best)) <= 0
+    starts = []
+    for row, scores in enumerate(score_matrix):
+        if max(scores) > best - 0.0005:
+            starts.extend(
+                [
+                    (score, (row, col))
+                    for col, score in enumerate(scores)
+                    if abs(score - best) < 0.0005
+                ]
             )
 
-        dT = time.time() - t0
-        logger.info(
-            "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
-                n_rec, dT, n_rec / dT
-            )
+    # local alignments neither start with a zero-score extension, nor
+    # with a score <= 0, nor end with a gap
+    keys = set(starts)
+    usable = []
+    for score, (row, col) in starts:
+        trace = trace_matrix[row][col]
+        if (
+            (score, (row - 1, col - 1)) not in keys
+            and score > 0
+            and (trace - trace % 2) % 4 == 2
+        ):
+            usable.append((score, (row, col)))
+
+    alignments = _recover_alignments(
+        seqA,
+        seqB,
+        usable,
+        best,
+        score_matrix,
+        trace_matrix,
+        False,
+        "-",
+        True,
+        gap_fn,
+        gap_fn,
+    )
+    if not alignments:
+        # the same workaround as in pairwise2._align()
+        score_matrix, trace_matrix = _reverse_matrices(score_matrix, trace_matrix)
+        starts = [(z, (y, x)) for z, (x, y) in starts]
+        alignments = _recover_alignments(
+            seqB,
+            seqA,
+            starts,
+            best,
+            score_matrix,
+            trace_matrix,
+            False,
+            "-",
+            True,
+            gap_fn,
+            gap_fn,
+            reverse=True,
         )
 
+    return alignments
+
 
-def process_fastq(Qfq, args, Qerr, abort_flag):
+def opseq_local_align(
+    seq,
+    opseq="GAATCACGATACGTACACCAGT",
+    min_opseq_score=22,
+    min_start=8,
+    max_end=22 + 12,
+    allow_start_gap=False,
+    allow_end_gap=False,
+):
+    results = pairwise2_local_align(opseq, seq, 2, -1.5, -3, -1)
+    res = results[0] if len(results) else None
+    return check_opseq_alignment(
+        res,
+        min_opseq_score=min_opseq_score,
+        min_start=min_start,
+        max_end=max_end,
+        allow_start_gap=allow_start_gap,
+        allow_end_gap=allow_end_gap,
+    )
+
+
+class LocalAlignment(
+    namedtuple("LocalAlignment", ["seqA", "seqB", "score", "start", "end"])
+):
     """
-    reads from two fastq files, groups the input into chunks for
-    faster parallel processing, and puts these on a mp.Queue()
+    Drop-in for the Bio.pairwise2 alignment records that opseq_local_align()
+    works with: full, gap-padded sequences and start/end of the aligned part
+    in alignment columns.
     """
-    with ExceptionLogging("dispatcher", Qerr=Qerr, exc_flag=abort_flag) as el:
-        for chunk in chunkify(read_source(args)):
-            logging.debug(f"placing {chunk[0]} {len(chunk[1])} in queue")
-            if put_or_abort(Qfq, chunk, abort_flag):
-                el.logger.warning("shutdown flag was raised!")
-                break
 
+    @classmethod
+    def from_parts(cls, seqA, seqB, score, a_start, a_end, b_start, b_end, alnA, alnB):
+        # unaligned prefixes are right-aligned, suffixes left-aligned,
+        # the same layout that pairwise2 uses for local alignments
+        pre = max(a_start, b_start)
+        post = max(len(seqA) - a_end, len(seqB) - b_end)
+        return cls(
+            seqA[:a_start].rjust(pre, "-") + alnA + seqA[a_end:].ljust(post, "-"),
+            seqB[:b_start].rjust(pre, "-") + alnB + seqB[b_end:].ljust(post, "-"),
+            score,
+            pre,
+            pre + len(alnA),
+        )
 
-def count_dict_sum(sources):
-    dst = defaultdict(float)
-    for src in sources:
-        for k, v in src.items():
-            dst[k] += v
-
-    return dst
 
+class OpseqDetector:
+    """
+    Tiered search for the opseq primer site in read 1:
 
-def dict_merge(sources):
-    dst = {}
-    for src in sources:
-        dst.update(src)
-    return dst
+        exact: the intact opseq occurs (once) as a substring
+        align: local alignment (opseq_local_align)
 
+    Both tiers feed into check_opseq_alignment() and return exactly the
+    (res, tstart, tend) that opseq_local_align() would, which match_BC1/
+    match_BC2 consume. Hits per tier are counted in self.N.
+    """
 
-def process_combinatorial(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"process_combinatorial starting up with Qfq={Qfq}, Qres={Qres} and args={args}"
-        )
-        bc1_matcher = TieBreaker(args.bc1_ref, place="left")
-        bc2_matcher = TieBreaker(args.bc2_ref, place="right")
-        bc1_matcher.load_cache(args.bc1_cache)
-        bc2_matcher.load_cache(args.bc2_cache)
+    def __init__(self, opseq="GAATCACGATACGTACACCAGT", **kw):
+        self.opseq = opseq
+        self.kw = kw
+        self.m = len(opseq)
+        self.N = defaultdict(int)
+
+    def align(self, seq):
+        pos = seq.find(self.opseq)
+        if pos >= 0 and seq.find(self.opseq, pos + 1) < 0:
+            self.N["opseq_exact"] += 1
+            res = LocalAlignment.from_parts(
+                self.opseq,
+                seq,
+                2.0 * self.m,
+                0,
+                self.m,
+                pos,
+                pos + self.m,
+                self.opseq,
+                self.opseq,
+            )
+            return check_opseq_alignment(res, **self.kw)
 
-        out = Output(args, open_files=False)
-        N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
-            el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
-            results = []
-            for fqid, r1, fqid2, r2, qual2 in reads:
-                N["total"] += 1
-                out_d = dict(qname=fqid, r1=r1, r2=r2, r2_qual=qual2, r2_qname=fqid2)
-                # fallback values for bc1/bc2 so that some BC diversity
-                # is maintained for debugging purposes in case we can not
-                # assign a decent & unambiguous match
-                # lower case bc is for original, uncorrected sequence
-                out_d["bc1"] = r1[:12]
-                out_d["bc2"] = r2[-12:]
-                # upper case BC is for assigned, corrected sequence
-                out_d["BC1"] = args.na
-                out_d["BC2"] = args.na
-
-                # align opseq sequence to seq of read1
-                aln = opseq_local_align(
-                    r1.rstrip(),
-                    opseq=args.opseq,
-                    min_opseq_score=args.min_opseq_score,
-                    allow_end_gap=True,  # TODO more permanent fix for this quick'n'dirty hack to get short illumina read to work
-                )
-                res, tstart, tend = aln
-                # print("OPSEQ", res, tstart, tend)
-                if res is None:
-                    N["opseq_broken"] += 1
-                    assigned = False
-                else:
-                    # identify barcodes
-                    bc1, BC1, ref1, score1 = match_BC1(
-                        bc1_matcher,
-                        res.seqB,
-                        res.start,
-                        tstart,
-                        N,
-                        threshold=args.threshold,
-                    )
-                    # bc2, BC2, ref2, score2 = match_BC2(
-                    #     bc2_matcher, res.seqB, res.end, tend, N, threshold=args.threshold
-                    # )
-                    bc2, BC2, ref2, score2 = "na", "NA", "na", -1
-
-                    # slo = sQSeq.lower()
-                    # sout = slo[:qstart] + sQSeq[qstart:qend] + slo[qend:]
-                    # print(sout, qstart, qend, tstart, tend, bc1, bc2)
-                    # print(f"bc1: {bc1} -> {ref1} -> {BC1} score={50.0*score1/len(bc1):.1f} %")
-                    # print(f"bc2: {bc2} -> {ref2} -> {BC2} score={50.0*score2/len(bc2):.1f} %")
-
-                    # best matching pieces of sequence
-                    out_d["bc1"] = bc1
-                    out_d["bc2"] = bc2
-                    # best attempt at assignment
-                    out_d["BC1"] = BC1
-                    out_d["BC2"] = BC2
-
-                    if BC1 != NO_CALL:  # and BC2 != NO_CALL:
-                        N["called"] += 1
-                        assigned = True
-                    else:
-                        assigned = False
-
-                out_d["assigned"] = assigned
-                rec = out.make_record(**out_d)
-                results.append((assigned, rec))
-
-            Qres.put((n_chunk, results))
-
-        N["BC1_cache_hit"] = bc1_matcher.n_hit
-        N["BC2_cache_hit"] = bc2_matcher.n_hit
-
-        # return our counts and observations
-        # via these list proxies
-        el.logger.debug("synchronizing cache and counts")
-        Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2 = stat_lists
-        Ns.append(N)
-        qcaches1.append(bc1_matcher.cache)
-        qcaches2.append(bc2_matcher.cache)
-        qcounts1.append(bc1_matcher.query_count)
-        qcounts2.append(bc2_matcher.query_count)
-        bccounts1.append(bc1_matcher.bc_count)
-        bccounts2.append(bc2_matcher.bc_count)
-
-
-def log_qerr(qerr):
-    "helper function for reporting errors in sub processes"
-    for name, lines in qerr:
-        for line in lines:
-            logging.error(f"subprocess {name} exception {line}")
+        self.N["opseq_align"] += 1
+        return opseq_local_align(seq, opseq=self.opseq, **self.kw)
 
 
-def main_combinatorial(args):
+class CombinatorialWorker:
+    """
+    Assigns combinatorial barcodes to the reads of a chunk (see read_chunks())
+    and returns the encoded output records (see Output.encode_chunk()).
+    Used as worker of a parallel.Pipeline.
+    """
 
-    # queues for communication between processes
-    Qfq = mp.Queue(
-        args.parallel * 5
-    )  # FASTQ reads from process_fastq->process_combinatorial
-    Qres = mp.Queue(
-        args.parallel * 25
-    )  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-    qcaches1 = manager.list()
-    qcaches2 = manager.list()
-    qcounts1 = manager.list()
-    qcounts2 = manager.list()
-    bccounts1 = manager.list()
-    bccounts2 = manager.list()
-    Ns = manager.list()
-    stat_lists = [Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2]
-
-    with ExceptionLogging("main_combinatorial", exc_flag=abort_flag) as el:
-
-        # read FASTQ in chunks and put them in Qfq
-        dispatcher = mp.Process(
-            target=process_fastq, name="dispatcher", args=(Qfq, args, Qerr, abort_flag)
+    def __init__(self, args):
+        self.args = args
+        self.logger = logging.getLogger("worker")
+        self.logger.debug(f"CombinatorialWorker starting up with args={args}")
+        self.bc1_matcher = TieBreaker(
+            args.bc1_ref, place="left", index_radius=args.bc1_index_radius
+        )
+        self.bc2_matcher = TieBreaker(
+            args.bc2_ref, place="right", index_radius=args.bc2_index_radius
+        )
+        self.bc1_matcher.load_cache(args.bc1_cache)
+        self.bc2_matcher.load_cache(args.bc2_cache)
+        self.opseq_detector = OpseqDetector(
+            args.opseq,
+            min_opseq_score=args.min_opseq_score,
+            allow_end_gap=True,  # TODO more permanent fix for this quick'n'dirty hack to get short illumina read to work
         )
 
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of FASTQ from Qfq,
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.parallel):
-            w = mp.Process(
-                target=process_combinatorial,
-                name=f"worker_{i}",
-                args=(Qfq, Qres, args, Qerr, abort_flag, stat_lists),
-            )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag),
+        self.out = Output(args, open_files=False)
+        self.N = defaultdict(int)
+
+    def __call__(self, chunk):
+        args = self.args
+        N = self.N
+        bc1_matcher = self.bc1_matcher
+        reads = unpack_reads(chunk)
+        self.logger.debug(f"received chunk of {len(reads)} reads")
+        # align opseq sequence to seq of read1 for the whole chunk first.
+        # This way, all BC1 candidates of the chunk can be scored against
+        # the reference barcodes in one batch.
+        alns = [
+            self.opseq_detector.align(r1.rstrip())
+            for fqid, r1, fqid2, r2, qual2 in reads
+        ]
+        bc1_matcher.prefetch(
+            [
+                bc1
+                for res, tstart, tend in alns
+                if res is not None
+                for bc1 in BC1_choices(res.seqB, res.start, tstart)
+            ]
         )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qfq, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.parallel):
-            Qfq.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
+
+        cols = defaultdict(list)
+        for (fqid, r1, fqid2, r2, qual2), aln in zip(reads, alns):
+            N["total"] += 1
+            # fallback values for bc1/bc2 so that some BC diversity
+            # is maintained for debugging purposes in case we can not
+            # assign a decent & unambiguous match
+            # lower case bc is for original, uncorrected sequence
+            bc1 = r1[:12]
+            bc2 = r2[-12:]
+            # upper case BC is for assigned, corrected sequence
+            BC1 = args.na
+            BC2 = args.na
+
+            res, tstart, tend = aln
+            # print("OPSEQ", res, tstart, tend)
+            if res is None:
+                N["opseq_broken"] += 1
+                assigned = False
+            else:
+                # identify barcodes
+                bc1, BC1, ref1, score1 = match_BC1(
+                    bc1_matcher,
+                    res.seqB,
+                    res.start,
+                    tstart,
+                    N,
+                    threshold=args.threshold,
+                )
+                # bc2, BC2, ref2, score2 = match_BC2(
+                #     bc2_matcher, res.seqB, res.end, tend, N, threshold=args.threshold
+                # )
+                bc2, BC2, ref2, score2 = "na", "NA", "na", -1
+
+                # slo = sQSeq.lower()
+                # sout = slo[:qstart] + sQSeq[qstart:qend] + slo[qend:]
+                # print(sout, qstart, qend, tstart, tend, bc1, bc2)
+                # print(f"bc1: {bc1} -> {ref1} -> {BC1} score={50.0*score1/len(bc1):.1f} %")
+                # print(f"bc2: {bc2} -> {ref2} -> {BC2} score={50.0*score2/len(bc2):.1f} %")
+
+                if BC1 != NO_CALL:  # and BC2 != NO_CALL:
+                    N["called"] += 1
+                    assigned = True
+                else:
+                    assigned = False
+
+            # best matching pieces of sequence and best attempt at assignment
+            cols["bc1"].append(bc1)
+            cols["bc2"].append(bc2)
+            cols["BC1"].append(BC1)
+            cols["BC2"].append(BC2)
+            cols["assigned"].append(assigned)
+
+        qname, r1, r2_qname, r2, r2_qual = zip(*reads)
+        results = self.out.make_records(
+            cols.pop("assigned"),
+            qname=qname,
+            r1=r1,
+            r2=r2,
+            r2_qual=r2_qual,
+            r2_qname=r2_qname,
+            **cols,
         )
-        # signal the collector to stop
-        Qres.put(None)
+        return self.out.encode_chunk(results)
+
+    def stats(self):
+        """
+        our counts and observations since the last call, to be merged with
+        those of the other workers (see parallel.merge_stats)
+        """
+        N = self.N
+        self.N = defaultdict(int)
+        N.update(self.opseq_detector.N)
+        self.opseq_detector.N = defaultdict(int)
+        N.update(self.out.pop_counts())
+
+        stats = dict(N=N)
+        for i, matcher in [(1, self.bc1_matcher), (2, self.bc2_matcher)]:
+            hits, stats[f"bc_count{i}"] = matcher.stats_delta()
+            for k, v in hits.items():
+                N[f"BC{i}_{k}"] = v
+
+            if self.args.update_cache:
+                stats[f"cache{i}"] = matcher.cache_delta()
+
+        stats["hist_counts"] = self.out.hist_cb_counts
+        self.out.hist_cb_counts = BarcodeCounter()
+        stats["trim"] = self.out.pop_trim_stats()
+        return stats
+
+
+def pipeline_io(args):
+    """
+    returns the Output, the read_chunks() source and the Checkpoint (or
+    None) for a parallel run. With --checkpoint, the output is collected in
+    the checkpoint directory and the source skips the reads that an
+    earlier run has already committed there.
+    """
+    if not args.checkpoint:
+        return Output(args), partial(read_chunks, args, n_chunk=args.n_chunk), None
+
+    out = Output(args, open_files=False)
+    checkpoint = out.open_checkpoint(args)
+    source = partial(read_chunks, args, n_chunk=args.n_chunk, skip=checkpoint.n_items)
+    return out, source, checkpoint
 
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
 
-        N = count_dict_sum(Ns)
+def main_combinatorial(args):
+    with ExceptionLogging("main_combinatorial") as el:
+        out, source, checkpoint = pipeline_io(args)
+        # dispatcher reads FASTQ in chunks, workers assign the barcodes
+        # and encode the output records, which we write in order.
+        stats = Pipeline(
+            source,
+            partial(CombinatorialWorker, args),
+            out.write_chunk,
+            n_workers=args.parallel,
+            max_bytes=int(args.max_mb_in_flight * 2**20),
+            monitor_file=args.monitor_file,
+            monitor_interval=args.monitor_interval,
+            checkpoint=checkpoint,
+        ).run()
+        out.close()
+        el.logger.info("Pipeline has finished. Merging worker statistics.")
+
+        N = stats["N"]
         if N["total"]:
             el.logger.info(
                 f"Run completed. Overall combinatorial barcode assignment "
                 f"rate was {100.0 * N['called']/N['total']}"
             )
+            for tier in ["exact", "align"]:
+                el.logger.info(
+                    f"opseq detection tier '{tier}' handled "
+                    f"{100.0 * N['opseq_' + tier]/N['total']:.2f}% of reads"
+                )
         else:
             el.logger.error("No reads were processed!")
 
         if args.update_cache:
-            qcount1 = count_dict_sum(qcounts1)
-            qcount2 = count_dict_sum(qcounts2)
-            cache1 = dict_merge(qcaches1)
-            cache2 = dict_merge(qcaches2)
-            store_cache(args.bc1_cache, cache1, qcount1)
-            store_cache(args.bc2_cache, cache2, qcount2)
+            if args.bc1_cache:
+                store_cache(args.bc1_cache, [stats["cache1"]])
+            if args.bc2_cache:
+                store_cache(args.bc2_cache, [stats["cache2"]])
+
+        if args.save_barcode_histogram:
+            save_barcode_histogram(
+                args.save_barcode_histogram, stats["hist_counts"], args
+            )
 
         if args.save_stats:
-            bccount1 = count_dict_sum(bccounts1)
-            bccount2 = count_dict_sum(bccounts2)
+            bccount1 = stats["bc_count1"]
+            bccount2 = stats["bc_count2"]
             with open(args.save_stats, "w") as f:
                 for k, v in sorted(N.items()):
                     f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
@@ -652,173 +1572,548 @@ def main_combinatorial(args):
                         f"BC2\t{k}\t{v}\t{100.0 * v/max(bccount2['total'], 1):.2f}\n"
                     )
 
+        if args.trim:
+            save_trim_stats(args, stats.get("trim", {}))
 
-def process_dropseq(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"process_dropseq starting up with Qfq={Qfq}, Qres={Qres} and args={args}"
+
+class DropseqWorker:
+    """
+    Extracts cell barcode and UMI from the reads of a chunk and returns the
+    encoded output records. Used as worker of a parallel.Pipeline.
+    """
+
+    def __init__(self, args):
+        self.out = Output(args, open_files=False)
+        self.N = defaultdict(int)
+
+    def __call__(self, chunk):
+        qname, r1, r2_qname, r2, r2_qual = unpack_columns(chunk)
+        self.N["total"] += len(qname)
+        results = self.out.make_records(
+            [True] * len(qname),
+            qname=qname,
+            r1=r1,
+            r2=r2,
+            r2_qual=r2_qual,
+            r2_qname=r2_qname,
         )
-        out = Output(args, open_files=False)
-        N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
-            el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
-            results = []
-            for fqid, r1, fqid2, r2, qual2 in reads:
-                N["total"] += 1
-                rec = out.make_record(
-                    assigned=True,
-                    qname=fqid,
-                    r1=r1,
-                    r2=r2,
-                    r2_qual=qual2,
-                    r2_qname=fqid2,
-                )
-                results.append((True, rec))
+        return self.out.encode_chunk(results)
+
+    def stats(self):
+        "counts since the last call (see parallel.merge_stats)"
+        self.N.update(self.out.pop_counts())
+        stats = dict(
+            N=self.N,
+            cb_counts=self.out.raw_cb_counts,
+            hist_counts=self.out.hist_cb_counts,
+            trim=self.out.pop_trim_stats(),
+        )
+        self.N = defaultdict(int)
+        self.out.raw_cb_counts = BarcodeCounter()
+        self.out.hist_cb_counts = BarcodeCounter()
+        return stats
 
-            Qres.put((n_chunk, results))
 
-        # return our counts and observations
-        # via these list proxies
-        el.logger.debug("synchronizing cache and counts")
-        Ns = stat_lists[0]
-        Ns.append(N)
+def save_cell_barcodes(fname, counter):
+    "writes raw cell barcode counts from a BarcodeCounter"
+    import gzip
 
-        cb_counts = stat_lists[1]
-        cb_counts.append(out.raw_cb_counts)
+    logging.getLogger("save_cell_barcodes").info(
+        f"writing {len(counter)} barcode counts to '{fname}'"
+    )
+    with gzip.open(fname, "wt") as f:
+        f.write("cell_bc\traw_read_count\n")
+        for bc, count in counter.items():
+            f.write(f"{bc}\t{count}\n")
 
 
-def main_dropseq(args):
-    # queues for communication between processes
-    Qfq = mp.Queue(
-        args.parallel * 5
-    )  # FASTQ reads from process_fastq->process_combinatorial
-    Qres = mp.Queue(
-        args.parallel * 25
-    )  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-    Ns = manager.list()
-    cb_counts = manager.list()
-    stat_lists = [Ns, cb_counts]
-
-    with ExceptionLogging("main_dropseq", exc_flag=abort_flag) as el:
-
-        # read FASTQ in chunks and put them in Qfq
-        dispatcher = mp.Process(
-            target=process_fastq, name="dispatcher", args=(Qfq, args, Qerr, abort_flag)
+def save_barcode_histogram(fname, counter, args):
+    """
+    writes the read counts per cell barcode from a BarcodeCounter in the
+    format of Drop-seq tools' BamTagHistogram, as if it was run on the
+    --out-assigned BAM: one header line, then count and barcode, by
+    decreasing count (ties sorted by barcode).
+    """
+    import gzip
+
+    # the last tag holding {cell}, like get_bam_tag_names() in the workflow
+    tag = "CB"
+    for name, parts in TagWriter(args.bam_tags).tags:
+        if parts == [("cell",)]:
+            tag = name
+
+    items = counter.items()
+    items.sort(key=lambda x: -x[1])
+    logging.getLogger("save_barcode_histogram").info(
+        f"writing read counts of {len(items)} barcodes ({tag}) to '{fname}'"
+    )
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "wt") as f:
+        f.write(
+            f"#INPUT={args.out_assigned}\tTAG={tag}\t"
+            "FILTER_PCR_DUPLICATES=false\tREAD_QUALITY=0\n"
         )
+        f.write("".join([f"{count}\t{bc}\n" for bc, count in items]))
 
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of FASTQ from Qfq,
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.parallel):
-            w = mp.Process(
-                target=process_dropseq,
-                name=f"worker_{i}",
-                args=(Qfq, Qres, args, Qerr, abort_flag, stat_lists),
-            )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag),
-        )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qfq, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.parallel):
-            Qfq.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
-        )
-        # signal the collector to stop
-        Qres.put(None)
 
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
+def save_stats(fname, N):
+    with open(fname, "w") as f:
+        for k, v in sorted(N.items()):
+            f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
+
+
+def save_trim_stats(args, stats):
+    """
+    writes the --save-trim-stats table and the --start-report and
+    --polyA-report of --trim, from the merged counts of the Trimmers
+    """
+    from spacemake.cutadapt_bam import write_reports
+
+    write_reports(
+        args.save_trim_stats,
+        args,
+        defaultdict(int, stats.get("stats", {})),
+        defaultdict(int, stats.get("total", {})),
+        stats.get("lhist", {}),
+        stats.get("trim_hists", dict(start={}, polyA={})),
+    )
+
 
-        N = count_dict_sum(Ns)
+def main_dropseq(args):
+    with ExceptionLogging("main_dropseq") as el:
+        out, source, checkpoint = pipeline_io(args)
+        stats = Pipeline(
+            source,
+            partial(DropseqWorker, args),
+            out.write_chunk,
+            n_workers=args.parallel,
+            max_bytes=int(args.max_mb_in_flight * 2**20),
+            monitor_file=args.monitor_file,
+            monitor_interval=args.monitor_interval,
+            checkpoint=checkpoint,
+        ).run()
+        out.close()
+        el.logger.info("Pipeline has finished. Merging worker statistics.")
+
+        N = stats["N"]
         if N["total"]:
             el.logger.info(f"Run completed, {N['total']} reads processed.")
         else:
             el.logger.error("No reads were processed!")
         # el.logger.debug(print(str(N.keys())[:200]))
-        cb_count = count_dict_sum(cb_counts)
         if args.save_cell_barcodes:
+            save_cell_barcodes(
+                args.save_cell_barcodes,
+                stats["cb_counts"],
+            )
+
+        if args.save_barcode_histogram:
+            save_barcode_histogram(
+                args.save_barcode_histogram, stats["hist_counts"], args
+            )
+
+        if args.save_stats:
+            save_stats(args.save_stats, N)
+
+        if args.trim:
+            save_trim_stats(args, stats.get("trim", {}))
+
+    return N
+
+
+def main_dropseq_streaming(args, n_chunk=20000):
+    """
+    Single-process path for barcode flavors that only slice the reads (no
+    BC1/BC2 references). Reads are processed in large chunks with the
+    column-wise Output methods, and written directly. Compression of one
+    chunk runs in background threads while the next chunk is prepared,
+    using max(--parallel, --threads-write) compression threads.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ExceptionLogging("main_dropseq_streaming") as el:
+        out = Output(args)
+        out.threads_write = max(args.parallel, args.threads_write)
+        N = defaultdict(int)
+
+        def write(results):
+            out.write_chunk(out.encode_chunk(results))
+
+        t0 = time.time()
+        t1 = t0
+        writer = ThreadPoolExecutor(max_workers=1)
+        pending = deque()
+        for chunk in read_chunks(args, n_chunk=n_chunk):
+            qname, r1, r2_qname, r2, r2_qual = unpack_columns(chunk)
+            N["total"] += len(qname)
+            results = out.make_records(
+                [True] * len(qname),
+                qname=qname,
+                r1=r1,
+                r2=r2,
+                r2_qual=r2_qual,
+                r2_qname=r2_qname,
+            )
+            pending.append(writer.submit(write, results))
+            # at most one chunk waiting for compression, one being compressed
+            while len(pending) > 2:
+                pending.popleft().result()
+
+            t2 = time.time()
+            if t2 - t1 > 30:
+                dT = t2 - t0
+                el.logger.info(
+                    f"processed {N['total']} reads in {dT:.0f} seconds "
+                    f"(average {N['total'] / dT:.0f} reads/second)."
+                )
+                t1 = t2
+
+        for f in pending:
+            f.result()
+
+        writer.shutdown()
+        out.close()
+        N.update(out.pop_counts())
+
+        dT = time.time() - t0
+        if N["total"]:
             el.logger.info(
-                f"writing {len(cb_count)} barcode counts to '{args.save_cell_barcodes}'"
+                f"Run completed, {N['total']} reads processed in {dT:.1f} seconds "
+                f"(average {N['total'] / dT:.0f} reads/second)."
             )
-            import gzip
+        else:
+            el.logger.error("No reads were processed!")
+
+        if args.save_cell_barcodes:
+            save_cell_barcodes(args.save_cell_barcodes, out.raw_cb_counts)
 
-            with gzip.open(args.save_cell_barcodes, "wt") as f:
-                f.write("cell_bc\traw_read_count\n")
-                for bc, count in sorted(cb_count.items()):
-                    f.write(f"{bc}\t{count}\n")
+        if args.save_barcode_histogram:
+            save_barcode_histogram(
+                args.save_barcode_histogram, out.hist_cb_counts, args
+            )
 
         if args.save_stats:
-            with open(args.save_stats, "w") as f:
-                for k, v in sorted(N.items()):
-                    f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
+            save_stats(args.save_stats, N)
+
+        if args.trim:
+            save_trim_stats(args, out.pop_trim_stats())
 
     return N
 
 
+# Python < 3.8 parses literals into Str/Num/NameConstant instead of
+# Constant nodes. Maps node type -> attribute holding the value.
+if sys.version_info < (3, 8):
+    AST_LITERALS = {ast.Str: "s", ast.Num: "n", ast.NameConstant: "value"}
+else:
+    AST_LITERALS = {ast.Constant: "value"}
+
+NOT_A_LITERAL = object()
+
+
+def ast_literal(node):
+    "value of a literal AST node, or NOT_A_LITERAL"
+    attr = AST_LITERALS.get(type(node), None)
+    if attr is None:
+        return NOT_A_LITERAL
+
+    return getattr(node, attr)
+
+
+class FlavorExpression:
+    """
+    Compiled form of a barcode flavor expression, such as the arguments to
+    --cell, --cell-raw or --UMI. Expressions are parsed once into a list of
+    parts, each either a literal string or a variable (r1, r2, bc1, BC1, ...)
+    followed by a chain of slices/indices. Supported are slicing with
+    constant bounds and steps (including reversal, e.g. 'r1[8:20][::-1]'),
+    concatenation with '+', string literals and 'None'. Anything else is
+    rejected with a ValueError, so no code is ever evaluated.
+    """
+
+    variables = ("r1", "r2", "bc1", "bc2", "BC1", "BC2", "qname", "r2_qname", "r2_qual")
+
+    def __init__(self, expr, name="expression"):
+        self.expr = expr
+        self.name = name
+        try:
+            tree = ast.parse(expr.strip(), mode="eval")
+        except SyntaxError as err:
+            raise ValueError(f"can not parse {name} expression '{expr}': {err}")
+
+        if ast_literal(tree.body) is None:
+            self.parts = None
+        else:
+            self.parts = self._parse_concat(tree.body)
+
+    def _error(self, node, msg="unsupported construct"):
+        if isinstance(node, ast.Name):
+            what = node.id
+        elif ast_literal(node) is not NOT_A_LITERAL:
+            what = repr(ast_literal(node))
+        else:
+            what = ast.dump(node)
+
+        return ValueError(f"{msg} '{what}' in {self.name} expression '{self.expr}'")
+
+    def _parse_concat(self, node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return self._parse_concat(node.left) + self._parse_concat(node.right)
+
+        if isinstance(ast_literal(node), str):
+            return [ast_literal(node)]
+
+        slices = []
+        while isinstance(node, ast.Subscript):
+            slices.insert(0, self._parse_slice(node.slice))
+            node = node.value
+
+        if not isinstance(node, ast.Name):
+            raise self._error(node)
+
+        if node.id not in self.variables:
+            raise self._error(node, "unknown variable")
+
+        return [(node.id, tuple(slices))]
+
+    def _parse_int(self, node):
+        if node is None:
+            return None
+
+        if (
+            isinstance(node, ast.UnaryOp)
+            and isinstance(node.op, ast.USub)
+            and ast_literal(node.operand) is not NOT_A_LITERAL
+        ):
+            node = node.operand
+            sign = -1
+        else:
+            sign = 1
+
+        if type(ast_literal(node)) is int:
+            return sign * ast_literal(node)
+
+        raise self._error(node, "expected an integer constant but found")
+
+    def _parse_slice(self, node):
+        if sys.version_info < (3, 9) and isinstance(node, ast.Index):
+            # Python < 3.9 wraps plain subscripts into Index nodes
+            node = node.value
+
+        if isinstance(node, ast.Slice):
+            return slice(
+                self._parse_int(node.lower),
+                self._parse_int(node.upper),
+                self._parse_int(node.step),
+            )
+        else:
+            return self._parse_int(node)
+
+    @property
+    def requires(self):
+        "names of the variables the expression refers to"
+        if self.parts is None:
+            return set()
+
+        return set([p[0] for p in self.parts if type(p) is tuple])
+
+    def __call__(self, **kw):
+        if self.parts is None:
+            return None
+
+        res = []
+        for part in self.parts:
+            if type(part) is tuple:
+                var, slices = part
+                x = kw[var]
+                for sl in slices:
+                    x = x[sl]
+                res.append(x)
+            else:
+                res.append(part)
+
+        return "".join(res)
+
+    def extract(self, columns, n):
+        """
+        evaluate the expression for a whole chunk of n reads at once.
+        columns maps variable names to sequences of n strings.
+        """
+        if self.parts is None:
+            return [None] * n
+
+        cols = []
+        for part in self.parts:
+            if type(part) is tuple:
+                var, slices = part
+                col = columns[var]
+                for sl in slices:
+                    col = [x[sl] for x in col]
+                cols.append(col)
+            else:
+                cols.append([part] * n)
+
+        if len(cols) == 1:
+            return list(cols[0])
+
+        return ["".join(xs) for xs in zip(*cols)]
+
+
+class TagWriter:
+    """
+    Pre-parsed version of the --bam-tags templates (e.g. 'CB:{cell},MI:{UMI}').
+    Each tag value is stored as a list of literal strings and field names so
+    that tag values for a whole chunk can be assembled without going through
+    str.format() for every read.
+    """
+
+    def __init__(self, bam_tags):
+        import string
+
+        self.tags = []
+        for tag in bam_tags.split(","):
+            name, templ = tag.split(":", 1)
+            parts = []
+            for literal, field, spec, conv in string.Formatter().parse(templ):
+                if literal:
+                    parts.append(literal)
+                if field is not None:
+                    if spec or conv or not field.isidentifier():
+                        raise ValueError(
+                            f"only plain '{{field}}' substitutions are supported in --bam-tags, not '{tag}'"
+                        )
+                    parts.append((field,))
+
+            self.tags.append((name, parts))
+
+    def __call__(self, **kw):
+        return [
+            (
+                name,
+                "".join(
+                    [str(kw[p[0]]) if type(p) is tuple else p for p in parts]
+                ),
+            )
+            for name, parts in self.tags
+        ]
+
+    def columns(self, columns, n):
+        "returns a list of (tag, values) with one value per read"
+        res = []
+        for name, parts in self.tags:
+            cols = []
+            for p in parts:
+                if type(p) is tuple:
+                    col = columns[p[0]]
+                    # only an expression such as cell_raw=None yields non-str
+                    if None in col:
+                        col = [str(x) for x in col]
+                    cols.append(col)
+                else:
+                    cols.append([p] * n)
+
+            if len(cols) == 1:
+                values = cols[0]
+            else:
+                values = ["".join(xs) for xs in zip(*cols)]
+
+            res.append((name, values))
+
+        return res
+
+
+def shard_fname(fname, shard):
+    "inserts the shard number before the file extension"
+    root, ext = os.path.splitext(fname)
+    return f"{root}.shard_{shard:03d}{ext}"
+
+
+def cell_shards(cells, n_shards):
+    "shard of each read, from a (stable) hash of its cell barcode"
+    return np.fromiter(
+        (zlib.crc32(cell.encode("ascii")) for cell in cells),
+        dtype=np.int64,
+        count=len(cells),
+    ) % n_shards
+
+
 class Output:
     def __init__(self, args, open_files=True):
-        assert Output.safety_check_eval(args.cell_raw)
-        assert Output.safety_check_eval(args.cell)
-        assert Output.safety_check_eval(args.UMI)
-        self.cell_raw = args.cell_raw
-        self.cell = args.cell
-        self.UMI = args.UMI
+        # parse the barcode flavor expressions once
+        self.cell_raw = FlavorExpression(args.cell_raw, "cell_raw")
+        self.cell = FlavorExpression(args.cell, "cell")
+        self.UMI = FlavorExpression(args.UMI, "UMI")
         self.na = args.na
-
-        # precompile functions for speed-up
-        self.f_cell_raw = compile(self.cell_raw, "<string cell_raw>", "eval")
-        self.f_cell = compile(self.cell, "<string cell>", "eval")
-        self.f_UMI = compile(self.UMI, "<string UMI>", "eval")
+        for expr in [self.cell, self.UMI]:
+            if expr.parts is None:
+                raise ValueError(f"{expr.name} expression must not be None")
 
         self.fq_qual = args.fq_qual
         self.bc_na = args.na
-        self.raw_cb_counts = defaultdict(int)
+        self.raw_cb_counts = BarcodeCounter()
         self.count_cb = bool(args.save_cell_barcodes)
+        # barcodes of the reads written to --out-assigned
+        self.hist_cb_counts = BarcodeCounter()
+        self.count_hist = bool(args.save_barcode_histogram)
+        # counts of our own, see pop_counts()
+        self.N = defaultdict(int)
+
+        bam_tags = args.bam_tags
+        # loaded on first use, so only where records are made
+        self.whitelist_files = args.whitelist
+        self.whitelist_mismatches = args.whitelist_mismatches
+        self.whitelist = None
+        if args.whitelist and args.whitelist_tag:
+            bam_tags += f",{args.whitelist_tag}:{{whitelist}}"
+
+        self.tags = TagWriter(bam_tags)
+        # read2 trimming (see trim_reads()). The adapters are built on first
+        # use, so only where records are made
+        self.trim_args = args if args.trim else None
+        self.trimmer = None
+
+        # records are encoded (and compressed) by the workers, the
+        # collector only writes the resulting bytes in chunk order.
+        self.level = args.compression_level
+        # thread pool for compression, created on first use, so that it
+        # lives in the worker process
+        self.pool = None
+        self.threads_write = args.threads_write
+        self.split_output = args.out_unassigned != args.out_assigned
+        self.streams = ["assigned", "unassigned"] if self.split_output else ["assigned"]
+        if args.out_off_whitelist:
+            self.streams.append("off_whitelist")
+
+        self.n_shards = max(args.shards, 1)
+        self.shard_by = args.shard_by
+        self.shard_manifest = args.shard_manifest
+        if self.n_shards > 1 and not self.shard_manifest:
+            self.shard_manifest = os.path.splitext(args.out_assigned)[0] + ".shards.tsv"
+
+        # output file names by stream name (with shard number if sharded),
+        # in the order of the blocks returned by encode_chunk()
+        fnames = {
+            "assigned": args.out_assigned,
+            "unassigned": args.out_unassigned,
+            "off_whitelist": args.out_off_whitelist,
+        }
+        self.outputs = {}
+        for shard in range(self.n_shards):
+            for stream in self.streams:
+                if self.n_shards > 1:
+                    self.outputs[f"{stream}.{shard:03d}"] = shard_fname(
+                        fnames[stream], shard
+                    )
+                else:
+                    self.outputs[stream] = fnames[stream]
 
-        self.tags = []
-        for tag in args.bam_tags.split(","):
-            self.tags.append(tag.split(":"))
-
+        self.n_chunks = 0
+        self.checkpoint = None
         if args.out_format == "fastq":
-            fopen = lambda x: open(x, "w")
-            self._write_record = self.write_fastq
-            self._make_record = self.make_fastq_record
+            fopen = lambda x: open(x, "wb")
+            self._make_records = self.make_fastq_records
+            self._encode = self.encode_fastq
 
         elif args.out_format == "bam":
             prog = os.path.basename(__file__)
@@ -838,62 +2133,265 @@ class Output:
                 ],
             }
             self.bam_header = pysam.AlignmentHeader.from_dict(header)
-            fopen = lambda x: pysam.AlignmentFile(x, "wbu", header=header)
-            self._write_record = self.write_bam
-            self._make_record = self.make_bam_record
+            fopen = lambda x: BAMWriter(x, self.bam_header, level=self.level)
+            self._make_records = self.make_bam_records
+            self._encode = self.encode_bam
         else:
             raise ValueError(f"unsopported output format '{args.out_format}'")
 
         if open_files:
-            self.out_assigned = fopen(args.out_assigned)
-            if args.out_unassigned != args.out_assigned:
-                self.out_unassigned = fopen(args.out_unassigned)
-            else:
-                self.out_unassigned = self.out_assigned
+            self.files = [fopen(fname) for fname in self.outputs.values()]
+
+    def open_checkpoint(self, args):
+        """
+        directs the output into a parallel.Checkpoint in args.checkpoint
+        (instead of opening the output files). close() then assembles the
+        output files. Returns the checkpoint.
+        """
+        head = b""
+        self.tail = b""
+        if args.out_format == "bam":
+            head = bgzf_compress(header_bytes(self.bam_header), level=self.level)
+            self.tail = BGZF_EOF
+
+        self.checkpoint = Checkpoint(
+            args.checkpoint,
+            self.outputs.keys(),
+            Checkpoint.make_signature(
+                args,
+                inputs=[
+                    args.read1,
+                    args.read2,
+                    args.bc1_ref,
+                    args.bc2_ref,
+                    args.bc1_cache,
+                    args.bc2_cache,
+                    args.adapters_right,
+                    args.adapters_left,
+                ]
+                + args.whitelist,
+                ignore=CHECKPOINT_IGNORE,
+            ),
+            heads={stream: head for stream in self.outputs},
+            resume=args.resume,
+            interval=args.checkpoint_interval,
+        )
+        self.files = [self.checkpoint.stream(stream) for stream in self.outputs]
+        # round-robin sharding continues where the checkpoint left off
+        self.n_chunks = self.checkpoint.n_chunks
+        return self.checkpoint
+
+    def make_bam_records(self, columns, n):
+        # STAR does not like spaces in read names so we have to cut them
+        qnames = "\n".join(columns["r2_qname"])
+        if " " in qnames or "\t" in qnames:
+            qnames = re.sub(r"[ \t][^\n]*", "", qnames)
+
+        return encode_unmapped(
+            qnames.split("\n"),
+            columns["r2"],
+            columns["r2_qual"],
+            self.tags.columns(columns, n) + columns.get("trim_tags", []),
+        )
 
-    @staticmethod
-    def safety_check_eval(s, danger="();."):
-        chars = set(list(s))
-        if chars & set(list(danger)):
-            return False
-        else:
-            return True
-
-    def make_bam_record(self, **kw):
-        # sys.stderr.write(f"r2_qual={r2_qual}\n")
-        a = pysam.AlignedSegment(self.bam_header)
-        # STAR does not like spaces in read names so we have to split
-        a.query_name = kw["r2_qname"].split()[0]
-        a.query_sequence = kw["r2"]
-        a.flag = 4
-        a.query_qualities = pysam.qualitystring_to_array(kw["r2_qual"])
-        a.tags = [(name, templ.format(**kw)) for name, templ in self.tags]
+    def make_fastq_records(self, columns, n):
+        records = [
+            f"@{qname}\n{cell}{UMI}\n+\n{self.fq_qual * (len(cell) + len(UMI))}\n"
+            for qname, cell, UMI in zip(
+                columns["qname"], columns["cell"], columns["UMI"]
+            )
+        ]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(list(map(len, records)), out=offsets[1:])
+        return "".join(records).encode("ascii"), offsets
+
+    def make_records(self, assigned, **columns):
+        """
+        Creates the output records for a chunk of reads. Takes one list per
+        field (qname, r1, r2, r2_qual, r2_qname and optionally bc1, bc2, BC1,
+        BC2) and a list of assigned flags. Returns
+        (n_reads, streams, buffer, offsets, shards) with all records
+        concatenated in buffer, record i occupying
+        buffer[offsets[i]:offsets[i+1]]. n_reads is the number of reads in
+        the chunk, streams holds the output stream of each record (see
+        record_streams()) and shards the shard of each record if the output
+        is sharded by cell barcode, otherwise it is None. With --trim, reads
+        that are too short after trimming (see trim_reads()) get no record,
+        so there can be fewer records than n_reads.
+        """
+        n = len(assigned)
+        n_reads = n
+        for BC in ["BC1", "BC2"]:
+            if BC not in columns:
+                columns[BC] = [self.na] * n
+
+        columns["raw"], columns["cell"], columns["UMI"] = self.format_chunk(
+            columns, n
+        )
+        columns["assigned"] = ["A" if a else "U" for a in assigned]
         if self.count_cb:
-            self.raw_cb_counts[kw["cell"]] += 1
-
-        return a.to_string()
+            self.raw_cb_counts.add(columns["cell"])
 
-    def make_fastq_record(self, **kw):
-        seq = kw["cell"] + kw["UMI"]
-        qual = self.fq_qual * len(seq)
-        return f"@{kw['qname']}\n{seq}\n+\n{qual}\n"
+        if self.trim_args:
+            assigned = self.trim_reads(columns, assigned)
+            n = len(assigned)
 
-    def make_record(self, assigned=True, **kw):
-        kw["raw"], kw["cell"], kw["UMI"] = self.format(**kw)
-        kw["assigned"] = "A" if assigned else "U"
-        return self._make_record(**kw)
-
-    def write_bam(self, out, rec):
-        out.write(pysam.AlignedSegment.fromstring(rec, self.bam_header))
+        on_whitelist = None
+        if self.whitelist_files:
+            if self.whitelist is None:
+                self.whitelist = BarcodeWhitelist(
+                    self.whitelist_files, max_mismatches=self.whitelist_mismatches
+                )
 
-    def write_fastq(self, out, rec):
-        out.write(rec)
+            on_whitelist = self.whitelist.query(columns["cell"])
+            columns["whitelist"] = np.array(["0", "1"])[on_whitelist.astype(int)].tolist()
+            n_on = int(on_whitelist.sum())
+            self.N["whitelist_on"] += n_on
+            self.N["whitelist_off"] += n - n_on
+
+        shards = None
+        if self.n_shards > 1 and self.shard_by == "cell":
+            shards = cell_shards(columns["cell"], self.n_shards)
+
+        streams = self.record_streams(assigned, on_whitelist)
+        if self.count_hist:
+            cells = columns["cell"]
+            if streams.any():
+                cells = [cells[i] for i in np.flatnonzero(streams == 0)]
+
+            self.hist_cb_counts.add(cells)
+
+        buf, offsets = self._make_records(columns, n)
+        return n_reads, streams, buf, offsets, shards
+
+    def trim_reads(self, columns, assigned):
+        """
+        Trims read2 of a chunk in place in columns, as cutadapt_bam would do
+        on the output BAM (see cutadapt_bam.Trimmer), and drops the reads
+        that become too short from all columns. The trimming tags are added
+        to columns as 'trim_tags'. Returns assigned for the remaining reads.
+        """
+        from spacemake.cutadapt_bam import Trimmer, load_adapters
+
+        args = self.trim_args
+        if self.trimmer is None:
+            self.trimmer = Trimmer(
+                args, load_adapters(args.adapters_right, args.adapters_left)
+            )
 
-    def write(self, assigned, record):
-        if assigned:
-            self._write_record(self.out_assigned, record)
-        else:
-            self._write_record(self.out_unassigned, record)
+        n = len(assigned)
+        r2 = columns["r2"]
+        r2_qual = columns["r2_qual"]
+        keep, starts, ends, tags = self.trimmer.trim(r2, r2_qual)
+        keep = keep.tolist()
+        if len(keep) < n:
+            for k, col in columns.items():
+                if col is not None and len(col) == n:
+                    columns[k] = [col[i] for i in keep]
+
+        bounds = list(zip(keep, starts, ends))
+        columns["r2"] = [r2[i][start:end] for i, start, end in bounds]
+        columns["r2_qual"] = [r2_qual[i][start:end] for i, start, end in bounds]
+        columns["trim_tags"] = tags
+        return [assigned[i] for i in keep]
+
+    def pop_trim_stats(self):
+        "trimming counts since the last call (see cutadapt_bam.Trimmer)"
+        if self.trimmer is None:
+            return {}
+
+        return self.trimmer.stats()
+
+    def record_streams(self, assigned, on_whitelist):
+        """
+        index into self.streams for each record. Unassigned reads go to their
+        own output if there is one, off-whitelist reads to theirs.
+        """
+        streams = np.zeros(len(assigned), dtype=np.int64)
+        unassigned = np.zeros(len(assigned), dtype=bool)
+        if self.split_output:
+            unassigned = ~np.array(assigned, dtype=bool)
+            streams[unassigned] = self.streams.index("unassigned")
+
+        if "off_whitelist" in self.streams:
+            streams[~on_whitelist & ~unassigned] = self.streams.index("off_whitelist")
+
+        return streams
+
+    def pop_counts(self):
+        "returns our counts (e.g. whitelist hits) since the last call"
+        N, self.N = self.N, defaultdict(int)
+        return N
+
+    def encode_bam(self, data):
+        if not data:
+            return b""
+
+        if self.pool is None:
+            self.pool = compression_pool(self.threads_write)
+
+        return bgzf_compress(data, level=self.level, pool=self.pool)
+
+    def encode_fastq(self, data):
+        return data
+
+    def encode_chunk(self, results):
+        """
+        Turns the records of a chunk (as returned by make_records()) into
+        ready-to-write bytes for each output file. This is done by the
+        workers. Returns (number of reads, blocks) with one block of bytes
+        per output stream (assigned and, if separate, unassigned and
+        off-whitelist) or, if sharded by cell barcode, per stream and shard.
+        The number of reads is that of the input chunk, not of the records,
+        as it tells a resumed checkpoint how many reads to skip.
+        """
+        n_reads, streams, buf, offsets, shards = results
+        n = len(streams)
+        n_streams = len(self.streams)
+        # index of the block that each record goes to
+        block = streams.copy()
+        blocks = [b""] * n_streams
+        if shards is not None:
+            block += shards * n_streams
+            blocks = [b""] * (n_streams * self.n_shards)
+
+        if not n:
+            return n_reads, blocks
+
+        if (block == block[0]).all():
+            blocks[block[0]] = self._encode(buf)
+            return n_reads, blocks
+
+        mask = np.repeat(block, np.diff(offsets))
+        data = np.frombuffer(buf, dtype=np.uint8)
+        for i in np.unique(block):
+            blocks[i] = self._encode(data[mask == i].tobytes())
+
+        return n_reads, blocks
+
+    def write_chunk(self, data):
+        n, blocks = data
+        first = 0
+        if self.shard_by == "chunk":
+            # round-robin: the whole chunk goes to one shard
+            first = (self.n_chunks % self.n_shards) * len(self.streams)
+
+        self.n_chunks += 1
+        for f, block in zip(self.files[first:], blocks):
+            if block:
+                f.write(block)
+
+        return n
+
+    def write_shard_manifest(self):
+        "tab-separated table of the shards and their output files"
+        cols = ["assigned", "unassigned"] + self.streams[1 + self.split_output :]
+        with open(self.shard_manifest, "w") as f:
+            f.write("\t".join(["shard"] + cols) + "\n")
+            for shard in range(self.n_shards):
+                a = self.outputs[f"assigned.{shard:03d}"]
+                fnames = [self.outputs.get(f"{c}.{shard:03d}", a) for c in cols]
+                f.write("\t".join([str(shard)] + fnames) + "\n")
 
     def format(
         self,
@@ -914,26 +2412,46 @@ class Output:
         if BC2 is None:
             BC2 = self.na
 
-        # slightly concerned about security here...
-        # at least all () and ; raise an assertion in __init__
-        cell = eval(self.f_cell)
-        raw = eval(self.f_cell_raw)
-        UMI = eval(self.f_UMI)
-        # cell = eval(self.cell)
-        # raw = eval(self.cell_raw)
-        # UMI = eval(self.UMI)
-
-        if (cell is None) or (UMI is None):
-            raise ValueError(
-                f"one of cell=eval('{self.cell}')='{cell}' "
-                f"UMI=eval('{self.UMI}')='{UMI}' evaluated to None"
-            )
+        kw = dict(
+            qname=qname,
+            r2_qname=r2_qname,
+            r2_qual=r2_qual,
+            bc1=bc1,
+            bc2=bc2,
+            BC1=BC1,
+            BC2=BC2,
+            r1=r1,
+            r2=r2,
+        )
+        return self.cell_raw(**kw), self.cell(**kw), self.UMI(**kw)
+
+    def format_chunk(self, columns, n):
+        "returns lists of raw, cell and UMI for a whole chunk of reads"
+        for expr in [self.cell_raw, self.cell, self.UMI]:
+            for var in expr.requires:
+                if columns.get(var, None) is None:
+                    raise ValueError(
+                        f"'{var}' is not available for {expr.name} expression '{expr.expr}'"
+                    )
 
-        return raw, cell, UMI
+        return (
+            self.cell_raw.extract(columns, n),
+            self.cell.extract(columns, n),
+            self.UMI.extract(columns, n),
+        )
 
     def close(self):
-        self.out_assigned.close()
-        self.out_unassigned.close()
+        for f in self.files:
+            f.close()
+
+        if self.checkpoint:
+            self.checkpoint.finalize(self.outputs, tail=self.tail)
+
+        if self.n_shards > 1:
+            self.write_shard_manifest()
+
+        if self.pool is not None:
+            self.pool.shutdown()
 
 
 # class Process(mp.Process):
@@ -1010,6 +2528,14 @@ def parse_args():
         default="",
         help="store (raw) cell barcode counts in this file. Numbers add up to number of total raw reads.",
     )
+    parser.add_argument(
+        "--save-barcode-histogram",
+        default="",
+        help=(
+            "store read counts per cell barcode of the reads in --out-assigned "
+            "in this file, in the format of Drop-seq tools' BamTagHistogram"
+        ),
+    )
     parser.add_argument(
         "--log-file",
         default="preprocessing_run.log",
@@ -1033,6 +2559,162 @@ def parse_args():
     parser.add_argument(
         "--parallel", default=1, type=int, help="how many processes to spawn"
     )
+    parser.add_argument(
+        "--streaming",
+        default=False,
+        action="store_true",
+        help=(
+            "process reads in a single process with large, vectorized chunks. "
+            "Only for barcode flavors without --bc1-ref/--bc2-ref. --parallel "
+            "then sets the number of compression threads"
+        ),
+    )
+    parser.add_argument(
+        "--monitor-file",
+        default="",
+        help=(
+            "write queue depths, throughput and idle time of reader, workers and "
+            "writer, and memory use of the parallel run to this file (JSON lines)"
+        ),
+    )
+    parser.add_argument(
+        "--monitor-interval",
+        default=5,
+        type=float,
+        help="seconds between samples for --monitor-file (default=5)",
+    )
+    parser.add_argument(
+        "--max-mb-in-flight",
+        default=128,
+        type=float,
+        help=(
+            "upper limit for the amount of input (in MB) that is on its way from "
+            "the reader to the output. Chunk sizes adapt to the speed of the "
+            "workers within this limit (default=128)"
+        ),
+    )
+    parser.add_argument(
+        "--shared-memory",
+        default=False,
+        action="store_true",
+        help=(
+            "pass chunks of input to the workers via shared memory instead of "
+            "pipes (requires Python >= 3.8)"
+        ),
+    )
+    parser.add_argument(
+        "--whitelist",
+        default=[],
+        nargs="+",
+        help=(
+            "puck barcode file(s) (column cell_bc, barcodes or barcode) or plain "
+            "lists of barcodes. The cell barcode of each read is looked up and "
+            "the result stored in the --whitelist-tag"
+        ),
+    )
+    parser.add_argument(
+        "--whitelist-mismatches",
+        default=0,
+        type=int,
+        help=(
+            "number of mismatches allowed between cell barcode and whitelist. "
+            "Each mismatch multiplies the cost of looking up barcodes that do "
+            "not match exactly by 3 x barcode length (default=0)"
+        ),
+    )
+    parser.add_argument(
+        "--whitelist-tag",
+        default="WL",
+        help=(
+            "BAM tag for the result of the whitelist lookup: '1' if on, '0' if "
+            "off the whitelist. Empty to disable (default=WL)"
+        ),
+    )
+    parser.add_argument(
+        "--out-off-whitelist",
+        default="",
+        help=(
+            "write reads whose cell barcode is not on the --whitelist here, "
+            "instead of to --out-assigned (default: off)"
+        ),
+    )
+    parser.add_argument(
+        "--shards",
+        default=1,
+        type=int,
+        help=(
+            "split the output into this many shards, e.g. for mapping them in "
+            "parallel. Shard files get '.shard_000' etc. inserted before the "
+            "file extension and share the same header (default=1, no sharding)"
+        ),
+    )
+    parser.add_argument(
+        "--shard-by",
+        default="chunk",
+        choices=["chunk", "cell"],
+        help=(
+            "'chunk' distributes chunks of reads round-robin over the shards, "
+            "'cell' keeps all reads of a cell barcode in the same shard "
+            "(default=chunk)"
+        ),
+    )
+    parser.add_argument(
+        "--shard-manifest",
+        default="",
+        help=(
+            "write a table of the shards and their files here "
+            "(default=<out-assigned without extension>.shards.tsv)"
+        ),
+    )
+    parser.add_argument(
+        "--n-chunk",
+        default=1000,
+        type=int,
+        help=(
+            "number of reads in the first chunk of a parallel run, or in all "
+            "chunks with --checkpoint (default=1000)"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="",
+        help=(
+            "periodically commit the output to this directory, so that an "
+            "interrupted run can be continued with --resume. The output is "
+            "assembled from there at the end and the directory is removed. "
+            "Chunks then have a fixed size (--n-chunk), so that the output does "
+            "not depend on interruptions. Not available with --streaming"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=300,
+        type=float,
+        help="seconds between commits to the --checkpoint directory (default=300)",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help=(
+            "continue from the --checkpoint directory, if it was created with "
+            "the same input and parameters. Otherwise start from scratch"
+        ),
+    )
+    parser.add_argument(
+        "--compression-level",
+        default=6,
+        type=int,
+        choices=range(10),
+        metavar="[0-9]",
+        help="zlib compression level for BAM output. 0 writes uncompressed BGZF (default=6)",
+    )
+    parser.add_argument(
+        "--threads-write",
+        default=1,
+        type=int,
+        help="number of compression threads used by each worker process (default=1)",
+    )
     parser.add_argument(
         "--opseq",
         default="GAATCACGATACGTACACCAGT",
@@ -1062,6 +2744,18 @@ def parse_args():
     parser.add_argument(
         "--bc2-cache", default="", help="load cached BC2 alignments from here"
     )
+    parser.add_argument(
+        "--bc1-index-radius",
+        default=1,
+        type=int,
+        help="pre-compute BC1 matches for all sequences within this Hamming distance of a reference (0: exact matches only, -1: no index, default=1)",
+    )
+    parser.add_argument(
+        "--bc2-index-radius",
+        default=1,
+        type=int,
+        help="pre-compute BC2 matches for all sequences within this Hamming distance of a reference (0: exact matches only, -1: no index, default=1)",
+    )
     parser.add_argument(
         "--update-cache",
         default=False,
@@ -1076,6 +2770,22 @@ def parse_args():
         default="CB:{cell},MI:{UMI},RG:{assigned}",
         help="raw, uncorrected cell barcode",
     )
+    parser.add_argument(
+        "--trim",
+        default=False,
+        action="store_true",
+        help=(
+            "trim read2 right after barcode extraction, like cutadapt_bam does "
+            "on the output BAM (see the trimming options below). Reads that "
+            "become too short are not written"
+        ),
+    )
+    parser.add_argument(
+        "--save-trim-stats",
+        default="",
+        help="with --trim, write the table of trimming results (as cutadapt_bam --stats-out) here",
+    )
+    add_trim_arguments(parser)
     args = parser.parse_args()
 
     return args
@@ -9,40 +9,36 @@ __email__ = ['nikolaos.karaiskos@mdc-berlin.de', 'tamasryszard.sztanka-toth@mdc-
 ###################################################
 # Snakefile containing the dropseq pipeline rules #
 ###################################################
-rule remove_smart_adapter:
+rule remove_smart_adapter_polyA:
+    # trims the smart adapter from the start and polyA from the end of the
+    # reads, like Drop-seq's TrimStartingSequence and PolyATrimmer, in one
+    # parallel pass. --min-length=0 keeps reads that are trimmed completely,
+    # as the Drop-seq tools did, so that read counts are unchanged. They are
+    # passed on with an empty sequence and STAR reports them as unmapped.
     input:
         tagged_bam
     output:
-        pipe(tagged_trimmed_bam)
+        temp(tagged_polyA_adapter_trimmed_bam)
     params:
         reports_dir = reports_dir
+    threads: 4
     shell:
         """
         mkdir -p {params.reports_dir}
 
-        {dropseq_tools}/TrimStartingSequence OUTPUT_SUMMARY={params.reports_dir}/remove_smart_adapter.report.txt \
-            INPUT={input} \
-            OUTPUT={output} \
-            SEQUENCE={smart_adapter} \
-            MISMATCHES=0 \
-            NUM_BASES=5 \
-            COMPRESSION_LEVEL=0
-        """
-
-rule remove_polyA:
-    input:
-        tagged_trimmed_bam
-    output:
-        temp(tagged_polyA_adapter_trimmed_bam)
-    params:
-        reports_dir = reports_dir
-    shell:
-        """
-        {dropseq_tools}/PolyATrimmer OUTPUT_SUMMARY={params.reports_dir}/remove_polyA.report.txt \
-            MISMATCHES=0 \
-            INPUT={input} \
-            OUTPUT={output} \
-            NUM_BASES=6
+        python {spacemake_dir}/cutadapt_bam.py {input} \
+            --bam-out={output} \
+            --bam-out-mode=b \
+            --start-sequence={smart_adapter} \
+            --start-mismatches=0 \
+            --start-min-bases=5 \
+            --start-report={params.reports_dir}/remove_smart_adapter.report.txt \
+            --polyA-min-bases=6 \
+            --polyA-mismatches=0 \
+            --polyA-report={params.reports_dir}/remove_polyA.report.txt \
+            --min-qual=0 \
+            --min-length=0 \
+            --threads-work={threads}
         """
 
 rule filter_mm_reads:
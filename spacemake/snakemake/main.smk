@@ -259,15 +259,9 @@ rule link_raw_reads:
             shell("cat {input} > {output}")
             
 
-rule zcat_pipe:
-    input: "{name}.fastq.gz"
-    output: temp("{name}.fastq")
-    threads: 2
-    shell: "unpigz --keep --processes {threads} --stdout $(readlink {input}) >> {output}"
-
 rule tag_reads_bc_umi:
     input:
-        # these implicitly depend on the raw reads via zcat_pipes
+        # gzipped FASTQ is decompressed in a background thread
         R1 = raw_reads_mate_1,
         R2 = raw_reads_mate_2
     params:
@@ -275,7 +269,9 @@ rule tag_reads_bc_umi:
     output:
         assigned = tagged_bam,
         unassigned = unassigned,
-        bc_stats = reverse_reads_mate_1.replace(reads_suffix, ".bc_stats.tsv")
+        bc_stats = reverse_reads_mate_1.replace(reads_suffix, ".bc_stats.tsv"),
+        # read counts per cell barcode, in the format of BamTagHistogram
+        bc_readcounts = barcode_readcounts_prealigned
     log:
         reverse_reads_mate_1.replace(reads_suffix, ".preprocessing.log")
     threads: 4
@@ -286,21 +282,23 @@ rule tag_reads_bc_umi:
         "--read2={input.R2} "
         "--parallel={threads} "
         "--save-stats={output.bc_stats} "
+        "--save-barcode-histogram={output.bc_readcounts} "
         "--log-file={log} "
         "--bc1-ref={params.bc.bc1_ref} "
         "--bc2-ref={params.bc.bc2_ref} "
         "--bc1-cache={params.bc.bc1_cache} "
         "--bc2-cache={params.bc.bc2_cache} "
+        "--bc1-index-radius={params.bc.bc1_index_radius} "
+        "--bc2-index-radius={params.bc.bc2_index_radius} "
         "--threshold={params.bc.score_threshold} "
         "--cell='{params.bc.cell}' "
         "--cell-raw='{params.bc.cell_raw}' "
         "--out-format=bam "
         "--out-unassigned={output.unassigned} "
-        "--out-assigned=/dev/stdout "
+        "--out-assigned={output.assigned} "
         "--UMI='{params.bc.UMI}' "
         "--bam-tags='{params.bc.bam_tags}' "
         "--min-opseq-score={params.bc.min_opseq_score} "
-        "| samtools view -bh /dev/stdin > {output.assigned} "
 
 rule run_fastqc:
     input:
@@ -339,25 +337,6 @@ rule get_barcode_readcounts:
         READ_MQ=0
         """
 
-rule get_barcode_readcounts_prealigned:
-    # we perform some preliminary counting on the prealigned reads
-    input:
-        tagged_bam
-    output:
-        barcode_readcounts_prealigned
-    params:
-        cell_barcode_tag = lambda wildcards: get_bam_tag_names(
-            project_id = wildcards.project_id,
-            sample_id = wildcards.sample_id)['{cell}']
-    shell:
-        """
-        {dropseq_tools}/BamTagHistogram -m 32g \
-        I= {input} \
-        O= {output} \
-        TAG={params.cell_barcode_tag} \
-        READ_MQ=0
-        """
-
 rule merge_stats_prealigned_spatial_barcodes:
     input:
         unpack(get_barcode_files),
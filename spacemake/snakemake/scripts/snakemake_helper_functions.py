@@ -319,6 +319,8 @@ def parse_barcode_flavors(
         cell_raw="None",
         score_threshold=0.0,
         min_opseq_score=22,
+        bc1_index_radius=1,
+        bc2_index_radius=1,
         bam_tags="CR:{cell},MI:{UMI}",
     ),
 ):
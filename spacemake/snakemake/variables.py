@@ -245,10 +245,7 @@ parsed_ribo_depletion_log = complete_data_root + "/parsed_ribo_depletion_log.txt
 tagged_bam = complete_data_root + "/unaligned_bc_tagged.bam"
 unassigned = complete_data_root + "/unaligned_bc_unassigned.bam"
 
-# trim smart adapter from the reads
-tagged_trimmed_bam = complete_data_root + "/unaligned_bc_tagged_trimmed.bam"
-
-# trim polyA overheang if exists
+# trim smart adapter and polyA overhang if exists
 tagged_polyA_adapter_trimmed_bam = (
     complete_data_root + "/unaligned_bc_tagged.polyA_adapter_trimmed.bam"
 )
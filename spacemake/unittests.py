@@ -272,6 +272,1582 @@ class SpaceMakeCmdlineTests(unittest.TestCase):
 #        # TODO: test correct DGE content
 
 
+def _pipeline_source(n, chunk_size):
+    return iter(range(n))
+
+
+def _resumed_source(n, skip, chunk_size):
+    return iter(range(skip, n))
+
+
+def _interrupted_source(source, n, chunk_size):
+    "the first n chunks of source, as if the run was killed after them"
+    import itertools
+
+    return itertools.islice(source(chunk_size), n)
+
+
+def _sized_source(n, chunk_size):
+    for i in range(n):
+        yield b"x" * chunk_size()
+
+
+def _sleepy_worker():
+    def work(chunk):
+        import time
+
+        # 10 MB/s
+        time.sleep(len(chunk) / 10e6)
+        return len(chunk)
+
+    return work
+
+
+class _SquareWorker:
+    def __init__(self, fail_at=None, delay=0):
+        self.fail_at = fail_at
+        self.delay = delay
+        self.n = 0
+
+    def __call__(self, x):
+        import time
+
+        if x == self.fail_at:
+            raise ValueError(f"failing on chunk {x}")
+
+        # uneven processing times to shuffle the order of results
+        time.sleep(self.delay * (x % 3))
+        self.n += 1
+        return x * x
+
+    def stats(self):
+        n, self.n = self.n, 0
+        return {"n": n}
+
+
+class PipelineTests(unittest.TestCase):
+    def run_pipeline(self, n=50, ordered=True, **kw):
+        from functools import partial
+        from spacemake.parallel import Pipeline
+
+        results = []
+        stats = Pipeline(
+            partial(_pipeline_source, n),
+            partial(_SquareWorker, **kw),
+            results.append,
+            n_workers=3,
+            ordered=ordered,
+            max_chunks=3,
+            stats_interval=0,
+            timeout=0.1,
+        ).run()
+        return results, stats
+
+    def test_ordered(self):
+        results, stats = self.run_pipeline(delay=0.002)
+        self.assertEqual(results, [x * x for x in range(50)])
+        self.assertEqual(stats["n"], 50)
+
+    def test_unordered(self):
+        results, stats = self.run_pipeline(ordered=False, delay=0.002)
+        self.assertEqual(sorted(results), [x * x for x in range(50)])
+
+    def test_empty(self):
+        results, stats = self.run_pipeline(n=0)
+        self.assertEqual(results, [])
+
+    def test_worker_exception(self):
+        with self.assertRaises(RuntimeError):
+            self.run_pipeline(n=1000, fail_at=10)
+
+    def test_sink_exception(self):
+        from functools import partial
+        from spacemake.parallel import Pipeline
+
+        def sink(x):
+            raise IOError("disk full")
+
+        with self.assertRaises(IOError):
+            Pipeline(
+                partial(_pipeline_source, 1000),
+                _SquareWorker,
+                sink,
+                n_workers=2,
+                max_chunks=2,
+                timeout=0.1,
+            ).run()
+
+    def test_adaptive_chunk_size(self):
+        from functools import partial
+        from spacemake.parallel import Pipeline
+
+        sizes = []
+        Pipeline(
+            partial(_sized_source, 40),
+            _sleepy_worker,
+            sizes.append,
+            n_workers=2,
+            chunk_bytes=2**16,
+            max_bytes=2**24,
+            target_time=0.02,
+            timeout=0.1,
+        ).run()
+        # chunks should grow towards 10 MB/s * 0.02 s = 200 kB
+        self.assertEqual(sizes[0], 2**16)
+        self.assertGreater(sizes[-1], 1.5 * 2**16)
+        self.assertLess(sizes[-1], 2**22)
+
+    def test_checkpoint_resume(self):
+        import tempfile
+        from functools import partial
+        from spacemake.parallel import Checkpoint, Pipeline
+
+        def run(path, n, resume):
+            ckpt = Checkpoint(
+                path,
+                ["out"],
+                {"n": 50},
+                heads={"out": b"head\n"},
+                resume=resume,
+                interval=0,
+            )
+            out = ckpt.stream("out")
+
+            def sink(x):
+                out.write(f"{x}\n".encode())
+                return 1
+
+            stats = Pipeline(
+                partial(_resumed_source, n, ckpt.n_items),
+                _SquareWorker,
+                sink,
+                n_workers=2,
+                checkpoint=ckpt,
+                timeout=0.1,
+            ).run()
+            return ckpt, stats
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ckpt")
+            # interrupted after 20 items, with some uncommitted output
+            ckpt, stats = run(path, 20, False)
+            ckpt.write("out", b"uncommitted\n")
+
+            ckpt, stats = run(path, 50, True)
+            fname = os.path.join(tmp, "out.txt")
+            ckpt.finalize({"out": fname}, tail=b"tail\n")
+
+            expect = "head\n" + "".join([f"{x * x}\n" for x in range(50)]) + "tail\n"
+            self.assertEqual(open(fname).read(), expect)
+            self.assertEqual(stats["n"], 50)
+            self.assertFalse(os.path.exists(path))
+
+    def test_checkpoint_resume_trim(self):
+        import gzip
+        import random
+        import tempfile
+        from functools import partial
+        from unittest import mock
+        import pysam
+        from spacemake.parallel import Pipeline
+        from spacemake.preprocess.fastq import (
+            DropseqWorker,
+            main_dropseq,
+            parse_args,
+            pipeline_io,
+        )
+
+        def parse(*argv):
+            with mock.patch.object(sys, "argv", ["fastq.py"] + list(argv)):
+                return parse_args()
+
+        def records(fname):
+            with pysam.AlignmentFile(fname, "rb", check_sq=False) as bam:
+                return [
+                    (r.query_name, r.query_sequence, sorted(r.get_tags()))
+                    for r in bam.fetch(until_eof=True)
+                ]
+
+        rng = random.Random(11)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+        with tempfile.TemporaryDirectory() as tmp:
+            fq1 = os.path.join(tmp, "R1.fastq.gz")
+            fq2 = os.path.join(tmp, "R2.fastq.gz")
+            with gzip.open(fq1, "wt") as f1, gzip.open(fq2, "wt") as f2:
+                for i in range(2000):
+                    # with --trim, about half of the reads are dropped as
+                    # too short after polyA trimming
+                    r2 = rnd(rng.choice([10, 40])) + "A" * rng.choice([0, 20])
+                    f1.write(f"@read{i}\n{rnd(30)}\n+\n{'I' * 30}\n")
+                    f2.write(f"@read{i}\n{r2}\n+\n{'I' * len(r2)}\n")
+
+            common = [
+                f"--read1={fq1}",
+                f"--read2={fq2}",
+                "--trim",
+                "--polyA-min-bases=6",
+                "--min-qual=0",
+                "--parallel=2",
+                "--n-chunk=100",
+                f"--save-stats={os.path.join(tmp, 'stats.txt')}",
+            ]
+            ref = os.path.join(tmp, "ref.bam")
+            main_dropseq(parse(f"--out-assigned={ref}", *common))
+
+            out = os.path.join(tmp, "out.bam")
+            common += [
+                f"--out-assigned={out}",
+                f"--checkpoint={os.path.join(tmp, 'ckpt')}",
+                "--checkpoint-interval=0",
+            ]
+            # interrupted after 5 chunks
+            args = parse(*common)
+            output, source, checkpoint = pipeline_io(args)
+            Pipeline(
+                partial(_interrupted_source, source, 5),
+                partial(DropseqWorker, args),
+                output.write_chunk,
+                n_workers=2,
+                checkpoint=checkpoint,
+            ).run()
+            self.assertEqual(checkpoint.n_items, 500)
+
+            main_dropseq(parse("--resume", *common))
+            expect = records(ref)
+            self.assertLess(len(expect), 2000)
+            self.assertEqual(records(out), expect)
+
+
+def _mutate(rng, seq, n):
+    seq = list(seq)
+    for i in range(n):
+        x = rng.random()
+        pos = rng.randrange(len(seq))
+        if x < 0.6:
+            seq[pos] = rng.choice("ACGTN")
+        elif x < 0.8:
+            del seq[pos]
+        else:
+            seq.insert(pos, rng.choice("ACGT"))
+
+    return "".join(seq)
+
+
+class OpseqTests(unittest.TestCase):
+    opseq = "GAATCACGATACGTACACCAGT"
+
+    def make_reads(self, n=1000, seed=13):
+        import random
+
+        rng = random.Random(seed)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+        reads = [
+            rnd(rng.choice([0, 3, 8, 8, 10, 12]))
+            + _mutate(rng, self.opseq, rng.choice([0, 0, 1, 1, 2, 3, 4, 6, 12]))
+            + rnd(rng.choice([0, 4, 20, 30]))
+            for i in range(n)
+        ]
+        # indel paths outside of a narrow band around the best edit-distance
+        # hit and alignments ending right at max_end
+        reads += [
+            "GCATCCTCGCGAATCACGATGCGTACACCGAAGTGGCA",
+            "AGGCGGTTACCGGAATCACGATACGTACACGACTCCAGTACAAT",
+            self.opseq,
+            self.opseq + self.opseq,
+            "A",
+        ]
+        return reads
+
+    def test_local_align(self):
+        import warnings
+        from spacemake.preprocess.fastq import pairwise2_local_align
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            from Bio import pairwise2
+
+        for seq in self.make_reads():
+            ref = pairwise2.align.localmd(
+                self.opseq, seq, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True
+            )
+            res = pairwise2_local_align(self.opseq, seq, 2, -1.5, -3, -1)
+            self.assertEqual([tuple(r) for r in res], [tuple(r) for r in ref], seq)
+
+    def test_local_align_fallback(self):
+        import warnings
+        from unittest import mock
+        import spacemake.preprocess.fastq as fastq
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            from Bio import cpairwise2, pairwise2
+
+        def changed_signature(seqA, seqB, match_fn, gap_open, gap_extend):
+            raise AssertionError("not reached")
+
+        reads = self.make_reads(n=50)
+        fast = cpairwise2._make_score_matrix_fast
+        for replacement in [changed_signature, None]:
+            with mock.patch.object(fastq, "PAIRWISE2_INTERNALS", True):
+                try:
+                    if replacement:
+                        cpairwise2._make_score_matrix_fast = replacement
+                    else:
+                        del cpairwise2._make_score_matrix_fast
+
+                    with self.assertLogs("pairwise2_local_align", level="WARNING"):
+                        fastq.pairwise2_local_align(self.opseq, reads[0])
+
+                    self.assertFalse(fastq.PAIRWISE2_INTERNALS)
+                    for seq in reads:
+                        ref = pairwise2.align.localmd(
+                            self.opseq,
+                            seq,
+                            2,
+                            -1.5,
+                            -3,
+                            -1,
+                            -3,
+                            -1,
+                            one_alignment_only=True,
+                        )
+                        res = fastq.pairwise2_local_align(self.opseq, seq)
+                        self.assertEqual(res, ref)
+                finally:
+                    cpairwise2._make_score_matrix_fast = fast
+
+    def test_detector(self):
+        import warnings
+        from spacemake.preprocess.fastq import OpseqDetector, check_opseq_alignment
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            from Bio import pairwise2
+
+        for kw in [
+            dict(min_opseq_score=22, allow_end_gap=True),
+            dict(min_start=0, max_end=0, allow_start_gap=True, allow_end_gap=True),
+        ]:
+            detector = OpseqDetector(self.opseq, **kw)
+            for seq in self.make_reads():
+                ref = pairwise2.align.localmd(
+                    self.opseq, seq, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True
+                )
+                ref, tstart, tend = check_opseq_alignment(
+                    ref[0] if ref else None, **kw
+                )
+                res, tstart_, tend_ = detector.align(seq)
+                self.assertEqual(
+                    (None if res is None else tuple(res), tstart_, tend_),
+                    (None if ref is None else tuple(ref), tstart, tend),
+                    seq,
+                )
+
+            self.assertGreater(detector.N["opseq_exact"], 0)
+            self.assertGreater(detector.N["opseq_align"], 0)
+
+
+
+def _start_trim_ref(read, sequence, min_bases, mismatches):
+    "the longest suffix of sequence that read begins with, one read at a time"
+    for l in range(min(len(sequence), len(read)), min_bases - 1, -1):
+        mism = sum([a != b for a, b in zip(read[:l], sequence[-l:])])
+        if mism <= mismatches:
+            return l
+
+    return 0
+
+
+def _polyA_trim_ref(read, min_bases, mismatches):
+    "the run of A's at the end of read, one read at a time"
+    run = 0
+    mism = 0
+    for i, c in enumerate(read[::-1]):
+        if c != "A":
+            mism += 1
+            if mism > mismatches:
+                break
+        else:
+            run = i + 1
+
+    return run if run >= min_bases else 0
+
+
+def _align_ref(matcher, query):
+    "BarcodeMatcher.align() one reference at a time, with hamming()"
+    import numpy as np
+    from spacemake.preprocess.fastq import hamming
+
+    if len(query) < matcher.lmin:
+        return matcher.align_na(query)
+
+    lq = min(len(query), matcher.lmax)
+    lmask = matcher.slen_masks[lq]
+    scores = np.array(
+        [hamming(query, seq, matcher.costs[lq]) for seq in matcher.seqs[lmask]]
+    )
+    ties = scores == scores.max()
+    return matcher.names[lmask][ties], matcher.seqs[lmask][ties], scores[ties]
+
+
+class BarcodeTests(unittest.TestCase):
+    def make_refs(self, fname, n=200, seed=17):
+        "random reference barcodes of 7 and 8 nt, some of them duplicated"
+        import random
+
+        rng = random.Random(seed)
+        seqs = ["".join(rng.choice("ACGT") for i in range(8)) for j in range(n)]
+        seqs += [seq[:7] for seq in seqs[: n // 10]]
+        seqs += rng.sample(seqs, n // 20)
+        with open(fname, "w") as f:
+            for i, seq in enumerate(seqs):
+                f.write(f">BC{i}\n{seq}\n")
+
+        return seqs
+
+    def mutate(self, rng, seq, n, alphabet="ACGT"):
+        seq = list(seq)
+        for pos in rng.sample(range(len(seq)), n):
+            seq[pos] = rng.choice([b for b in alphabet if b != seq[pos]])
+
+        return "".join(seq)
+
+    def make_queries(self, refs, n=500, seed=19):
+        import random
+
+        rng = random.Random(seed)
+        queries = []
+        for i in range(n):
+            query = self.mutate(rng, rng.choice(refs), rng.choice([0, 1, 1, 2, 3]))
+            query += "".join(rng.choice("ACGT") for i in range(rng.choice([0, 0, 2])))
+            if rng.random() < 0.1:
+                query = self.mutate(rng, query, 1, alphabet="N")
+            if rng.random() < 0.05:
+                query = query[:6]
+
+            queries.append(query)
+
+        return queries
+
+    def test_score_batch(self):
+        import tempfile
+        import numpy as np
+        from spacemake.preprocess.fastq import BarcodeMatcher, hamming
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "refs.fa")
+            refs = self.make_refs(fname)
+            for place in ["left", "right"]:
+                matcher = BarcodeMatcher(fname, place=place, max_cells=1000)
+                queries = self.make_queries(refs)
+                for lq in [7, 8]:
+                    sel = [q for q in queries if len(q) >= lq]
+                    expect = [
+                        [hamming(q, seq, matcher.costs[lq]) for seq in matcher.seqs]
+                        for q in sel
+                    ]
+                    expect = np.array(expect)[:, matcher.slen == lq]
+                    self.assertTrue(
+                        (matcher.score_batch(sel, lq) == expect).all(), place
+                    )
+
+                n_ties = 0
+                for query, res in zip(queries, matcher.align_batch(queries)):
+                    names, seqs, scores = _align_ref(matcher, query)
+                    self.assertEqual(list(res[0]), list(names), query)
+                    self.assertEqual(list(res[1]), list(seqs), query)
+                    self.assertEqual(list(res[2]), list(scores), query)
+                    n_ties += len(names) > 1
+
+                self.assertGreater(n_ties, 0)
+                self.assertTrue(any(["N" in q for q in queries]))
+
+    def test_neighborhood_index(self):
+        import random
+        import tempfile
+        from spacemake.preprocess.fastq import (
+            BarcodeMatcher,
+            NeighborhoodIndex,
+            TieBreaker,
+        )
+
+        rng = random.Random(23)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "refs.fa")
+            for n, radius in [(60, 1), (20, 2)]:
+                refs = self.make_refs(fname, n=n)
+                matcher = BarcodeMatcher(fname)
+                index = NeighborhoodIndex(matcher, radius=radius)
+
+                # every entry is what an exhaustive search gives
+                self.assertGreater(index.n_ambig, 0)
+                for query, res in index.lookup.items():
+                    name, seq, score = TieBreaker.resolve(*_align_ref(matcher, query))
+                    self.assertEqual(res, (str(name), str(seq), float(score)))
+
+                # and every sequence within radius of a reference is indexed,
+                # others are not
+                for i in range(500):
+                    ref = rng.choice(refs)
+                    query = self.mutate(rng, ref, rng.choice(range(radius + 3)))
+                    dist = min(
+                        [
+                            sum([a != b for a, b in zip(query, seq)])
+                            for seq in refs
+                            if len(seq) == len(query)
+                        ]
+                    )
+                    self.assertEqual(
+                        index.get(query, matcher.lmax) is not None,
+                        dist <= radius,
+                        query,
+                    )
+
+
+    def make_assignments(self, seed=29, n=300):
+        "{query: (name, seq, score)} and query counts, as made by TieBreaker"
+        import random
+        from spacemake.preprocess.fastq import NO_CALL
+
+        rng = random.Random(seed)
+        cache = {}
+        counts = {}
+        for i in range(n):
+            query = "".join(rng.choice("ACGT") for i in range(8))
+            if rng.random() < 0.2:
+                cache[query] = (NO_CALL, NO_CALL, float(rng.randrange(8)))
+            else:
+                j = rng.randrange(20)
+                cache[query] = (f"BC{j}", f"SEQ{j}", float(rng.randrange(16)))
+            counts[query] = rng.randrange(1, 4)
+
+        return cache, counts
+
+    def stored_counts(self, cache, queries):
+        "the observation counts of queries in a BarcodeCache"
+        import numpy as np
+        from spacemake.preprocess.fastq import pack_2bit
+
+        keys, valid = pack_2bit([q[: cache.lmax] for q in queries])
+        return cache.counts[np.searchsorted(cache.keys, keys)].tolist()
+
+    def test_cache_roundtrip(self):
+        import tempfile
+        from spacemake.preprocess.fastq import BarcodeCache, store_cache
+
+        cache, counts = self.make_assignments()
+        queries = list(cache)
+        # not cached: can not be packed
+        cache["ACGTNACG"] = ("BC0", "SEQ0", 3.0)
+        # one entry, with the counts summed up, after truncation to lmax
+        cache[queries[0] + "A"] = cache[queries[0]]
+        counts[queries[0] + "A"] = 5
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "cache.bin")
+            BarcodeCache.from_dict(cache, counts, 8).write(fname)
+            loaded = BarcodeCache.load(fname)
+            self.assertEqual(loaded.lmax, 8)
+            self.assertEqual(len(loaded), len(queries))
+            self.assertEqual(loaded.lookup(queries, 8), [cache[q] for q in queries])
+            self.assertEqual(loaded.get("ACGTNACG", 8), None)
+            self.assertEqual(loaded.get("AAAAAAAAAA", 8), cache.get("AAAAAAAA"))
+            expect = [counts[q] for q in queries]
+            expect[0] += 5
+            self.assertEqual(self.stored_counts(loaded, queries), expect)
+
+            BarcodeCache.empty().write(fname)
+            self.assertEqual(len(BarcodeCache.load(fname)), 0)
+            self.assertEqual(len(BarcodeCache.load(os.path.join(tmp, "missing"))), 0)
+
+            # written by a later, incompatible version
+            with open(fname, "r+b") as f:
+                f.write(b"SMKBCC02")
+
+            with self.assertRaises(ValueError):
+                BarcodeCache.load(fname)
+
+            # and is left alone
+            with self.assertLogs("store_cache", level="WARNING"):
+                store_cache(fname, [BarcodeCache.from_dict(cache, counts, 8)], 1)
+
+            with open(fname, "rb") as f:
+                self.assertEqual(f.read(8), b"SMKBCC02")
+
+    def test_cache_merge(self):
+        import tempfile
+        from spacemake.preprocess.fastq import BarcodeCache, store_cache
+
+        cache, counts = self.make_assignments()
+        queries = list(cache)
+        # two workers, with overlapping queries and their own name tables
+        a = {q: cache[q] for q in queries[:200]}
+        b = {q: cache[q] for q in queries[100:][::-1]}
+        merged = BarcodeCache.merge(
+            [
+                BarcodeCache.from_dict(a, counts, 8),
+                BarcodeCache.from_dict(b, counts, 8),
+            ]
+        )
+        self.assertEqual(merged.lookup(queries, 8), [cache[q] for q in queries])
+        # counts of queries in both are summed up
+        expect = [counts[q] * (1 + (100 <= i < 200)) for i, q in enumerate(queries)]
+        self.assertEqual(self.stored_counts(merged, queries), expect)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "cache.bin")
+            # only queries observed at least mincount times are stored
+            store_cache(fname, [BarcodeCache.from_dict(a, counts, 8)], mincount=2)
+            stored = BarcodeCache.load(fname)
+            expect = [cache[q] if counts[q] >= 2 else None for q in queries[:200]]
+            self.assertEqual(stored.lookup(queries[:200], 8), expect)
+
+            store_cache(fname, [BarcodeCache.from_dict(b, counts, 8)], mincount=2)
+            stored = BarcodeCache.load(fname)
+            expect = [cache[q] if counts[q] >= 2 else None for q in queries]
+            self.assertEqual(stored.lookup(queries, 8), expect)
+
+    def test_cache_legacy_tsv(self):
+        import tempfile
+        from spacemake.preprocess.fastq import BarcodeCache, store_cache
+
+        cache, counts = self.make_assignments()
+        queries = list(cache)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "cache.tsv")
+            # the tab-separated format of previous versions
+            with open(fname, "w") as f:
+                for query in sorted(queries):
+                    name, seq, score = cache[query]
+                    f.write(f"{query}\t{seq}\t{name}\t{score}\t{counts[query]}\n")
+
+            legacy = BarcodeCache.load(fname, 8)
+            self.assertEqual(legacy.lookup(queries, 8), [cache[q] for q in queries])
+
+            # storing new assignments upgrades the file to the binary format
+            store_cache(fname, [BarcodeCache.from_dict({}, {}, 8)])
+            with open(fname, "rb") as f:
+                self.assertEqual(f.read(8), BarcodeCache.magic)
+
+            upgraded = BarcodeCache.load(fname)
+            self.assertEqual(upgraded.lmax, 8)
+            self.assertEqual(upgraded.lookup(queries, 8), [cache[q] for q in queries])
+            self.assertEqual(
+                self.stored_counts(upgraded, queries), [counts[q] for q in queries]
+            )
+
+
+class FlavorExpressionTests(unittest.TestCase):
+    # defaults of preprocess and forms used with combinatorial barcodes
+    extra = [
+        "r1[8:20][::-1]",
+        "r1[0:8]",
+        "None",
+        "BC1",
+        "bc1 + bc2",
+        "BC1 + '_' + BC2",
+        "r1[-8:]",
+        "r1[::2][1:]",
+        "r2[-12:][0]",
+        "r2_qname",
+    ]
+
+    def flavor_expressions(self):
+        "the cell, cell_raw and UMI expressions of the shipped flavors"
+        config = yaml.safe_load(
+            open(f"{base_dir}/spacemake/data/config/config.yaml")
+        )
+        exprs = []
+        for flavor in config["barcode_flavors"].values():
+            exprs += [flavor[k] for k in ["cell", "cell_raw", "UMI"] if k in flavor]
+
+        self.assertGreater(len(exprs), 10)
+        return list(dict.fromkeys(exprs + self.extra))
+
+    def test_eval_equivalence(self):
+        import random
+        from spacemake.preprocess.fastq import FlavorExpression
+
+        rng = random.Random(31)
+        rnd = lambda l: "".join([rng.choice("ACGTN") for i in range(l)])
+        reads = [
+            dict(
+                r1=rnd(rng.choice([0, 10, 30, 50])),
+                r2=rnd(rng.choice([12, 90])),
+                bc1=rnd(8),
+                bc2=rnd(8),
+                BC1=rnd(8),
+                BC2=rnd(8),
+                qname=f"read{i}",
+                r2_qname=f"read{i} 2:N:0",
+                r2_qual="I" * 12,
+            )
+            for i in range(50)
+        ]
+        columns = {k: [read[k] for read in reads] for k in reads[0]}
+        for expr in self.flavor_expressions():
+            fe = FlavorExpression(expr)
+            expect = [eval(expr, {}, read) for read in reads]
+            self.assertEqual([fe(**read) for read in reads], expect, expr)
+            self.assertEqual(fe.extract(columns, len(reads)), expect, expr)
+
+    def test_disallowed(self):
+        from spacemake.preprocess.fastq import FlavorExpression
+
+        for expr in [
+            "__import__('os').system('true')",
+            "r1.upper()",
+            "r1 * 2",
+            "r1[0:n]",
+            "r1[0:8.5]",
+            "unknown[0:8]",
+            "[r1 for r1 in r2]",
+            "lambda: r1",
+            "r1[0:8",
+        ]:
+            with self.assertRaises(ValueError, msg=expr):
+                FlavorExpression(expr)
+
+
+def _whitelisted_ref(whitelist, barcode, max_mismatches):
+    if barcode in whitelist:
+        return True
+
+    if "N" in barcode:
+        return False
+
+    return any(
+        len(wl) == len(barcode)
+        and sum([a != b for a, b in zip(wl, barcode)]) <= max_mismatches
+        for wl in whitelist
+    )
+
+
+class WhitelistTests(unittest.TestCase):
+    def make_barcodes(self, seed=23):
+        import random
+
+        rng = random.Random(seed)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+        whitelist = [rnd(12) for i in range(40)] + [rnd(10) for i in range(5)]
+        whitelist += ["ACGTNACGTNAC"]
+        barcodes = []
+        for i in range(400):
+            bc = rng.choice(whitelist)
+            barcodes.append(_mutate(rng, bc, rng.choice([0, 1, 1, 2, 3])))
+            barcodes.append(rnd(12))
+
+        barcodes += ["ACGTNACGTNAC", "ACGTNACGTNAA", ""]
+        return whitelist, barcodes
+
+    def test_query(self):
+        import tempfile
+        from spacemake.preprocess.fastq import BarcodeWhitelist
+
+        whitelist, barcodes = self.make_barcodes()
+        with tempfile.TemporaryDirectory() as tmp:
+            # a puck barcode file and a plain list
+            fnames = [os.path.join(tmp, "puck.tsv"), os.path.join(tmp, "list.txt")]
+            with open(fnames[0], "w") as f:
+                f.write("x_pos\tcell_bc\ty_pos\n")
+                f.write("".join([f"1\t{bc}\t2\n" for bc in whitelist[:20]]))
+
+            with open(fnames[1], "w") as f:
+                f.write("".join([f"{bc}\n" for bc in whitelist[20:]]))
+
+            for mm in [0, 1, 2]:
+                wl = BarcodeWhitelist(fnames, max_mismatches=mm)
+                self.assertEqual(len(wl), len(set(whitelist)))
+                expect = [_whitelisted_ref(whitelist, bc, mm) for bc in barcodes]
+                self.assertEqual(wl.query(barcodes).tolist(), expect, mm)
+                self.assertTrue(any(expect) and not all(expect))
+
+    def test_preprocess(self):
+        import gzip
+        import tempfile
+        from unittest import mock
+        import pysam
+        from spacemake.preprocess.fastq import (
+            main_dropseq,
+            main_dropseq_streaming,
+            parse_args,
+        )
+
+        def parse(*argv):
+            with mock.patch.object(sys, "argv", ["fastq.py"] + list(argv)):
+                return parse_args()
+
+        def records(fname):
+            with pysam.AlignmentFile(fname, "rb", check_sq=False) as bam:
+                return [
+                    (r.query_name, r.get_tag("CB"), r.get_tag("WL"))
+                    for r in bam.fetch(until_eof=True)
+                ]
+
+        def stats(fname):
+            return {
+                line.split("\t")[1]: int(line.split("\t")[2])
+                for line in open(fname)
+            }
+
+        whitelist, barcodes = self.make_barcodes()
+        barcodes = [bc for bc in barcodes if len(bc) == 12]
+        with tempfile.TemporaryDirectory() as tmp:
+            fq1 = os.path.join(tmp, "R1.fastq.gz")
+            fq2 = os.path.join(tmp, "R2.fastq.gz")
+            with gzip.open(fq1, "wt") as f1, gzip.open(fq2, "wt") as f2:
+                for i, bc in enumerate(barcodes):
+                    f1.write(f"@read{i}\n{bc}ACGTACGT\n+\n{'I' * 20}\n")
+                    f2.write(f"@read{i}\nACGTACGTACGT\n+\n{'I' * 12}\n")
+
+            wl_file = os.path.join(tmp, "puck.txt")
+            with open(wl_file, "w") as f:
+                f.write("".join([f"{bc}\n" for bc in whitelist]))
+
+            for main in [main_dropseq, main_dropseq_streaming]:
+                for mm in [0, 1]:
+                    out = os.path.join(tmp, "out.bam")
+                    off = os.path.join(tmp, "off.bam")
+                    args = parse(
+                        f"--read1={fq1}",
+                        f"--read2={fq2}",
+                        "--cell=r1[0:12]",
+                        "--UMI=r1[12:20]",
+                        f"--out-assigned={out}",
+                        f"--out-unassigned={out}",
+                        f"--whitelist={wl_file}",
+                        f"--whitelist-mismatches={mm}",
+                        f"--out-off-whitelist={off}",
+                        f"--save-stats={os.path.join(tmp, 'stats.txt')}",
+                        "--parallel=2",
+                        "--n-chunk=100",
+                    )
+                    main(args)
+
+                    on = [_whitelisted_ref(whitelist, bc, mm) for bc in barcodes]
+                    reads = [(f"read{i}", bc) for i, bc in enumerate(barcodes)]
+                    # barcodes are looked up, not corrected
+                    self.assertEqual(
+                        records(out),
+                        [(q, bc, "1") for (q, bc), o in zip(reads, on) if o],
+                    )
+                    self.assertEqual(
+                        records(off),
+                        [(q, bc, "0") for (q, bc), o in zip(reads, on) if not o],
+                    )
+                    N = stats(os.path.join(tmp, "stats.txt"))
+                    self.assertEqual(N["whitelist_on"], sum(on))
+                    self.assertEqual(N["whitelist_off"], len(on) - sum(on))
+                    self.assertEqual(N["total"], len(on))
+
+
+class BarcodeHistogramTests(unittest.TestCase):
+    def test_format(self):
+        import gzip
+        import random
+        import tempfile
+        from collections import Counter
+        from unittest import mock
+        import pandas as pd
+        import pysam
+        from spacemake.preprocess.fastq import (
+            main_dropseq,
+            main_dropseq_streaming,
+            parse_args,
+        )
+
+        def parse(*argv):
+            with mock.patch.object(sys, "argv", ["fastq.py"] + list(argv)):
+                return parse_args()
+
+        def bam_tag_histogram(fname, tag):
+            "the output of the removed get_barcode_readcounts_prealigned rule"
+            with pysam.AlignmentFile(fname, "rb", check_sq=False) as bam:
+                counts = Counter([r.get_tag(tag) for r in bam.fetch(until_eof=True)])
+
+            header = (
+                f"#INPUT={fname}\tTAG={tag}\tFILTER_PCR_DUPLICATES=false\t"
+                "READ_QUALITY=0\n"
+            )
+            items = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+            return header + "".join([f"{n}\t{bc}\n" for bc, n in items])
+
+        rng = random.Random(3)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+        # many ties, a few barcodes with N
+        cells = [rnd(12) for i in range(30)] + ["ACGTNACGTNAC", "NNNNNNNNNNNN"]
+        with tempfile.TemporaryDirectory() as tmp:
+            fq1 = os.path.join(tmp, "R1.fastq.gz")
+            fq2 = os.path.join(tmp, "R2.fastq.gz")
+            with gzip.open(fq1, "wt") as f1, gzip.open(fq2, "wt") as f2:
+                for i in range(1000):
+                    r1 = rng.choice(cells[: rng.choice([5, 32])]) + rnd(8)
+                    f1.write(f"@read{i}\n{r1}\n+\n{'I' * 20}\n")
+                    f2.write(f"@read{i}\nACGTACGTACGT\n+\n{'I' * 12}\n")
+
+            wl_file = os.path.join(tmp, "puck.txt")
+            with open(wl_file, "w") as f:
+                f.write("".join([f"{bc}\n" for bc in cells[::2]]))
+
+            out = os.path.join(tmp, "out.bam")
+            hist = os.path.join(tmp, "out_readcounts_prealigned.txt.gz")
+            common = [
+                f"--read1={fq1}",
+                f"--read2={fq2}",
+                "--cell=r1[0:12]",
+                "--UMI=r1[12:20]",
+                f"--out-assigned={out}",
+                f"--out-unassigned={out}",
+                f"--save-barcode-histogram={hist}",
+                f"--save-stats={os.path.join(tmp, 'stats.txt')}",
+                "--parallel=2",
+                "--n-chunk=100",
+            ]
+            whitelist = [
+                f"--whitelist={wl_file}",
+                f"--out-off-whitelist={os.path.join(tmp, 'off.bam')}",
+            ]
+            for main in [main_dropseq, main_dropseq_streaming]:
+                for extra, tag in [
+                    ([], "CB"),
+                    # the last tag holding only {cell}, as in the workflow
+                    (["--bam-tags=CR:{cell},XC:{cell},MI:{UMI},RG:{assigned}"], "XC"),
+                    # reads not in --out-assigned are not counted
+                    (whitelist, "CB"),
+                ]:
+                    main(parse(*common, *extra))
+                    text = gzip.open(hist, "rt").read()
+                    self.assertEqual(text, bam_tag_histogram(out, tag))
+                    if not extra:
+                        self.assertIn("\tNNNNNNNNNNNN\n", text)
+
+                    # as read by create_spatial_barcode_file
+                    df = pd.read_table(hist, skiprows=1, names=["read_n", "cell_bc"])
+                    self.assertTrue((df["read_n"].diff().dropna() <= 0).all())
+                    with pysam.AlignmentFile(out, "rb", check_sq=False) as bam:
+                        n = len(list(bam.fetch(until_eof=True)))
+
+                    self.assertEqual(df["read_n"].sum(), n)
+
+
+class BamTests(unittest.TestCase):
+    def make_reads(self, n=40, seed=5):
+        import random
+
+        rng = random.Random(seed)
+        reads = []
+        for i in range(n):
+            # odd and even lengths, and empty sequences
+            l = rng.choice([0, 1, 2, 7, 8, 25, 50])
+            reads.append(
+                dict(
+                    qname=f"read_{i}",
+                    seq="".join([rng.choice("ACGTN") for j in range(l)]),
+                    qual="".join([chr(33 + rng.randint(0, 41)) for j in range(l)]),
+                    CB=rng.choice([None, "ACGTACGT", ""]),
+                    XC=rng.choice([None, 0, 1, 255, 256, 70000, 2**31]),
+                    XA=rng.choice(["A", "B", "-"]),
+                )
+            )
+        return reads
+
+    def roundtrip(self, reads, aux):
+        import pysam
+        import tempfile
+        from spacemake.bam import BAMWriter, encode_unmapped
+
+        header = {"HD": {"VN": "1.6"}, "RG": [{"ID": "A", "SM": "NA"}]}
+        data, offsets = encode_unmapped(
+            [r["qname"] for r in reads],
+            [r["seq"] for r in reads],
+            [r["qual"] for r in reads],
+            [("CB", [r["CB"] for r in reads]), ("XC", [r["XC"] for r in reads])],
+            aux=aux,
+        )
+        self.assertEqual(len(offsets), len(reads) + 1)
+        self.assertEqual(offsets[-1], len(data))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "test.bam")
+            writer = BAMWriter(fname, header)
+            writer.write_records([data])
+            writer.close()
+            bam = pysam.AlignmentFile(fname, "rb", check_sq=False)
+            self.assertEqual(bam.header.to_dict()["RG"], header["RG"])
+            return list(bam.fetch(until_eof=True))
+
+    def check(self, reads, records):
+        self.assertEqual(len(records), len(reads))
+        for r, rec in zip(reads, records):
+            self.assertTrue(rec.is_unmapped)
+            self.assertEqual(rec.query_name, r["qname"])
+            self.assertEqual(rec.query_sequence or "", r["seq"])
+            quals = rec.query_qualities
+            self.assertEqual(
+                [] if quals is None else list(quals),
+                [ord(q) - 33 for q in r["qual"]],
+            )
+            for tag in ["CB", "XC"]:
+                if r[tag] is None:
+                    self.assertFalse(rec.has_tag(tag))
+                else:
+                    self.assertEqual(rec.get_tag(tag), r[tag])
+
+    def test_encode_unmapped(self):
+        reads = self.make_reads()
+        self.check(reads, self.roundtrip(reads, None))
+
+    def test_encode_aux(self):
+        from spacemake.bam import encode_aux, encode_tags
+
+        reads = self.make_reads()
+        # only string tags take the fast path of encode_aux()
+        aux = [f"RG:Z:A\tXS:Z:{r['seq']}" for r in reads]
+        records = self.roundtrip(reads, aux)
+        self.check(reads, records)
+        for r, rec in zip(reads, records):
+            self.assertEqual(rec.get_tag("RG"), "A")
+            self.assertEqual(rec.get_tag("XS"), r["seq"])
+            # aux tags go before the tags passed explicitly
+            self.assertEqual([t for t, v in rec.get_tags()][:2], ["RG", "XS"])
+
+        # mixed types and values with colons
+        aux = [
+            f"XA:A:{r['XA']}\tXI:i:-{i}\tXZ:Z:a:b\tXF:f:0.5\tXB:B:S,1,{i}"
+            for i, r in enumerate(reads)
+        ]
+        records = self.roundtrip(reads, aux)
+        self.check(reads, records)
+        for i, (r, rec) in enumerate(zip(reads, records)):
+            self.assertEqual(rec.get_tag("XA"), r["XA"])
+            self.assertEqual(rec.get_tag("XI"), -i)
+            self.assertEqual(rec.get_tag("XZ"), "a:b")
+            self.assertEqual(rec.get_tag("XF"), 0.5)
+            self.assertEqual(list(rec.get_tag("XB")), [1, i])
+
+        texts = [f"RG:Z:A\tXS:Z:{r['seq']}" for r in reads]
+        data, lens = encode_aux(texts)
+        self.assertEqual(data, b"".join([encode_tags(t) for t in texts]))
+        self.assertEqual(list(lens), [len(encode_tags(t)) for t in texts])
+
+    def test_tags_to_text(self):
+        from spacemake.bam import tags_to_text
+
+        reads = self.make_reads(n=10)
+        for r in reads:
+            # pysam's get_tags() (unlike get_tag()) reads 'I' values >= 2**31
+            # as negative
+            if r["XC"] is not None and r["XC"] >= 2**31:
+                r["XC"] = 2**31 - 1
+
+        aux = [f"XA:A:{r['XA']}\tXI:i:-7\tXB:B:f,1.5,2\tXZ:Z:{r['seq']}" for r in reads]
+        records = self.roundtrip(reads, aux)
+        for r in reads:
+            r["CB"] = r["XC"] = None
+
+        # the text form restores the tags with their exact types
+        tags = [rec.get_tags(with_value_type=True) for rec in records]
+        again = self.roundtrip(reads, [tags_to_text(t) for t in tags])
+        self.assertEqual([rec.query_name for rec in again], [r["qname"] for r in reads])
+        self.assertEqual([rec.get_tags(with_value_type=True) for rec in again], tags)
+
+    def test_length_mismatch(self):
+        from spacemake.bam import encode_unmapped
+
+        with self.assertRaises(ValueError):
+            encode_unmapped(["a", "b"], ["ACG", "AC"], ["III", "III"], [])
+
+        data, offsets = encode_unmapped([], [], [], [])
+        self.assertEqual(data, b"")
+        self.assertEqual(list(offsets), [0])
+
+
+class _AllCandidates:
+    "stands in for AdapterSeeds: every adapter is matched against every read"
+
+    def __init__(self, n_adapters):
+        self.n_adapters = n_adapters
+
+    def candidates(self, seqs, ends):
+        import numpy as np
+
+        return np.ones((self.n_adapters, len(seqs)), dtype=bool)
+
+
+class TrimTests(unittest.TestCase):
+    smart = "AAGCAGTGGTATCAACGCAGAGTGAATGGG"
+
+    def make_reads(self, n=2000, seed=7):
+        import random
+
+        rng = random.Random(seed)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+        reads = []
+        for i in range(n):
+            start = self.smart[len(self.smart) - rng.choice([0, 3, 5, 8, 20, 30]) :]
+            polyA = "A" * rng.choice([0, 2, 6, 10, 30])
+            read = list(start + rnd(rng.choice([0, 1, 10, 30])) + polyA)
+            for j in range(rng.choice([0, 0, 1, 2])):
+                if read:
+                    read[rng.randrange(len(read))] = rng.choice("ACGTN")
+
+            reads.append("".join(read))
+
+        return reads
+
+    def make_args(self, *argv):
+        import argparse
+        from spacemake.cutadapt_bam import add_trim_arguments
+
+        parser = argparse.ArgumentParser()
+        add_trim_arguments(parser)
+        return parser.parse_args(list(argv))
+
+    def test_start_trim(self):
+        import numpy as np
+        from spacemake.cutadapt_bam import start_trim_lengths
+
+        def trim(seqs, mismatches, starts=None):
+            starts = np.zeros(len(seqs), dtype=np.int64) if starts is None else starts
+            ends = np.array([len(s) for s in seqs], dtype=np.int64)
+            trim = start_trim_lengths(seqs, starts, ends, self.smart, 5, mismatches)
+            return trim.tolist()
+
+        smart = self.smart
+        seqs = [
+            smart + "CGTACGTA",  # the whole sequence
+            smart[-10:] + "CGTACGTA",  # a suffix of it
+            smart[-4:] + "CGTACGTA",  # shorter than min_bases
+            "CGTACGTA",
+            smart[-10:-6] + "C" + smart[-5:] + "CGTACGTA",  # one mismatch
+            smart[-8:],  # read and suffix end together
+            "",
+        ]
+        self.assertEqual(trim(seqs, 0), [30, 10, 0, 0, 0, 8, 0])
+        self.assertEqual(trim(seqs, 1), [30, 10, 0, 0, 10, 8, 0])
+        # only the part of the read after starts is looked at
+        starts = np.array([3, 0, 0, 0, 0, 0, 0], dtype=np.int64)
+        self.assertEqual(trim(["CGT" + smart[-12:]] + seqs[1:], 0, starts)[0], 12)
+
+        reads = self.make_reads()
+        for mismatches in [0, 1, 2]:
+            self.assertEqual(
+                trim(reads, mismatches),
+                [_start_trim_ref(r, smart, 5, mismatches) for r in reads],
+            )
+
+    def test_polyA_trim(self):
+        import numpy as np
+        from spacemake.cutadapt_bam import polyA_trim_lengths
+
+        def trim(seqs, min_bases, mismatches):
+            starts = np.zeros(len(seqs), dtype=np.int64)
+            ends = np.array([len(s) for s in seqs], dtype=np.int64)
+            trim = polyA_trim_lengths(seqs, starts, ends, min_bases, mismatches)
+            return trim.tolist()
+
+        seqs = [
+            "CGTACGT" + "A" * 8,
+            "CGTACGT" + "A" * 5,  # too short
+            "CGTACGTAAAACAAAA",  # a mismatch inside the run
+            "CGTACGTAAAAAAC",  # a mismatch at the end
+            "A" * 8,
+            "",
+        ]
+        self.assertEqual(trim(seqs, 6, 0), [8, 0, 0, 0, 8, 0])
+        self.assertEqual(trim(seqs, 6, 1), [8, 0, 9, 7, 8, 0])
+
+        reads = self.make_reads()
+        for min_bases, mismatches in [(6, 0), (6, 1), (3, 2)]:
+            self.assertEqual(
+                trim(reads, min_bases, mismatches),
+                [_polyA_trim_ref(r, min_bases, mismatches) for r in reads],
+            )
+
+    def test_trim_tags(self):
+        from collections import defaultdict
+        from spacemake.cutadapt_bam import load_adapters, make_adapters, trim_chunk
+
+        args = self.make_args(
+            f"--start-sequence={self.smart}",
+            "--polyA-min-bases=6",
+            "--min-qual=0",
+            "--min-length=0",
+        )
+        seqs = [
+            self.smart[-8:] + "CGTAGCTAGCTAGGATCGAT" + "A" * 10,
+            self.smart[-10:] + "A" * 20,
+            "A" * 30,
+            self.smart,
+            "CGTAGCTAGCTAGGATCGAT",
+        ]
+        quals = ["I" * len(s) for s in seqs]
+        stats = defaultdict(int)
+        total = defaultdict(int)
+        trim_hists = dict(start=defaultdict(int), polyA=defaultdict(int))
+        keep, starts, ends, tags = trim_chunk(
+            seqs,
+            quals,
+            make_adapters(load_adapters("", "")),
+            args,
+            stats=stats,
+            total=total,
+            lhist=defaultdict(int),
+            trim_hists=trim_hists,
+        )
+        # with --min-length=0 reads that are trimmed completely are kept
+        self.assertEqual(keep.tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(starts, [8, 10, 0, 30, 0])
+        self.assertEqual(ends, [28, 10, 0, 30, 20])
+        self.assertEqual(dict(tags)["ZS"], [8, 10, None, 30, None])
+        self.assertEqual(dict(tags)["ZP"], [20, 0, 0, None, None])
+        self.assertEqual(
+            [tag for tag, values in tags], ["ZS", "ZP", "A3", "T3", "A5", "T5"]
+        )
+        self.assertEqual(stats["N_start_trimmed"], 3)
+        self.assertEqual(total["bp_start_trimmed"], 48)
+        self.assertEqual(stats["N_polyA_trimmed"], 3)
+        self.assertEqual(total["bp_polyA_trimmed"], 60)
+        self.assertEqual(dict(trim_hists["polyA"]), {0: 2, 10: 1, 20: 1, 30: 1})
+
+        # the default --min-length drops them
+        args.min_length = 18
+        keep, starts, ends, tags = trim_chunk(
+            seqs,
+            quals,
+            make_adapters(load_adapters("", "")),
+            args,
+            stats=defaultdict(int),
+            total=defaultdict(int),
+            lhist=defaultdict(int),
+            trim_hists=dict(start=defaultdict(int), polyA=defaultdict(int)),
+        )
+        self.assertEqual(keep.tolist(), [0, 4])
+
+    def test_start_and_left_adapter(self):
+        import tempfile
+        from collections import defaultdict
+        from spacemake.cutadapt_bam import load_adapters, make_adapters, trim_chunk
+
+        left = "GTCTCGTGGGCTCGG"
+        insert = "CGTAGCTAGCTAGGATCGATTGCAGTCA"
+        with tempfile.TemporaryDirectory() as tmp:
+            fa = os.path.join(tmp, "left.fa")
+            with open(fa, "w") as f:
+                f.write(f">nextera\n{left}\n")
+
+            args = self.make_args(
+                f"--start-sequence={self.smart}",
+                f"--adapters-left={fa}",
+                "--min-qual=0",
+            )
+            adapters = make_adapters(load_adapters("", fa))
+
+        seqs = [
+            self.smart[-10:] + left + insert,
+            left + insert,
+            self.smart[-10:] + insert,
+        ]
+        stats = defaultdict(int)
+        total = defaultdict(int)
+        keep, starts, ends, tags = trim_chunk(
+            seqs,
+            ["I" * len(s) for s in seqs],
+            adapters,
+            args,
+            stats=stats,
+            total=total,
+            lhist=defaultdict(int),
+            trim_hists=dict(start=defaultdict(int), polyA=defaultdict(int)),
+        )
+        # the adapter is cut right after the trimmed start sequence
+        self.assertEqual(starts, [10 + len(left), len(left), 10])
+        self.assertEqual(
+            [seqs[i][start:end] for i, start, end in zip(keep, starts, ends)],
+            [insert] * 3,
+        )
+        tags = dict(tags)
+        self.assertEqual(tags["ZS"], [10, None, 10])
+        self.assertEqual(tags["A5"], ["nextera", "nextera", None])
+        self.assertEqual(tags["T5"], [str(len(left))] * 2 + [None])
+        self.assertEqual(stats["N_nextera"], 2)
+        self.assertEqual(total["bp_nextera"], 2 * len(left))
+        self.assertEqual(total["bp_trimmed"], 20 + 2 * len(left))
+
+    def test_adapter_seeds(self):
+        import random
+        import tempfile
+        from collections import defaultdict
+        from spacemake.cutadapt_bam import load_adapters, make_adapters, trim_chunk
+
+        right = {
+            "polyA": "A" * 20,
+            "nextera": "CTGTCTCTTATACACATCTGACGCTGCCGACGA",
+            "truseq": "AGATCGGAAGAGC",
+            "smart": "AATGATACGGCGACCACCGAGATCTACACTCTTTCCCTACACGACGCTCTTC",
+        }
+        left = {
+            "nextera_left": "GTCTCGTGGGCTCGG",
+            "TSO": "AAGCAGTGGTATCAACGCAGAGTGAATGGG",
+        }
+        rng = random.Random(3)
+        rnd = lambda l: "".join([rng.choice("ACGT") for i in range(l)])
+
+        def fragment(seq):
+            "a piece of seq with some errors"
+            a = rng.choice([0, 0, rng.randrange(len(seq))])
+            b = rng.choice([len(seq), rng.randrange(a, len(seq) + 1)])
+            frag = list(seq[a:b])
+            for i in range(rng.choice([0, 0, 1, 2])):
+                if frag:
+                    frag[rng.randrange(len(frag))] = rng.choice("ACGTN")
+
+            return "".join(frag)
+
+        seqs = []
+        for i in range(3000):
+            seq = rnd(rng.choice([0, 3, 6, 20, 40, 60]))
+            if rng.random() < 0.4:
+                seq = fragment(rng.choice(list(left.values()))) + seq
+            if rng.random() < 0.6:
+                seq += fragment(rng.choice(list(right.values())))
+            if rng.random() < 0.2:
+                # N bases anywhere
+                seq = "".join([rng.choice("N" + c * 9) for c in seq])
+
+            seqs.append(seq)
+
+        quals = ["".join([rng.choice("I" * 8 + "#") for c in s]) for s in seqs]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = []
+            for name, adapters in [("right", right), ("left", left)]:
+                fnames.append(os.path.join(tmp, f"{name}.fa"))
+                with open(fnames[-1], "w") as f:
+                    for adap_name, seq in adapters.items():
+                        f.write(f">{adap_name}\n{seq}\n")
+
+            adapters = make_adapters(load_adapters(*fnames))
+
+        adapters_right, adapters_left, seeds = adapters
+        unfiltered = (
+            adapters_right,
+            adapters_left,
+            _AllCandidates(len(adapters_right) + len(adapters_left)),
+        )
+        self.assertEqual(seeds.unfiltered, [])
+        for argv in [
+            [],
+            ["--min-length=0"],
+            [f"--start-sequence={self.smart}", "--polyA-min-bases=6"],
+        ]:
+            args = self.make_args(*argv)
+            res = []
+            for adap in [adapters, unfiltered]:
+                counts = [defaultdict(int) for i in range(3)]
+                keep, starts, ends, tags = trim_chunk(
+                    seqs,
+                    quals,
+                    adap,
+                    args,
+                    *counts,
+                    trim_hists=dict(start=defaultdict(int), polyA=defaultdict(int)),
+                )
+                counts = [list(c.items()) for c in counts]
+                res.append((keep.tolist(), starts, ends, tags, counts))
+
+            self.assertEqual(res[0], res[1], argv)
+            stats = dict(res[0][-1][0])
+            for name in list(right) + list(left):
+                self.assertGreater(stats.get("N_" + name, 0), 0, name)
+
+    def test_trim_report(self):
+        import tempfile
+        from spacemake.cutadapt_bam import write_trim_report
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "polyA.report.txt")
+            write_trim_report(
+                fname,
+                "polyA",
+                dict(N_input=5, N_polyA_trimmed=3),
+                dict(bp_polyA_trimmed=60),
+                {20: 1, 0: 2, 10: 1, 30: 1},
+            )
+            lines = open(fname).read().split("\n")
+
+        self.assertTrue(lines[0].startswith("## cutadapt_bam.py"))
+        self.assertEqual(
+            lines[1:],
+            [
+                "",
+                "## METRICS CLASS\tpolyA_trimming",
+                "NUM_READS\tNUM_READS_TRIMMED\tNUM_BASES_TRIMMED",
+                "5\t3\t60",
+                "",
+                "## HISTOGRAM\tjava.lang.Integer",
+                "BIN\tVALUE",
+                "0\t2",
+                "10\t1",
+                "20\t1",
+                "30\t1",
+                "",
+            ],
+        )
+
+
+
+class AnnotatorTests(unittest.TestCase):
+    gtf = f"{base_dir}/test_data/test_genome.gtf.gz"
+
+    def load_annotation(self, tmp):
+        "the uncompiled GenomeAnnotation of the test genome"
+        from spacemake.annotator import GenomeAnnotation, load_GTF
+
+        tabular = os.path.join(tmp, "test_genome.tsv")
+        load_GTF(self.gtf).to_csv(tabular, sep="\t")
+        return GenomeAnnotation.from_uncompiled_df(tabular)
+
+    def make_reads(self, n=2000, seed=5):
+        "chromosomes, strands and aligned blocks of random reads"
+        import random
+        from spacemake.annotator import load_GTF
+
+        rng = random.Random(seed)
+        chroms = sorted(load_GTF(self.gtf)["chrom"].unique()) + ["chrUn"]
+        reads = []
+        for i in range(n):
+            pos = sorted(rng.sample(range(0, 400), 2 * rng.choice([1, 1, 2, 3])))
+            blocks = list(zip(pos[0::2], pos[1::2]))
+            reads.append((rng.choice(chroms), rng.choice("+-"), blocks))
+
+        return [list(x) for x in zip(*reads)]
+
+    def query_blocks_ref(self, ga, chroms, strands, blocks, antisense=False):
+        "query_blocks_batch() one read at a time via query_blocks()"
+        from spacemake.annotator import as_strand
+
+        results = []
+        for chrom, strand, read_blocks in zip(chroms, strands, blocks):
+            res = [list(x) for x in ga.query_blocks(chrom, strand, read_blocks)]
+            if antisense:
+                res_as = ga.query_blocks(chrom, as_strand[strand], read_blocks)
+                res = [a + list(b) for a, b in zip(res, res_as)]
+
+            results.append(tuple([",".join(x) for x in res]) if res[0] else None)
+
+        return results
+
+    def test_query_blocks_batch(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ga = self.load_annotation(tmp).compile("")
+
+        chroms, strands, blocks = self.make_reads()
+        # multi-segment reads and reads without annotation are covered
+        self.assertGreater(sum([len(b) > 1 for b in blocks]), 0)
+        self.assertIn("chrUn", chroms)
+        for antisense in [False, True]:
+            expect = self.query_blocks_ref(ga, chroms, strands, blocks, antisense)
+            self.assertIn(None, expect)
+            self.assertTrue(any([r and "," in r[0] for r in expect]))
+            self.assertEqual(
+                ga.query_blocks_batch(chroms, strands, blocks, antisense=antisense),
+                expect,
+            )
+
+        self.assertEqual(
+            ga.query_tags_batch(chroms, strands, blocks),
+            self.query_blocks_ref(ga, chroms, strands, blocks),
+        )
+        self.assertEqual(ga.query_blocks_batch([], [], []), [])
+        self.assertEqual(ga.query_tags_batch([], [], []), [])
+
+    def test_binary_index(self):
+        import runpy
+        import tempfile
+        from unittest import mock
+        import spacemake.annotator as annotator
+        from spacemake.annotator import AnnotationIndex, GenomeAnnotation
+
+        chroms, strands, blocks = self.make_reads()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "compiled")
+            os.mkdir(path)
+            ga = self.load_annotation(tmp).compile(path)
+            self.assertTrue(AnnotationIndex.exists(path))
+            files = [f for f in os.listdir(path) if f != "annotation.idx"]
+            ga_csv = GenomeAnnotation.from_compiled_index(path)
+            ga_bin = GenomeAnnotation.from_binary_index(path)
+            for antisense in [False, True]:
+                expect = ga_csv.query_blocks_batch(
+                    chroms, strands, blocks, antisense=antisense
+                )
+                self.assertEqual(
+                    ga.query_blocks_batch(chroms, strands, blocks, antisense=antisense),
+                    expect,
+                )
+                self.assertEqual(
+                    ga_bin.query_blocks_batch(
+                        chroms, strands, blocks, antisense=antisense
+                    ),
+                    expect,
+                )
+
+            # the per-read lookup builds its nested lists from the index
+            self.assertEqual(
+                self.query_blocks_ref(ga_bin, chroms, strands, blocks),
+                self.query_blocks_ref(ga_csv, chroms, strands, blocks),
+            )
+
+            # an older cache without the binary index, which can not be
+            # added to it: the annotation goes ahead with a warning, and
+            # nothing is left behind
+            os.remove(AnnotationIndex.get_filename(path))
+            bam_in = os.path.join(tmp, "in.bam")
+            bam_out = os.path.join(tmp, "out.bam")
+            self.write_bam(bam_in, chroms[:100], strands[:100], blocks[:100])
+            argv = [
+                "annotator.py",
+                f"--gtf={self.gtf}",
+                f"--compiled={path}",
+                "--use-compiled",
+                f"--bam-in={bam_in}",
+                f"--bam-out={bam_out}",
+            ]
+            with mock.patch.object(sys, "argv", argv), mock.patch(
+                "os.replace", side_effect=PermissionError("read-only")
+            ), self.assertLogs("AnnotationIndex", level="WARNING"):
+                runpy.run_path(annotator.__file__, run_name="__main__")
+
+            self.assertEqual(sorted(os.listdir(path)), sorted(files))
+            self.assertTrue(os.path.exists(bam_out))
+
+    def write_bam(self, fname, chroms, strands, blocks):
+        "unpaired alignments with the given blocks, as M and N cigar operations"
+        import pysam
+
+        names = sorted(set(chroms))
+        header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": c, "LN": 1000} for c in names]}
+        with pysam.AlignmentFile(fname, "wb", header=header) as bam:
+            reads = zip(chroms, strands, blocks)
+            for i, (chrom, strand, read_blocks) in enumerate(reads):
+                cigar = []
+                for (x0, x1), nxt in zip(read_blocks, read_blocks[1:] + [None]):
+                    cigar.append((0, x1 - x0))
+                    if nxt:
+                        cigar.append((3, nxt[0] - x1))
+
+                read = pysam.AlignedSegment(bam.header)
+                read.query_name = f"read{i}"
+                read.reference_id = names.index(chrom)
+                read.reference_start = read_blocks[0][0]
+                read.cigartuples = cigar
+                read.query_sequence = "A" * sum([x1 - x0 for x0, x1 in read_blocks])
+                read.flag = 16 if strand == "-" else 0
+                bam.write(read)
+
+
 if __name__ == "__main__":
     ## run this line once, together with output redirect to create
     ## reference md5 hashes from a run you deem correct
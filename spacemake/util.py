@@ -73,18 +73,173 @@ def BAM_src(src):
         yield read.query_name, read.query_sequence, read.query_qualities
 
 
-def read_fq(fname, skim=0):
+def read_raw(fname, bufsize=2**22, n_queue=4):
+    """
+    Reads a (possibly gzip compressed) file in a background thread and yields
+    large chunks of raw, decompressed bytes. zlib releases the GIL, so that
+    decompression runs in parallel with whatever consumes the data.
+    """
     import gzip
+    import queue
+    import threading
+
+    Q = queue.Queue(n_queue)
+
+    def reader():
+        try:
+            if fname.endswith(".gz"):
+                f = gzip.open(fname, "rb")
+            else:
+                f = open(fname, "rb")
+
+            with f:
+                while True:
+                    buf = f.read(bufsize)
+                    Q.put(buf)
+                    if not buf:
+                        break
+
+        except BaseException as err:
+            Q.put(err)
+
+    t = threading.Thread(target=reader, name=f"read_raw({fname})", daemon=True)
+    t.start()
+    while True:
+        buf = Q.get()
+        if isinstance(buf, BaseException):
+            raise buf
+
+        if not buf:
+            break
+
+        yield buf
+
+    t.join()
+
+
+class FASTQBlockReader:
+    """
+    Hands out blocks of raw bytes from a (possibly gzip compressed) FASTQ file,
+    each holding a requested number of complete records. Taking the same
+    number of records from two mate files keeps the blocks in sync, even if
+    the number changes from block to block. Parse with parse_fq_block().
+    """
+
+    def __init__(self, fname, **kw):
+        import numpy as np
+
+        self.src = read_raw(fname, **kw)
+        self.data = b""
+        self.start = 0
+        # positions of newlines in data, from self.start on
+        self.newlines = np.zeros(0, dtype=np.int64)
+        self.eof = False
+        self.n_records = 0
+        self.n_bytes = 0
+
+    @property
+    def bytes_per_record(self):
+        "average size of the records handed out so far"
+        return self.n_bytes / max(self.n_records, 1)
+
+    def _fill(self):
+        import numpy as np
+
+        buf = next(self.src, None)
+        if buf is None:
+            self.eof = True
+            return
+
+        rest = self.data[self.start :]
+        newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+        self.newlines = np.concatenate(
+            [self.newlines - self.start, newlines + len(rest)]
+        )
+        self.data = rest + buf
+        self.start = 0
+
+    def take(self, n_records):
+        """
+        returns the next block with n_records records (fewer at the end of
+        the file) or b"" if the file is exhausted.
+        """
+        n_lines = 4 * n_records
+        while len(self.newlines) < n_lines and not self.eof:
+            self._fill()
+
+        if len(self.newlines) >= n_lines:
+            end = self.newlines[n_lines - 1] + 1
+            self.newlines = self.newlines[n_lines:]
+        else:
+            end = len(self.data)
+            self.newlines = self.newlines[:0]
+
+        block = self.data[self.start : end]
+        self.start = end
+        if end == len(self.data) and self.eof:
+            if not block.strip():
+                return b""
+            if not block.endswith(b"\n"):
+                block += b"\n"
 
+        self.n_records += n_records
+        self.n_bytes += len(block)
+        return block
+
+    def skip(self, n_records, n_step=100000):
+        "discards the next n_records records, e.g. to resume an earlier run"
+        while n_records > 0:
+            n = min(n_records, n_step)
+            if not self.take(n):
+                break
+
+            n_records -= n
+
+
+def read_fq_blocks(fname, n_records=1000, **kw):
+    """
+    Splits a (possibly gzip compressed) FASTQ file into blocks of raw bytes,
+    each holding exactly n_records complete records (the last block may be
+    shorter). Blocks of two mate files therefore stay in sync. Parse with
+    parse_fq_block().
+    """
+    reader = FASTQBlockReader(fname, **kw)
+    while True:
+        block = reader.take(n_records)
+        if not block:
+            break
+
+        yield block
+
+
+def parse_fq_block(block):
+    """
+    Parses a block of raw FASTQ data (see read_fq_blocks()) into three lists:
+    names (without the leading '@'), sequences and quality strings.
+    """
+    text = block.decode("ascii")
+    if "\r" in text:
+        text = text.replace("\r", "")
+
+    lines = text.split("\n")
+    n = len(lines) // 4
+    names = [name[1:] for name in lines[0 : 4 * n : 4]]
+    return names, lines[1 : 4 * n : 4], lines[3 : 4 * n : 4]
+
+
+def FASTQ_block_src(fname):
+    for block in read_fq_blocks(fname):
+        yield from zip(*parse_fq_block(block))
+
+
+def read_fq(fname, skim=0):
     logger = logging.getLogger("spacemake.util.read_fq")
-    if fname.endswith(".gz"):
-        src = FASTQ_src(gzip.open(fname, mode="rt"))
+    if type(fname) is not str:
+        src = FASTQ_src(fname)  # assume its a stream or file-like object already
     elif fname.endswith(".bam"):
         src = BAM_src(fname)
-    elif type(fname) is str:
-        src = FASTQ_src(open(fname))
     else:
-        src = FASTQ_src(fname)  # assume its a stream or file-like object already
+        src = FASTQ_block_src(fname)
 
     for i, (name, seq, qual) in enumerate(src):
         if not skim: